@@ -0,0 +1,91 @@
+import glob
+import os
+import threading
+from typing import List, Set
+
+# set to 0 to let concurrent searches share all cores
+PIN_CPUS = os.getenv("SAGE_PIN_CPUS", "1") == "1"
+
+
+def parse_cpulist(cpulist: str) -> List[int]:
+    """Parse the kernel's cpulist format, e.g. '0-3,8-11'."""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def available_cpus() -> Set[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return set(os.sched_getaffinity(0))
+    return set(range(os.cpu_count() or 1))
+
+
+def numa_nodes(cpus: Set[int]) -> List[Set[int]]:
+    """The given CPUs grouped by NUMA node (one group if the topology is unknown)."""
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+        with open(path) as f:
+            node = set(parse_cpulist(f.read())) & cpus
+        if node:
+            nodes.append(node)
+    return nodes or [set(cpus)]
+
+
+class CpuAllocator:
+    """
+    Hands each running job its own set of cores, so concurrent Sage searches
+    do not oversubscribe the machine. Sets are kept on one NUMA node when
+    they fit, so threads and their (first touch) memory stay local.
+    """
+
+    def __init__(self, slots: int):
+        self.available = available_cpus()
+        self.per_job = max(1, len(self.available) // max(1, slots))
+        self.nodes = numa_nodes(self.available)
+        self.free = set(self.available)
+        # sets handed out exclusively, only these go back to `free`
+        self.allocated: List[frozenset] = []
+        self.lock = threading.Lock()
+
+    def allocate(self) -> List[int]:
+        with self.lock:
+            # fullest node that still fits the whole set, else spill over the
+            # nodes with the most free cores
+            nodes = sorted(self.nodes, key=lambda node: -len(node & self.free))
+            fitting = [node for node in nodes if len(node & self.free) >= self.per_job]
+            if fitting:
+                nodes = [min(fitting, key=lambda node: len(node & self.free))]
+
+            cpus: List[int] = []
+            for node in nodes:
+                cpus.extend(sorted(node & self.free)[: self.per_job - len(cpus)])
+                if len(cpus) == self.per_job:
+                    break
+            if not cpus:
+                # more jobs than slots: share everything
+                return sorted(self.available)
+            self.free -= set(cpus)
+            self.allocated.append(frozenset(cpus))
+            return cpus
+
+    def release(self, cpus: List[int]) -> None:
+        with self.lock:
+            if frozenset(cpus) in self.allocated:
+                self.allocated.remove(frozenset(cpus))
+                self.free |= set(cpus)
+
+
+def pin_current_thread(cpus: List[int]) -> None:
+    """
+    Pin the calling thread. Processes it starts inherit the affinity from
+    birth, so Sage's thread pool never runs outside its cores.
+    """
+    if PIN_CPUS and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
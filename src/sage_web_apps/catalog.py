@@ -0,0 +1,291 @@
+"""
+Catalog of finished jobs, for finding and reusing earlier results by their
+search parameters and inputs.
+
+An SQLite database (SAGE_CATALOG_PATH, default <jobs_root>/catalog.sqlite)
+with one indexed row per job: the config fields people search by (enzyme,
+tolerances, modifications, quantification), input names and hashes, Sage
+version, timings and the headline results. The job.json files stay the
+source of truth, `Catalog.sync` indexes jobs that finished since the last
+sync, so jobs from before the catalog existed are picked up too.
+"""
+
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sage_web_apps.jobs import SEARCH, Job
+
+CATALOG_PATH = os.getenv("SAGE_CATALOG_PATH")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    submitted_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    queue_seconds REAL,
+    run_seconds REAL,
+    cpu_seconds REAL,
+    sage_version TEXT,
+    fasta_name TEXT,
+    fasta_sha256 TEXT,
+    files INTEGER,
+    enzyme TEXT,
+    missed_cleavages INTEGER,
+    semi_enzymatic INTEGER,
+    precursor_tol TEXT,
+    fragment_tol TEXT,
+    static_mods TEXT,
+    variable_mods TEXT,
+    quant TEXT,
+    wide_window INTEGER,
+    psms INTEGER,
+    peptides INTEGER,
+    proteins INTEGER,
+    config TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, submitted_at);
+CREATE INDEX IF NOT EXISTS jobs_submitted ON jobs (submitted_at);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_fasta ON jobs (fasta_sha256);
+CREATE INDEX IF NOT EXISTS jobs_params ON jobs (enzyme, precursor_tol, fragment_tol);
+CREATE INDEX IF NOT EXISTS jobs_quant ON jobs (quant);
+CREATE INDEX IF NOT EXISTS jobs_version ON jobs (sage_version);
+
+CREATE TABLE IF NOT EXISTS inputs (
+    job_id TEXT NOT NULL REFERENCES jobs (job_id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS inputs_job ON inputs (job_id);
+CREATE INDEX IF NOT EXISTS inputs_name ON inputs (name);
+CREATE INDEX IF NOT EXISTS inputs_sha256 ON inputs (sha256);
+"""
+
+# filter widgets offer the distinct values of these columns
+OPTION_COLUMNS = ("status", "enzyme", "precursor_tol", "fragment_tol", "quant", "sage_version")
+
+
+def _tolerance(tolerance: dict) -> Optional[str]:
+    for unit in ("ppm", "da"):
+        if unit in tolerance:
+            low, high = tolerance[unit]
+            return f"{low:g} to {high:g} {unit}"
+    return None
+
+
+def _mods(mods: dict) -> str:
+    # 'C:57.0215, M:15.9949', variable mods can list several masses
+    return ", ".join(
+        f"{residue}:{'/'.join(f'{m:g}' for m in (mass if isinstance(mass, list) else [mass]))}"
+        for residue, mass in sorted(mods.items())
+    )
+
+
+def config_fields(config: dict) -> Dict[str, object]:
+    """The searchable fields of a Sage config, with Sage's defaults filled in."""
+    database = config.get("database") or {}
+    enzyme = database.get("enzyme") or {}
+    quant = config.get("quant") or {}
+
+    cleave_at = enzyme.get("cleave_at", "KR")
+    restrict = enzyme.get("restrict", "P")
+    if not cleave_at:
+        enzyme_name = "non-specific"
+    else:
+        enzyme_name = cleave_at + (f" not before {restrict}" if restrict else "")
+        enzyme_name += " (C-term)" if enzyme.get("c_terminal", True) else " (N-term)"
+
+    if quant.get("tmt"):
+        quant_name = f"TMT {quant['tmt']}"
+    elif quant.get("lfq"):
+        quant_name = "LFQ"
+    else:
+        quant_name = "none"
+
+    return {
+        "enzyme": enzyme_name,
+        "missed_cleavages": enzyme.get("missed_cleavages", 1),
+        "semi_enzymatic": int(bool(enzyme.get("semi_enzymatic", False))),
+        "precursor_tol": _tolerance(config.get("precursor_tol") or {}),
+        "fragment_tol": _tolerance(config.get("fragment_tol") or {}),
+        "static_mods": _mods(database.get("static_mods") or {}),
+        "variable_mods": _mods(database.get("variable_mods") or {}),
+        "quant": quant_name,
+        "wide_window": int(bool(config.get("wide_window", False))),
+    }
+
+
+def sage_version(job: Job) -> Optional[str]:
+    # results.json records the version of Sage that wrote the results
+    try:
+        with open(os.path.join(job.output_path, "results.json")) as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def job_row(job: Job) -> Dict[str, object]:
+    row: Dict[str, object] = {
+        "job_id": job.job_id,
+        "owner": job.owner,
+        "name": job.name,
+        "status": job.status,
+        "submitted_at": job.submitted_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "queue_seconds": job.started_at - job.submitted_at if job.started_at else None,
+        "run_seconds": (
+            job.finished_at - job.started_at
+            if job.started_at and job.finished_at
+            else None
+        ),
+        "cpu_seconds": job.cpu_seconds,
+        "sage_version": sage_version(job),
+        "fasta_name": os.path.basename(job.fasta_path) if job.fasta_path else None,
+        "fasta_sha256": job.fasta_sha256,
+        "files": len(job.mzml_paths),
+        "psms": job.summary.get("psms"),
+        "peptides": job.summary.get("peptides"),
+        "proteins": job.summary.get("proteins"),
+        "config": None,
+    }
+    row.update(dict.fromkeys(config_fields({})))
+    # workspaces of cancelled and timed out jobs no longer have the config
+    try:
+        with open(job.config_path) as f:
+            config = json.load(f)
+        row["config"] = json.dumps(config)
+        row.update(config_fields(config))
+    except (OSError, TypeError, ValueError, AttributeError):
+        pass
+    return row
+
+
+class Catalog:
+    def __init__(self, path: str):
+        self.path = path
+        # one writer per process, SQLite serializes writers across processes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode = WAL")
+            con.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # a connection per call, sessions run in different threads
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            con.row_factory = sqlite3.Row
+            con.execute("PRAGMA foreign_keys = ON")
+            # commits, or rolls back on an exception; closing is up to us
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def sync(self, jobs: Iterable[Job]) -> int:
+        """Index finished jobs that are new or changed, returns how many."""
+        with self.lock, self._connect() as con:
+            indexed = dict(con.execute("SELECT job_id, finished_at FROM jobs"))
+            changed = [
+                job
+                for job in jobs
+                if job.kind == SEARCH
+                and job.finished
+                and indexed.get(job.job_id, -1) != job.finished_at
+            ]
+            rows = [job_row(job) for job in changed]
+            if rows:
+                columns = list(rows[0])
+                con.executemany(
+                    f"INSERT OR REPLACE INTO jobs ({', '.join(columns)}) "
+                    f"VALUES ({', '.join(':' + c for c in columns)})",
+                    rows,
+                )
+                con.executemany(
+                    "DELETE FROM inputs WHERE job_id = ?", [(job.job_id,) for job in changed]
+                )
+                con.executemany(
+                    "INSERT INTO inputs (job_id, name, sha256) VALUES (?, ?, ?)",
+                    [
+                        (job.job_id, os.path.basename(path.rstrip("/")), sha256)
+                        for job in changed
+                        for path, sha256 in zip(
+                            job.mzml_paths,
+                            job.mzml_sha256 or [None] * len(job.mzml_paths),
+                        )
+                    ],
+                )
+            return len(rows)
+
+    def options(self, owner: Optional[str] = None) -> Dict[str, List[str]]:
+        """Distinct values of the OPTION_COLUMNS, for filter widgets."""
+        where, params = ("WHERE owner = ?", [owner]) if owner else ("", [])
+        with self._connect() as con:
+            return {
+                column: [
+                    value
+                    for (value,) in con.execute(
+                        f"SELECT DISTINCT {column} FROM jobs {where} ORDER BY {column}",
+                        params,
+                    )
+                    if value is not None
+                ]
+                for column in OPTION_COLUMNS
+            }
+
+    def search(
+        self,
+        owner: Optional[str] = None,
+        text: str = "",
+        filters: Optional[Dict[str, List[str]]] = None,
+        page: int = 0,
+        page_size: int = 50,
+    ) -> Tuple[List[dict], int]:
+        """
+        One page of jobs, newest first, and the number of matching jobs.
+        `text` matches job, FASTA and mzML names, modifications and input
+        hashes, `filters` maps OPTION_COLUMNS to the accepted values.
+        """
+        clauses, params = [], []
+        if owner:
+            clauses.append("owner = ?")
+            params.append(owner)
+        for column, values in (filters or {}).items():
+            if column not in OPTION_COLUMNS:
+                raise ValueError(f"Cannot filter on {column}")
+            if values:
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        if text:
+            # the text matches literally, also its % and _
+            escaped = re.sub(r"([\\%_])", r"\\\1", text)
+            pattern = f"%{escaped}%"
+            like = "LIKE ? ESCAPE '\\'"
+            clauses.append(
+                f"(name {like} OR fasta_name {like} OR static_mods {like}"
+                f" OR variable_mods {like} OR fasta_sha256 = ? OR job_id IN"
+                f" (SELECT job_id FROM inputs WHERE name {like} OR sha256 = ?))"
+            )
+            params.extend([pattern, pattern, pattern, pattern, text, pattern, text])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        with self._connect() as con:
+            (total,) = con.execute(f"SELECT count(*) FROM jobs {where}", params).fetchone()
+            rows = con.execute(
+                f"SELECT jobs.*, (SELECT group_concat(name, ', ') FROM inputs"
+                f" WHERE inputs.job_id = jobs.job_id) AS mzml_names"
+                f" FROM jobs {where} ORDER BY submitted_at DESC LIMIT ? OFFSET ?",
+                params + [page_size, page * page_size],
+            ).fetchall()
+        return [dict(row) for row in rows], total
@@ -0,0 +1,168 @@
+import os
+import time
+
+import pandas as pd
+import streamlit as st
+
+from sage_web_apps.catalog import CATALOG_PATH, Catalog
+from sage_web_apps.jobs import Quotas, Scheduler
+from sage_web_apps.profiling import profile_section
+from sage_web_apps.users import get_user_id
+
+# the catalog page of the multipage app (sage_web_app.py)
+
+is_local = os.getenv("LOCAL", "False") == "True"
+jobs_root = os.path.abspath(os.getenv("SAGE_WORKSPACE_DIR", "sage_jobs"))
+
+# in server mode users only see their own jobs, unless the catalog is shared
+shared = is_local or os.getenv("SAGE_CATALOG_SHARED", "False") == "True"
+
+PAGE_SIZE = 50
+
+FILTERS = {
+    "status": "Status",
+    "enzyme": "Enzyme",
+    "precursor_tol": "Precursor tolerance",
+    "fragment_tol": "Fragment tolerance",
+    "quant": "Quantification",
+    "sage_version": "Sage version",
+}
+
+
+@st.cache_resource
+def get_catalog():
+    # read-only view of the jobs, the search page runs the worker
+    scheduler = Scheduler(Quotas.from_env(), jobs_root)
+    return scheduler, Catalog(CATALOG_PATH or os.path.join(jobs_root, "catalog.sqlite"))
+
+
+def format_time(timestamp):
+    if timestamp is None or pd.isna(timestamp):
+        return None
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+
+scheduler, catalog = get_catalog()
+user_id = get_user_id(is_local)
+owner = None if shared else user_id
+
+st.title("Job catalog")
+st.caption("Finished searches by parameters and inputs. Open one to see its results.")
+
+with profile_section("sync"):
+    # only jobs that finished since the last rerun are read and indexed
+    catalog.sync(scheduler.jobs.values())
+
+with profile_section("filters"):
+    text = st.text_input(
+        "Search",
+        placeholder="Job, FASTA or mzML name, modification or file SHA-256",
+    )
+    options = catalog.options(owner)
+    filters = {}
+    columns = st.columns(3)
+    for i, (column, label) in enumerate(FILTERS.items()):
+        filters[column] = columns[i % 3].multiselect(label, options[column])
+
+if st.session_state.get("catalog_last") != (text, str(filters)):
+    st.session_state.catalog_last = (text, str(filters))
+    st.session_state.catalog_page = 0
+
+with profile_section("search"):
+    rows, total = catalog.search(
+        owner, text, filters, st.session_state.catalog_page, PAGE_SIZE
+    )
+
+if not rows:
+    st.info("No finished jobs match.")
+    st.stop()
+
+df = pd.DataFrame(rows)
+df["open"] = "search?job=" + df["job_id"]
+df["submitted_at"] = df["submitted_at"].map(format_time)
+df["run_seconds"] = df["run_seconds"] / 60
+df["cpu_seconds"] = df["cpu_seconds"] / 3600
+columns = [
+    "open",
+    "name",
+    "status",
+    "submitted_at",
+    "fasta_name",
+    "mzml_names",
+    "enzyme",
+    "missed_cleavages",
+    "precursor_tol",
+    "fragment_tol",
+    "static_mods",
+    "variable_mods",
+    "quant",
+    "sage_version",
+    "psms",
+    "peptides",
+    "proteins",
+    "run_seconds",
+    "cpu_seconds",
+]
+if shared:
+    columns.insert(2, "owner")
+
+st.dataframe(
+    df[columns],
+    hide_index=True,
+    use_container_width=True,
+    column_config={
+        "open": st.column_config.LinkColumn("Job", display_text="Open"),
+        "name": "Name",
+        "owner": "Owner",
+        "status": "Status",
+        "submitted_at": "Submitted",
+        "fasta_name": "FASTA",
+        "mzml_names": "mzML files",
+        "enzyme": "Enzyme",
+        "missed_cleavages": "Missed cleavages",
+        "precursor_tol": "Precursor tolerance",
+        "fragment_tol": "Fragment tolerance",
+        "static_mods": "Static mods",
+        "variable_mods": "Variable mods",
+        "quant": "Quantification",
+        "sage_version": "Sage version",
+        "psms": "PSMs",
+        "peptides": "Peptides",
+        "proteins": "Proteins",
+        "run_seconds": st.column_config.NumberColumn("Run time (min)", format="%.1f"),
+        "cpu_seconds": st.column_config.NumberColumn("CPU hours", format="%.2f"),
+    },
+)
+
+pages = max(1, -(-total // PAGE_SIZE))
+c1, c2, c3 = st.columns([1, 2, 1], vertical_alignment="center")
+if c1.button("Previous", disabled=st.session_state.catalog_page == 0, use_container_width=True):
+    st.session_state.catalog_page -= 1
+    st.rerun()
+c2.caption(f"Page {st.session_state.catalog_page + 1} of {pages} ({total} jobs)")
+if c3.button("Next", disabled=st.session_state.catalog_page >= pages - 1, use_container_width=True):
+    st.session_state.catalog_page += 1
+    st.rerun()
+
+st.subheader("Reuse a config")
+configs = {row["job_id"]: row for row in rows if row["config"]}
+if not configs:
+    st.caption("None of the jobs on this page still have their config.")
+    st.stop()
+job_id = st.selectbox(
+    "Job",
+    list(configs),
+    format_func=lambda job_id: f"{configs[job_id]['name']} ({job_id})",
+)
+c1, c2 = st.columns(2)
+c1.download_button(
+    "Download config",
+    configs[job_id]["config"],
+    file_name=f"{configs[job_id]['name']}_config.json",
+    mime="application/json",
+    use_container_width=True,
+)
+# the search page offers it like a config from the config builder
+if c2.button("Use in Search", use_container_width=True):
+    st.session_state["generated_config"] = configs[job_id]["config"]
+    st.switch_page("sage_app.py")
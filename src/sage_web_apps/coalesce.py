@@ -0,0 +1,198 @@
+"""
+Coalescing of queued jobs that search the same database with the same
+settings: a worker searches all their mzML files in one Sage run, so the
+fragment index is built once, and then splits the results back per job.
+
+Sage estimates FDR over all files of a run, so every job's q-values are
+recomputed from its own PSMs after the split (target-decoy competition on
+Sage's discriminant score). Jobs that quantify (LFQ/TMT) are never
+coalesced, their intensities are computed across all files of a run.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import List, Optional, Set
+
+import numpy as np
+import pandas as pd
+
+from sage_web_apps.jobs import SEARCH, Job, directory_size
+
+# most jobs searched in one Sage run, 1 disables coalescing
+MAX_BATCH_JOBS = int(os.getenv("SAGE_COALESCE_MAX_JOBS", "8"))
+
+# options of the app's Sage command that take a per-job value
+PER_JOB_OPTIONS = ("--output_directory", "--fasta")
+
+# the score Sage's own FDR is computed on, by Sage version
+SCORE_COLUMNS = ["sage_discriminant_score", "discriminant_score", "hyperscore"]
+
+PSM_TABLE = "results.sage"
+FRAGMENT_TABLE = "matched_fragments.sage"
+
+
+def command_flags(job: Job) -> List[str]:
+    """The job's Sage options, without the per-job ones."""
+    # the command is [sage, config, *mzml, options...]
+    options = job.command[2 + len(job.mzml_paths) :]
+    skip = {i + 1 for i, arg in enumerate(options) if arg in PER_JOB_OPTIONS}
+    return sorted(
+        arg
+        for i, arg in enumerate(options)
+        if i not in skip and arg not in PER_JOB_OPTIONS
+    )
+
+
+def search_key(job: Job) -> Optional[str]:
+    """Jobs with equal keys can share a Sage run, None if the job cannot."""
+    if job.kind != SEARCH or not job.fasta_sha256 or not job.config_path:
+        return None
+    try:
+        with open(job.config_path) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return None
+    quant = config.get("quant") or {}
+    if quant.get("lfq") or quant.get("tmt"):
+        return None
+
+    # per-job paths, the app passes them on the command line
+    config.pop("mzml_paths", None)
+    config.pop("output_directory", None)
+    if isinstance(config.get("database"), dict):
+        config["database"].pop("fasta", None)
+
+    key = [job.command[0], job.fasta_sha256, config, command_flags(job), job.timeout]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def file_names(job: Job) -> Set[str]:
+    # Sage's filename column, must be unique within a run to split it
+    return {os.path.basename(path.rstrip("/")) for path in job.mzml_paths}
+
+
+def batch_command(jobs: List[Job], output_path: str) -> List[str]:
+    """One Sage command over the mzML files of all jobs."""
+    leader = jobs[0]
+    mzml_paths = [path for job in jobs for path in job.mzml_paths]
+    return [
+        leader.command[0],
+        leader.config_path,
+        *mzml_paths,
+        "--output_directory",
+        output_path,
+        "--fasta",
+        leader.fasta_path,
+        *command_flags(leader),
+    ]
+
+
+def input_shares(jobs: List[Job]) -> List[float]:
+    """Each job's share of a batch's CPU time, by the size of its mzML files."""
+    sizes = []
+    for job in jobs:
+        size = 0
+        for path in job.mzml_paths:
+            if os.path.isdir(path):
+                size += directory_size(path)
+            else:
+                size += os.path.getsize(path)
+        sizes.append(size)
+    total = sum(sizes)
+    if not total:
+        return [1 / len(jobs)] * len(jobs)
+    return [size / total for size in sizes]
+
+
+def q_values(scores: np.ndarray, decoys: np.ndarray) -> np.ndarray:
+    """
+    Target-decoy q-values: decoys / targets scoring at least as high, made
+    monotonic from the lowest score up.
+    """
+    order = np.argsort(-scores, kind="stable")
+    decoy_count = np.cumsum(decoys[order])
+    target_count = np.cumsum(~decoys[order])
+    fdr = decoy_count / np.maximum(target_count, 1)
+    q = np.minimum.accumulate(fdr[::-1])[::-1]
+    result = np.empty(len(q))
+    result[order] = q
+    return result
+
+
+def rescore(psms: pd.DataFrame) -> pd.DataFrame:
+    """Recompute spectrum, peptide and protein q-values of one job's PSMs."""
+    score_column = next((c for c in SCORE_COLUMNS if c in psms.columns), None)
+    if score_column is None or "label" not in psms.columns or psms.empty:
+        return psms
+    psms = psms.copy()
+    decoys = psms["label"].to_numpy() == -1
+    if "spectrum_q" in psms.columns:
+        psms["spectrum_q"] = q_values(psms[score_column].to_numpy(float), decoys)
+
+    # peptide and protein level: the best PSM of each competes
+    for column, key in (("peptide_q", "peptide"), ("protein_q", "proteins")):
+        if column not in psms.columns or key not in psms.columns:
+            continue
+        best = psms.groupby([key, "label"], sort=False)[score_column].max()
+        q = pd.Series(
+            q_values(
+                best.to_numpy(float),
+                best.index.get_level_values("label").to_numpy() == -1,
+            ),
+            index=best.index,
+        )
+        keys = pd.MultiIndex.from_frame(psms[[key, "label"]])
+        psms[column] = q.reindex(keys).to_numpy()
+    return psms
+
+
+def _read(path: str) -> pd.DataFrame:
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, sep="\t")
+
+
+def write_table(df: pd.DataFrame, path: str) -> None:
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, sep="\t", index=False)
+
+
+def split_outputs(batch_path: str, jobs: List[Job]) -> None:
+    """Demultiplex a batch's output directory into the jobs' output directories."""
+    for job in jobs:
+        os.makedirs(job.output_path, exist_ok=True)
+
+    psm_ids = {}
+    # PSMs first, fragment rows are assigned through their psm_id
+    files = sorted(os.listdir(batch_path), key=lambda f: not f.startswith(PSM_TABLE))
+    for file in files:
+        path = os.path.join(batch_path, file)
+        stem, ext = file.split(".", 1)[0], os.path.splitext(file)[1]
+        if file.startswith(PSM_TABLE) and ext in (".tsv", ".parquet"):
+            psms = _read(path)
+            for job in jobs:
+                subset = psms[psms["filename"].isin(file_names(job))]
+                psm_ids[job.job_id] = subset["psm_id"]
+                write_table(rescore(subset), os.path.join(job.output_path, file))
+        elif file.startswith(FRAGMENT_TABLE) and ext in (".tsv", ".parquet"):
+            fragments = _read(path)
+            for job in jobs:
+                ids = psm_ids.get(job.job_id, [])
+                subset = fragments[fragments["psm_id"].isin(ids)]
+                write_table(subset, os.path.join(job.output_path, file))
+        elif stem == "results" and ext == ".json":
+            with open(path) as f:
+                results = json.load(f)
+            for job in jobs:
+                results["mzml_paths"] = job.mzml_paths
+                results["output_directory"] = job.output_path
+                with open(os.path.join(job.output_path, file), "w") as f:
+                    json.dump(results, f, indent=2)
+        elif os.path.isfile(path):
+            # logs and anything else are the same for every job
+            for job in jobs:
+                shutil.copyfile(path, os.path.join(job.output_path, file))
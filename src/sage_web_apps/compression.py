@@ -0,0 +1,91 @@
+"""
+Parallel gzip compression of uploads, the way pigz does it: the input is cut
+into blocks that are deflated independently on a thread pool (zlib releases
+the GIL) and joined into a single gzip member, so any gzip reader, Sage
+included, can read the result.
+"""
+
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque
+
+# uncompressed bytes per block, each block costs a few bytes of ratio
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# threads compressing one file
+THREADS = int(os.getenv("SAGE_GZIP_THREADS", str(os.cpu_count() or 1)))
+
+LEVEL = 6
+
+
+def _deflate(block: bytes, level: int, last: bool) -> bytes:
+    # raw deflate, a full flush ends every block but the last byte-aligned
+    # without depending on earlier blocks, so the blocks can be concatenated
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH
+    )
+
+
+class ParallelGzipWriter:
+    """A binary file-like object writing `path` as gzip."""
+
+    def __init__(
+        self,
+        path: str,
+        threads: int = THREADS,
+        level: int = LEVEL,
+        block_size: int = BLOCK_SIZE,
+    ):
+        self.file = open(path, "wb")
+        self.level = level
+        self.block_size = block_size
+        self.threads = max(1, threads)
+        self.pool = ThreadPoolExecutor(self.threads, thread_name_prefix="gzip")
+        # blocks in compression, in file order
+        self.pending: Deque[Future] = deque()
+        self.buffer = bytearray()
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        # magic, deflate, no flags, mtime, no extra flags, unix
+        self.file.write(struct.pack("<BBBBIBB", 0x1F, 0x8B, 8, 0, int(time.time()), 0, 3))
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.pool.submit(_deflate, block, self.level, last))
+        # bounded read-ahead, memory stays at a few blocks per thread
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.popleft().result())
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[: self.block_size]), last=False)
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self.buffer), last=True)
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+            self.file.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
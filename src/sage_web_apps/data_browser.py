@@ -0,0 +1,70 @@
+import os
+from typing import List, Tuple
+
+# file endings Sage can read spectra from (.d = Bruker timsTOF folders)
+MZML_EXTENSIONS = (".mzml", ".mzml.gz", ".d")
+FASTA_EXTENSIONS = (".fasta", ".fa", ".fasta.gz")
+
+
+def has_extension(name: str, extensions: Tuple[str, ...]) -> bool:
+    return name.lower().endswith(extensions)
+
+
+def find_mzml_files(folder_path: str) -> List[str]:
+    """Return the paths of all mzML (or Bruker .d) inputs in a folder."""
+    return sorted(
+        os.path.join(folder_path, f)
+        for f in os.listdir(folder_path)
+        if has_extension(f, MZML_EXTENSIONS)
+    )
+
+
+def get_data_roots() -> List[str]:
+    """
+    Server-side data roots users are allowed to browse.
+
+    Set with SAGE_DATA_ROOTS (os.pathsep separated) or `sage-app --data-root`.
+    """
+    roots = []
+    for root in os.getenv("SAGE_DATA_ROOTS", "").split(os.pathsep):
+        if root and os.path.isdir(root):
+            roots.append(os.path.realpath(root))
+    return roots
+
+
+def resolve_data_path(root: str, rel_path: str) -> str:
+    """
+    Resolve a path relative to an allow-listed root.
+
+    Symlinks are resolved before the check, so nothing outside the root can be
+    reached through '..' or a link pointing elsewhere.
+    """
+    root = os.path.realpath(root)
+    if root not in get_data_roots():
+        raise ValueError(f"{root} is not an allowed data root")
+
+    path = os.path.realpath(os.path.join(root, rel_path))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"{rel_path} is outside of {root}")
+    return path
+
+
+def list_data_dir(
+    root: str, rel_path: str, extensions: Tuple[str, ...]
+) -> Tuple[List[str], List[str]]:
+    """List sub folders and matching files (both relative to root) of a folder."""
+    folder = resolve_data_path(root, rel_path)
+
+    dirs, files = [], []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            rel_entry = os.path.relpath(entry.path, root)
+            # .d acquisitions are folders, but are selected like files
+            if has_extension(entry.name, extensions):
+                files.append(rel_entry)
+            elif entry.is_dir():
+                dirs.append(rel_entry)
+
+    return sorted(dirs), sorted(files)
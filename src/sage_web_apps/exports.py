@@ -0,0 +1,133 @@
+import os
+from typing import List, Optional, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# q-value columns of Sage's tables (results.sage.*, lfq.tsv)
+Q_VALUE_COLUMNS = ["spectrum_q", "peptide_q", "protein_q", "q_value"]
+
+TABLE_EXTENSIONS = (".tsv", ".parquet")
+
+# rows per batch while scanning, bounds the memory of an export
+BATCH_SIZE = 64 * 1024
+
+# parquet copies of TSV outputs, written by post-processing (postprocess.py)
+# to this folder of the job workspace, next to the output folder
+CONVERTED_DIR = "tables"
+
+
+def table_paths(output_path: str) -> List[str]:
+    return sorted(
+        os.path.join(output_path, f)
+        for f in os.listdir(output_path)
+        if f.endswith(TABLE_EXTENSIONS)
+    )
+
+
+def converted_path(path: str) -> str:
+    output_path, file = os.path.split(path)
+    stem = os.path.splitext(file)[0]
+    return os.path.join(os.path.dirname(output_path), CONVERTED_DIR, stem + ".parquet")
+
+
+def table_source(path: str) -> str:
+    """The output table itself, or its parquet copy once there is an up to date one."""
+    if not path.endswith(".tsv"):
+        return path
+    converted = converted_path(path)
+    if os.path.exists(converted) and (
+        os.path.getmtime(converted) >= os.path.getmtime(path)
+    ):
+        return converted
+    return path
+
+
+def open_table(path: str) -> ds.Dataset:
+    """A lazily scanned dataset over a Sage output table (TSV or parquet)."""
+    path = table_source(path)
+    if path.endswith(".parquet"):
+        return ds.dataset(path, format="parquet")
+    return ds.dataset(
+        path, format=ds.CsvFileFormat(parse_options=csv.ParseOptions(delimiter="\t"))
+    )
+
+
+def distinct_values(source: Union[str, ds.Dataset], column: str) -> List[str]:
+    """Unique values of one column of a table path or dataset, scanning only it."""
+    dataset = open_table(source) if isinstance(source, str) else source
+    values = set()
+    for batch in dataset.to_batches(columns=[column], batch_size=BATCH_SIZE):
+        values.update(pc.unique(batch.column(0)).to_pylist())
+    return sorted(str(v) for v in values if v is not None)
+
+
+def build_filter(
+    schema: pa.Schema,
+    max_q: Optional[float],
+    q_column: Optional[str],
+    filenames: Optional[List[str]],
+    targets_only: bool,
+) -> Optional[ds.Expression]:
+    expression = None
+
+    def add(condition):
+        nonlocal expression
+        expression = condition if expression is None else expression & condition
+
+    if max_q is not None and q_column in schema.names:
+        add(ds.field(q_column) <= max_q)
+    if filenames and "filename" in schema.names:
+        add(ds.field("filename").isin(filenames))
+    # Sage marks decoys with label -1
+    if targets_only and "label" in schema.names:
+        add(ds.field("label") == 1)
+    return expression
+
+
+def export_table(
+    source: Union[str, ds.Dataset],
+    dest: str,
+    columns: Optional[List[str]] = None,
+    max_q: Optional[float] = None,
+    q_column: Optional[str] = None,
+    filenames: Optional[List[str]] = None,
+    targets_only: bool = False,
+) -> int:
+    """
+    Write the filtered rows and selected columns of a table path or dataset
+    to dest (.parquet or .tsv.gz), batch by batch. Filters and columns are
+    pushed into the scan: parquet row groups whose statistics exclude the
+    filter are skipped and unselected columns are never decoded. Returns the
+    number of rows written.
+    """
+    dataset = open_table(source) if isinstance(source, str) else source
+    schema = dataset.schema
+    if columns:
+        schema = pa.schema([schema.field(c) for c in columns])
+    batches = dataset.to_batches(
+        columns=columns or None,
+        filter=build_filter(dataset.schema, max_q, q_column, filenames, targets_only),
+        batch_size=BATCH_SIZE,
+    )
+
+    rows = 0
+    if dest.endswith(".parquet"):
+        with pq.ParquetWriter(dest, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    else:
+        with pa.CompressedOutputStream(dest, "gzip") as sink:
+            with csv.CSVWriter(
+                sink,
+                schema,
+                write_options=csv.WriteOptions(delimiter="\t"),
+            ) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+    return rows
@@ -0,0 +1,263 @@
+"""
+Incremental searches: a job that adds mzML files to an earlier job searches
+only the new files, with the earlier job's FASTA, config and options.
+
+Sage's PSM table keeps every target and decoy PSM with its score, before any
+FDR filtering, so the q-values can be recomputed over the old and new files
+together (coalesce.rescore). Every search keeps the score columns of its own
+PSMs in a small parquet file (SCORES_FILE), and an extending job only reads
+those of the jobs it extends, never their full tables. Its own output tables
+hold the new files' PSMs and fragments with the q-values over all files; the
+earlier jobs' tables are referenced (COHORT_FILE) and read with this job's
+q-values of their PSMs (COHORT_Q_FILE) by the summary, plots, exports and SQL
+views. So an increment costs its own files plus a pass over the score
+columns, and the next increment can extend it in turn. Sage fits its
+discriminant score per run, scores of different runs are comparable but not
+identical to one search over all files.
+"""
+
+import json
+import os
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from sage_web_apps.catalog import sage_version
+from sage_web_apps.coalesce import (
+    FRAGMENT_TABLE,
+    PSM_TABLE,
+    SCORE_COLUMNS,
+    rescore,
+    search_key,
+    write_table,
+)
+from sage_web_apps.exports import (
+    BATCH_SIZE,
+    CONVERTED_DIR,
+    Q_VALUE_COLUMNS,
+    export_table,
+    open_table,
+)
+from sage_web_apps.jobs import COMPLETED, SEARCH, Job
+from sage_web_apps.quant import find_table, read_table
+
+# in the job's CONVERTED_DIR, next to the parquet copies of its tables
+SCORES_FILE = "scores.parquet"
+COHORT_FILE = "cohort.json"
+COHORT_Q_FILE = "cohort_q.parquet"
+
+# what rescore needs, besides the score column
+SCORE_STORE_COLUMNS = [
+    "psm_id",
+    "filename",
+    "label",
+    "peptide",
+    "proteins",
+    "spectrum_q",
+    "peptide_q",
+    "protein_q",
+]
+
+# the columns filters of PSM tables use (exports.build_filter, plots, the
+# summary), read from earlier tables to filter after their q-values are
+# replaced
+FILTER_COLUMNS = ["psm_id", "filename", "label", "rank"] + Q_VALUE_COLUMNS
+
+
+def _table_dir(job: Job) -> str:
+    return os.path.join(job.workspace, CONVERTED_DIR)
+
+
+def searched_files(job: Job) -> List[str]:
+    """mzML paths in the job's results, those of the jobs it extends included."""
+    try:
+        with open(os.path.join(job.output_path, "results.json")) as f:
+            return json.load(f)["mzml_paths"]
+    except (OSError, ValueError, KeyError):
+        return job.mzml_paths
+
+
+def can_extend(job: Job, sage_path: str) -> bool:
+    """Whether new files can be searched against the job's results."""
+    return (
+        job.kind == SEARCH
+        and job.status == COMPLETED
+        and job.command[0] == sage_path
+        # the same jobs can share a Sage run, no quantification across files
+        and search_key(job) is not None
+        and find_table(job.output_path, PSM_TABLE) is not None
+    )
+
+
+def score_store(job: Job) -> str:
+    """The job's SCORES_FILE, written from its PSM table the first time."""
+    path = os.path.join(_table_dir(job), SCORES_FILE)
+    if not os.path.exists(path):
+        psm_path = find_table(job.output_path, PSM_TABLE)
+        names = open_table(psm_path).schema.names
+        columns = [c for c in SCORE_STORE_COLUMNS + SCORE_COLUMNS if c in names]
+        os.makedirs(_table_dir(job), exist_ok=True)
+        tmp_path = f"{path[: -len('.parquet')]}.{uuid.uuid4().hex}.tmp.parquet"
+        export_table(psm_path, tmp_path, columns=columns)
+        os.replace(tmp_path, path)
+    return path
+
+
+def cohort(job: Job) -> List[Dict[str, Optional[str]]]:
+    """Tables of the jobs this one extends, oldest first, [] if it extends none."""
+    try:
+        with open(os.path.join(_table_dir(job), COHORT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def merge_parent(job: Job, parent: Optional[Job]) -> None:
+    """Rescore the job's PSMs with those of the jobs it extends."""
+    if parent is None or not can_extend(parent, job.command[0]):
+        raise RuntimeError(
+            f"the extended search {job.parent_id} is no longer available"
+        )
+    if sage_version(parent) != sage_version(job):
+        raise RuntimeError(
+            f"the extended search ran Sage {sage_version(parent)}, "
+            f"this one {sage_version(job)}"
+        )
+
+    psm_path = find_table(job.output_path, PSM_TABLE)
+    if psm_path is None:
+        raise RuntimeError("Sage wrote no PSMs for the new files")
+    earlier = cohort(parent) + [
+        {
+            "job_id": parent.job_id,
+            "psms": find_table(parent.output_path, PSM_TABLE),
+            "fragments": find_table(parent.output_path, FRAGMENT_TABLE),
+            "scores": score_store(parent),
+        }
+    ]
+    old = pd.concat([read_table(e["scores"]) for e in earlier], ignore_index=True)
+    new = read_table(psm_path)
+    # psm_id restarts in every run, the new ones follow all earlier ones
+    offset = int(old["psm_id"].max()) + 1 if len(old) else 0
+    new["psm_id"] += offset
+    scores = rescore(pd.concat([old, new[old.columns]], ignore_index=True))
+    q_columns = [c for c in Q_VALUE_COLUMNS if c in scores.columns]
+    new[q_columns] = scores[q_columns].iloc[len(old) :].to_numpy()
+    write_table(new, psm_path)
+
+    os.makedirs(_table_dir(job), exist_ok=True)
+    # the earlier tables stay as they are, this job reads them with these
+    scores.iloc[: len(old)][["psm_id"] + q_columns].to_parquet(
+        os.path.join(_table_dir(job), COHORT_Q_FILE), index=False
+    )
+
+    fragment_path = find_table(job.output_path, FRAGMENT_TABLE)
+    if fragment_path:
+        fragments = read_table(fragment_path)
+        fragments["psm_id"] += offset
+        write_table(fragments, fragment_path)
+
+    with open(os.path.join(_table_dir(job), COHORT_FILE), "w") as f:
+        json.dump(earlier, f, indent=2)
+
+    results_path = os.path.join(job.output_path, "results.json")
+    with open(results_path) as f:
+        results = json.load(f)
+    results["mzml_paths"] = searched_files(parent) + job.mzml_paths
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def earlier_tables(job: Job, path: str) -> Tuple[List[str], Optional[str]]:
+    """
+    The tables of the jobs it extends that belong to the job's output table
+    at path, and the q-values to read them with (None: as they are).
+    """
+    file = os.path.basename(path)
+    earlier = cohort(job)
+    if earlier and file.startswith(PSM_TABLE + "."):
+        q_path = os.path.join(_table_dir(job), COHORT_Q_FILE)
+        return [e["psms"] for e in earlier], q_path
+    if earlier and file.startswith(FRAGMENT_TABLE + "."):
+        return [e["fragments"] for e in earlier if e["fragments"]], None
+    return [], None
+
+
+class CohortTable:
+    """
+    A job's PSM table followed by those of the jobs it extends, read like a
+    pyarrow dataset. The earlier tables' q-values are replaced by the job's,
+    so they are filtered after reading.
+    """
+
+    def __init__(self, path: str, earlier: List[str], q_path: str):
+        self.path = path
+        self.earlier = earlier
+        self.q_path = q_path
+        self.schema = open_table(path).schema
+
+    def to_batches(
+        self,
+        columns: Optional[List[str]] = None,
+        filter: Optional[ds.Expression] = None,
+        batch_size: int = BATCH_SIZE,
+    ) -> Iterator[pa.RecordBatch]:
+        yield from open_table(self.path).to_batches(
+            columns=columns, filter=filter, batch_size=batch_size
+        )
+        columns = columns or self.schema.names
+        schema = pa.schema([self.schema.field(c) for c in columns])
+        q_values = pq.read_table(self.q_path)
+        for path in self.earlier:
+            dataset = open_table(path)
+            names = dataset.schema.names
+            read = [c for c in dict.fromkeys(columns + FILTER_COLUMNS) if c in names]
+            for batch in dataset.to_batches(columns=read, batch_size=batch_size):
+                table = pa.Table.from_batches([batch])
+                rows = pc.index_in(table["psm_id"], value_set=q_values["psm_id"])
+                for column in q_values.column_names[1:]:
+                    if column in read:
+                        i = read.index(column)
+                        values = q_values[column].take(rows)
+                        table = table.set_column(
+                            i, column, values.cast(table.schema.field(i).type)
+                        )
+                if filter is not None:
+                    table = table.filter(filter)
+                yield from table.select(columns).cast(schema).to_batches()
+
+    def to_table(
+        self,
+        columns: Optional[List[str]] = None,
+        filter: Optional[ds.Expression] = None,
+    ) -> pa.Table:
+        columns = columns or self.schema.names
+        schema = pa.schema([self.schema.field(c) for c in columns])
+        return pa.Table.from_batches(self.to_batches(columns, filter), schema)
+
+
+def open_output(job: Job, path: str) -> Union[ds.Dataset, CohortTable]:
+    """
+    An output table of the job. Its PSM and fragment tables include those of
+    the jobs it extends.
+    """
+    earlier, q_path = earlier_tables(job, path)
+    if q_path:
+        return CohortTable(path, earlier, q_path)
+    dataset = open_table(path)
+    if not earlier:
+        return dataset
+    return ds.dataset(
+        [dataset] + [open_table(p) for p in earlier], schema=dataset.schema
+    )
+
+
+def open_psms(job: Job) -> Optional[Union[ds.Dataset, CohortTable]]:
+    """The job's PSMs, with those of the jobs it extends, None without any."""
+    path = find_table(job.output_path, PSM_TABLE)
+    return open_output(job, path) if path else None
@@ -0,0 +1,445 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from dataclasses import asdict, dataclass, field, fields
+from typing import Dict, Iterable, List, Optional, Tuple
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMED_OUT = "timed out"
+
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED, TIMED_OUT)
+
+# what a job runs: a Sage search, or auto-tuning trials (tuning.py) or a
+# preview search (preview.py) run by a worker like searches are (tasks.py)
+SEARCH = "search"
+TUNING = "tuning"
+PREVIEW = "preview"
+
+# job state, written to the job's workspace on every status change
+JOB_FILE = "job.json"
+
+# created (mkdir is atomic, also on NFS) by whoever takes a queued job
+CLAIM_DIR = ".claim"
+
+# created by the UI to ask the worker running a job to stop it
+CANCEL_FILE = "cancel"
+
+# written by tuning and preview jobs to their output directory (tasks.py)
+TASK_RESULT_FILE = "task_result.json"
+
+# zip of the output directory, in the workspace; the search name is only used
+# for the download's file name (download_name), it is free text
+ARCHIVE_FILE = "output.zip"
+
+# files kept when a stopped job's workspace is released
+KEEP_ON_RELEASE = ("stdout.txt", "stderr.txt", JOB_FILE, TASK_RESULT_FILE)
+
+
+class QuotaError(Exception):
+    """Raised when a user is over one of their quotas."""
+
+
+def _env_number(name, default):
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+@dataclass
+class Quotas:
+    # 0 means unlimited
+    max_running_jobs: int = 0
+    max_cpu_hours: float = 0.0
+    max_workspace_bytes: int = 0
+    window_hours: float = 24.0
+
+    @classmethod
+    def from_env(cls) -> "Quotas":
+        return cls(
+            max_running_jobs=int(_env_number("SAGE_USER_MAX_JOBS", 0)),
+            max_cpu_hours=_env_number("SAGE_USER_CPU_HOURS", 0.0),
+            max_workspace_bytes=int(_env_number("SAGE_USER_DISK_GB", 0) * 1024**3),
+            window_hours=_env_number("SAGE_QUOTA_WINDOW_HOURS", 24.0),
+        )
+
+
+@dataclass
+class Job:
+    job_id: str
+    owner: str
+    name: str
+    workspace: str
+    command: List[str]
+    output_path: str
+    fasta_path: Optional[str] = None
+    # content hash, jobs on the same database can share a search (coalesce.py)
+    fasta_sha256: Optional[str] = None
+    mzml_paths: List[str] = field(default_factory=list)
+    # content hashes of mzml_paths, None for Bruker .d folders and for server
+    # data until the worker validated it
+    mzml_sha256: List[Optional[str]] = field(default_factory=list)
+    config_path: Optional[str] = None
+    status: str = PENDING
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    pid: Optional[int] = None
+    returncode: Optional[int] = None
+    cpu_seconds: float = 0.0
+    error: Optional[str] = None
+    # wall-clock limit in seconds, None = no limit
+    timeout: Optional[float] = None
+    # 'host:pid' of the worker running the job, refreshed with every heartbeat
+    worker: Optional[str] = None
+    heartbeat_at: Optional[float] = None
+    # cores the job is pinned to on its worker
+    cpus: List[int] = field(default_factory=list)
+    # first job of the coalesced Sage run this job was searched in
+    batch_id: Optional[str] = None
+    # earlier job whose results this one extends with new mzML files (incremental.py)
+    parent_id: Optional[str] = None
+    kind: str = SEARCH
+    # headline results (target PSMs, peptides, proteins at 1% FDR)
+    summary: Dict[str, int] = field(default_factory=dict)
+    # post-processing step -> error, the search itself completed (postprocess.py)
+    postprocess_errors: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    @property
+    def zip_path(self) -> str:
+        path = os.path.join(self.workspace, ARCHIVE_FILE)
+        # archives of older versions were named after the job
+        legacy = f"{self.name}.zip"
+        if not os.path.exists(path) and legacy == download_name(self.name) + ".zip":
+            legacy = os.path.join(self.workspace, legacy)
+            if os.path.exists(legacy):
+                return legacy
+        return path
+
+    @property
+    def claim_path(self) -> str:
+        return os.path.join(self.workspace, CLAIM_DIR)
+
+    @property
+    def cancel_requested(self) -> bool:
+        return os.path.exists(os.path.join(self.workspace, CANCEL_FILE))
+
+
+def download_name(name: str) -> str:
+    """A search name as a file name: only letters, digits and ._- are kept."""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name).strip("._") or "sage_results"
+
+
+def save_job(job: Job) -> None:
+    path = os.path.join(job.workspace, JOB_FILE)
+    # write then rename, so readers never see a half written file
+    with open(path + ".tmp", "w") as f:
+        json.dump(asdict(job), f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def load_job(path: str) -> Job:
+    with open(path) as f:
+        data = json.load(f)
+    # ignore keys written by other versions of the app
+    names = {f.name for f in fields(Job)}
+    return Job(**{k: v for k, v in data.items() if k in names})
+
+
+def is_job_process(job: Job) -> bool:
+    """Check that job.pid is still the Sage process of this job (pids get reused)."""
+    try:
+        with open(f"/proc/{job.pid}/cmdline", "rb") as f:
+            return f.read().split(b"\0")[0].decode() == job.command[0]
+    except (OSError, IndexError, TypeError):
+        return False
+
+
+def log_tail(job: Job, log: str, max_bytes: int = 4096) -> str:
+    """Last lines of a job's stdout.txt/stderr.txt, to follow its progress."""
+    path = os.path.join(job.output_path, log)
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, os.path.getsize(path) - max_bytes))
+            return f.read().decode(errors="replace")
+    except OSError:
+        return ""
+
+
+def proc_cpu_seconds(pid: int) -> float:
+    """CPU time (user + system) used so far by a running process, from /proc."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # skip 'pid (comm)', comm may contain spaces
+            values = f.read().rsplit(")", 1)[1].split()
+        return (int(values[11]) + int(values[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def directory_size(path: str) -> int:
+    """Bytes used by the files in a directory tree (symlinks are not followed)."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def signal_process_group(pgid: int, sig: int) -> None:
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def claim_job(job: Job, claimant: str) -> bool:
+    """Take a queued job. Only one of several concurrent claimants succeeds."""
+    try:
+        os.mkdir(job.claim_path)
+    except FileExistsError:
+        return False
+    with open(os.path.join(job.claim_path, "claimant"), "w") as f:
+        f.write(claimant)
+    return True
+
+
+def claimant(job: Job) -> Optional[str]:
+    try:
+        with open(os.path.join(job.claim_path, "claimant")) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def drop_claim(job: Job) -> bool:
+    """Remove a claim. Only one of several concurrent callers succeeds."""
+    stale_path = f"{job.claim_path}.{uuid.uuid4().hex}"
+    try:
+        # rename is atomic, rmtree is not
+        os.rename(job.claim_path, stale_path)
+    except OSError:
+        return False
+    shutil.rmtree(stale_path, ignore_errors=True)
+    return True
+
+
+def release_workspace(job: Job) -> None:
+    """Delete a job's inputs and outputs, keeping only its logs."""
+    for root, dirs, files in os.walk(job.workspace):
+        if CLAIM_DIR in dirs:
+            dirs.remove(CLAIM_DIR)
+        for file in files:
+            if file not in KEEP_ON_RELEASE:
+                try:
+                    os.remove(os.path.join(root, file))
+                except OSError:
+                    pass
+
+
+def fair_share_order(
+    pending: List[Job], running: Dict[str, int], cpu_seconds: Dict[str, float]
+) -> List[Job]:
+    """
+    Order pending jobs so users with the fewest running jobs, then the least
+    recent CPU time, go first. Jobs of the same user stay first in, first out.
+    """
+    return sorted(
+        pending,
+        key=lambda job: (
+            running.get(job.owner, 0),
+            cpu_seconds.get(job.owner, 0.0),
+            job.submitted_at,
+        ),
+    )
+
+
+def zip_output(job: Job) -> None:
+    with zipfile.ZipFile(job.zip_path, "w") as zipf:
+        for root, dirs, files in os.walk(job.output_path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                zipf.write(file_path, os.path.relpath(file_path, job.output_path))
+
+
+class Scheduler:
+    """
+    The job queue, as seen by the app.
+
+    Jobs live in their workspaces under `jobs_root`, which can be on storage
+    shared with worker nodes (see worker.py). Workers take pending jobs in
+    `queue` order, skipping users at their running job cap.
+    """
+
+    def __init__(self, quotas: Quotas, jobs_root: str):
+        self.quotas = quotas
+        self.jobs_root = jobs_root
+        self.lock = threading.Lock()
+        # job_id -> (job.json mtime, job)
+        self._cache: Dict[str, Tuple[int, Job]] = {}
+        # job_id -> (workspace stamp, bytes), see workspace_bytes
+        self._sizes: Dict[str, Tuple[tuple, int]] = {}
+
+    @property
+    def jobs(self) -> Dict[str, Job]:
+        """All jobs, reloading only the job.json files that changed."""
+        try:
+            names = os.listdir(self.jobs_root)
+        except FileNotFoundError:
+            names = []
+
+        with self.lock:
+            cache = {}
+            for name in names:
+                path = os.path.join(self.jobs_root, name, JOB_FILE)
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                    if name in self._cache and self._cache[name][0] == mtime:
+                        cache[name] = self._cache[name]
+                    else:
+                        cache[name] = (mtime, load_job(path))
+                except (OSError, ValueError, TypeError):
+                    continue
+            self._cache = cache
+            self._sizes = {k: v for k, v in self._sizes.items() if k in cache}
+            return {job_id: job for job_id, (_, job) in cache.items()}
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """One job, without listing the others."""
+        if not job_id or os.sep in job_id or job_id.startswith("."):
+            return None
+        path = os.path.join(self.jobs_root, job_id, JOB_FILE)
+        with self.lock:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                if job_id not in self._cache or self._cache[job_id][0] != mtime:
+                    self._cache[job_id] = (mtime, load_job(path))
+            except (OSError, ValueError, TypeError):
+                return None
+            return self._cache[job_id][1]
+
+    def user_jobs(self, owner: str, jobs: Optional[Iterable[Job]] = None) -> List[Job]:
+        """The user's jobs, newest first, from `jobs` if already listed."""
+        jobs = self.jobs.values() if jobs is None else jobs
+        jobs = [job for job in jobs if job.owner == owner]
+        return sorted(jobs, key=lambda job: job.submitted_at, reverse=True)
+
+    def workspace_bytes(self, job: Job) -> int:
+        """
+        directory_size of the job's workspace, walked again only when its top
+        level changed. job.json is part of it, so running jobs are measured
+        again with every heartbeat.
+        """
+        try:
+            with os.scandir(job.workspace) as entries:
+                stamp = tuple(
+                    sorted(
+                        (entry.name, entry.stat(follow_symlinks=False).st_mtime_ns)
+                        for entry in entries
+                    )
+                )
+        except OSError:
+            return 0
+        cached = self._sizes.get(job.job_id)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, directory_size(job.workspace))
+            self._sizes[job.job_id] = cached
+        return cached[1]
+
+    def _cpu_seconds(self, jobs: List[Job]) -> Dict[str, float]:
+        since = time.time() - self.quotas.window_hours * 3600
+        usage: Dict[str, float] = {}
+        for job in jobs:
+            # running jobs: cpu_seconds is updated by the worker's heartbeat
+            if job.status == RUNNING or (job.finished and (job.finished_at or 0) >= since):
+                usage[job.owner] = usage.get(job.owner, 0.0) + job.cpu_seconds
+        return usage
+
+    @staticmethod
+    def running(jobs: List[Job]) -> Dict[str, int]:
+        running: Dict[str, int] = {}
+        for job in jobs:
+            if job.status == RUNNING:
+                running[job.owner] = running.get(job.owner, 0) + 1
+        return running
+
+    def usage(self, owner: str, jobs: Optional[Iterable[Job]] = None) -> Dict[str, float]:
+        jobs = self.user_jobs(owner, jobs)
+        return {
+            "running": sum(job.status == RUNNING for job in jobs),
+            "pending": sum(job.status == PENDING for job in jobs),
+            "cpu_hours": self._cpu_seconds(jobs).get(owner, 0.0) / 3600,
+            "workspace_bytes": sum(self.workspace_bytes(job) for job in jobs),
+        }
+
+    def check_quota(self, owner: str, extra_bytes: int = 0) -> None:
+        """Raise QuotaError if the user cannot submit another job."""
+        usage = self.usage(owner)
+        if self.quotas.max_cpu_hours and usage["cpu_hours"] >= self.quotas.max_cpu_hours:
+            raise QuotaError(
+                f"CPU quota used up ({usage['cpu_hours']:.1f} of "
+                f"{self.quotas.max_cpu_hours:g} CPU-hours in the last "
+                f"{self.quotas.window_hours:g} hours)"
+            )
+        if (
+            self.quotas.max_workspace_bytes
+            and usage["workspace_bytes"] + extra_bytes > self.quotas.max_workspace_bytes
+        ):
+            raise QuotaError(
+                f"Workspace quota exceeded ({(usage['workspace_bytes'] + extra_bytes) / 1024**3:.1f} "
+                f"of {self.quotas.max_workspace_bytes / 1024**3:g} GB)"
+            )
+
+    def queue(self) -> List[Job]:
+        """Pending jobs that may start now, in fair-share order."""
+        jobs = list(self.jobs.values())
+        running = self.running(jobs)
+        pending = [job for job in jobs if job.status == PENDING]
+
+        queue = []
+        for job in fair_share_order(pending, running, self._cpu_seconds(jobs)):
+            cap = self.quotas.max_running_jobs
+            if cap and running.get(job.owner, 0) >= cap:
+                continue
+            queue.append(job)
+        return queue
+
+    def queue_position(self, job_id: str) -> Optional[int]:
+        """1-based position of a pending job in the current fair-share order."""
+        jobs = list(self.jobs.values())
+        pending = [job for job in jobs if job.status == PENDING]
+        order = fair_share_order(pending, self.running(jobs), self._cpu_seconds(jobs))
+        for i, job in enumerate(order):
+            if job.job_id == job_id:
+                return i + 1
+        return None
+
+    def submit(self, job: Job) -> None:
+        self.check_quota(job.owner)
+        save_job(job)
+
+    def cancel(self, job_id: str) -> None:
+        """Cancel a queued job, or ask the worker running it to stop it."""
+        job = self.get(job_id)
+        if job.status == PENDING and claim_job(job, "cancel"):
+            job.status = CANCELLED
+            job.finished_at = time.time()
+            release_workspace(job)
+            save_job(job)
+        elif not job.finished:
+            # a worker took the job meanwhile, it checks for this file
+            open(os.path.join(job.workspace, CANCEL_FILE), "w").close()
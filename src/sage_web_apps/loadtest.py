@@ -0,0 +1,299 @@
+"""
+Concurrent-session load test for sage_app.py.
+
+Drives N simulated sessions with Streamlit's app testing API (AppTest), each
+in its own process: AppTest cannot run several scripts side by side in one
+process. The sessions only queue their jobs (SAGE_MAX_RUNNING_JOBS=0), and one
+worker in the harness process runs them with `--slots` slots, like a worker
+node sharing the job spool. Sessions pick synthetic inputs from a temporary
+server data root and press Run. `stub_sage` stands in for Sage with a
+configurable runtime and output size.
+
+Memory is summed over the harness and the session processes. Every session
+process loads its own copy of the app's modules, so it overstates what one
+server process with N sessions would hold.
+
+AppTest cannot drive st.file_uploader, so inputs go through the server data
+browser and browser upload transfer is not part of the measurement.
+
+Run with `sage-loadtest --sessions 10 --runtime 5 --output-mb 20`.
+"""
+
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import random
+import stat
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+STAGES = ["load", "submit", "queue", "search", "detect", "render"]
+
+# how often a waiting session reruns the page (like the job status fragment)
+POLL_INTERVAL = 0.5
+
+
+def write_fasta(path: str, n_proteins: int) -> None:
+    with open(path, "w") as f:
+        for i in range(n_proteins):
+            sequence = "".join(random.choices("ACDEFGHIKLMNPQRSTVWY", k=400))
+            f.write(f">sp|P{i:05d}|SYN{i}_HUMAN Synthetic protein {i}\n")
+            for start in range(0, len(sequence), 60):
+                f.write(sequence[start : start + 60] + "\n")
+
+
+def _binary_array(n_values: int, accession: str, name: str) -> str:
+    data = base64.b64encode(os.urandom(n_values * 8)).decode()
+    return (
+        f'<binaryDataArray encodedLength="{len(data)}">\n'
+        '<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float"/>\n'
+        '<cvParam cvRef="MS" accession="MS:1000576" name="no compression"/>\n'
+        f'<cvParam cvRef="MS" accession="{accession}" name="{name}"/>\n'
+        f"<binary>{data}</binary>\n"
+        "</binaryDataArray>\n"
+    )
+
+
+def _spectrum(index: int, n_peaks: int) -> str:
+    mz = random.uniform(400, 1200)
+    return (
+        f'<spectrum index="{index}" id="scan={index + 1}" defaultArrayLength="{n_peaks}">\n'
+        '<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="2"/>\n'
+        f'<scanList count="1"><scan><cvParam cvRef="MS" accession="MS:1000016" '
+        f'name="scan start time" value="{index * 0.01:.3f}" unitName="minute"/>'
+        "</scan></scanList>\n"
+        '<precursorList count="1"><precursor><selectedIonList count="1"><selectedIon>'
+        f'<cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="{mz:.4f}"/>'
+        f'<cvParam cvRef="MS" accession="MS:1000041" name="charge state" value="{random.randint(2, 4)}"/>'
+        "</selectedIon></selectedIonList></precursor></precursorList>\n"
+        '<binaryDataArrayList count="2">\n'
+        + _binary_array(n_peaks, "MS:1000514", "m/z array")
+        + _binary_array(n_peaks, "MS:1000515", "intensity array")
+        + "</binaryDataArrayList>\n</spectrum>\n"
+    )
+
+
+def write_mzml(path: str, size_mb: float, n_peaks: int = 150) -> None:
+    """Write a well-formed mzML with random MS2 spectra of about size_mb."""
+    n_spectra = max(1, int(size_mb * 1024 * 1024 / len(_spectrum(0, n_peaks))))
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write('<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n')
+        f.write('<run id="synthetic">\n')
+        f.write(f'<spectrumList count="{n_spectra}">\n')
+        for i in range(n_spectra):
+            f.write(_spectrum(i, n_peaks))
+        f.write("</spectrumList>\n</run>\n</mzML>\n")
+
+
+def write_stub_executable(directory: str) -> str:
+    """A `sage` wrapper that runs stub_sage with this interpreter."""
+    path = os.path.join(directory, "sage")
+    with open(path, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" -m sage_web_apps.stub_sage "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+    return path
+
+
+class RssSampler(threading.Thread):
+    """Samples the resident memory of this process and the session processes."""
+
+    def __init__(self, interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples: List[int] = []
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def rss_bytes(pid="self") -> int:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:  # the process exited
+            pass
+        return 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            # Sage (stub) subprocesses of the worker are not multiprocessing children
+            sessions = multiprocessing.active_children()
+            self.samples.append(
+                self.rss_bytes() + sum(self.rss_bytes(p.pid) for p in sessions)
+            )
+            time.sleep(self.interval)
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def _finished(at) -> bool:
+    messages = [e.value for e in [*at.success, *at.error, *at.warning]]
+    return any(
+        m.startswith(("Sage completed", "Sage failed", "Search timed out", "Search was"))
+        for m in messages
+    )
+
+
+def run_session(app_path: str, mzml_names: List[str], timeout: float) -> Dict:
+    from streamlit.testing.v1 import AppTest
+
+    timings: Dict[str, float] = {}
+    at = AppTest.from_file(app_path, default_timeout=timeout)
+
+    start = time.perf_counter()
+    at.run()
+    timings["load"] = time.perf_counter() - start
+
+    at.sidebar.radio[0].set_value("Server data").run()
+    at.selectbox(key="fasta_files").set_value("synthetic.fasta")
+    at.multiselect(key="mzml_files").set_value(mzml_names)
+    at.selectbox(key="config_files").set_value("config.json")
+    at.run()
+
+    start = time.perf_counter()
+    at.button(key="run").click().run()
+    timings["submit"] = time.perf_counter() - start
+    if at.exception or at.error:
+        raise RuntimeError(f"submit failed: {[e.value for e in [*at.exception, *at.error]]}")
+
+    job_id = at.query_params["job"]
+    if isinstance(job_id, list):
+        job_id = job_id[0]
+    deadline = time.time() + timeout
+    while True:
+        start = time.perf_counter()
+        at.run()
+        if _finished(at):
+            render = time.perf_counter() - start
+            break
+        if time.time() > deadline:
+            raise TimeoutError(f"job {job_id} did not finish in {timeout}s")
+        time.sleep(POLL_INTERVAL)
+
+    with open(os.path.join(os.environ["SAGE_WORKSPACE_DIR"], job_id, "job.json")) as f:
+        job = json.load(f)
+    timings["queue"] = job["started_at"] - job["submitted_at"]
+    timings["search"] = job["finished_at"] - job["started_at"]
+    # time from the job finishing until a page run noticed it, page render excluded
+    timings["detect"] = max(0.0, time.time() - render - job["finished_at"])
+    timings["render"] = render
+    timings["status"] = job["status"]
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test sage_app.py.")
+    parser.add_argument("--sessions", type=int, default=5, help="Concurrent sessions")
+    parser.add_argument("--slots", type=int, default=1, help="Worker slots")
+    parser.add_argument("--files", type=int, default=2, help="mzML files per search")
+    parser.add_argument("--file-mb", type=float, default=5, help="Size of each mzML")
+    parser.add_argument("--runtime", type=float, default=2, help="Stub search seconds")
+    parser.add_argument("--output-mb", type=float, default=1, help="Stub PSM table size")
+    parser.add_argument("--busy", action="store_true", help="Stub burns CPU")
+    parser.add_argument("--timeout", type=float, default=600, help="Per session")
+    parser.add_argument("--report", help="Also write the report as JSON here")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="sage_loadtest_")
+    data_root = os.path.join(work_dir, "data")
+    os.makedirs(data_root)
+
+    print(f"Writing synthetic inputs to {data_root}")
+    write_fasta(os.path.join(data_root, "synthetic.fasta"), 2000)
+    mzml_names = []
+    for i in range(args.files):
+        mzml_names.append(f"synthetic_{i}.mzML")
+        write_mzml(os.path.join(data_root, mzml_names[-1]), args.file_mb)
+    with open(os.path.join(data_root, "config.json"), "w") as f:
+        json.dump({"database": {"enzyme": {"cleave_at": "KR"}}}, f)
+
+    os.environ.update(
+        {
+            "LOCAL": "False",
+            "SAGE_DATA_ROOTS": data_root,
+            "SAGE_WORKSPACE_DIR": os.path.join(work_dir, "jobs"),
+            # the sessions only queue, the worker below runs the jobs
+            "SAGE_MAX_RUNNING_JOBS": "0",
+            "SAGE_EXECUTABLE": write_stub_executable(work_dir),
+            "STUB_SAGE_RUNTIME": str(args.runtime),
+            "STUB_SAGE_OUTPUT_MB": str(args.output_mb),
+            "STUB_SAGE_BUSY": "1" if args.busy else "0",
+        }
+    )
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sage_app.py")
+
+    from sage_web_apps.jobs import Quotas, Scheduler
+    from sage_web_apps.worker import Worker
+
+    scheduler = Scheduler(Quotas.from_env(), os.environ["SAGE_WORKSPACE_DIR"])
+    Worker(scheduler, args.slots).start()
+
+    sampler = RssSampler()
+    sampler.start()
+    start = time.perf_counter()
+    results, failures = [], []
+    # spawned, not forked: this process already runs the worker's threads
+    with ProcessPoolExecutor(
+        max_workers=args.sessions, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        futures = [
+            pool.submit(run_session, app_path, mzml_names, args.timeout)
+            for _ in range(args.sessions)
+        ]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                failures.append(str(e))
+    wall = time.perf_counter() - start
+    sampler.stopped.set()
+
+    completed = [r for r in results if r["status"] == "completed"]
+    report = {
+        "sessions": args.sessions,
+        "completed": len(completed),
+        "failed": args.sessions - len(completed),
+        "wall_seconds": wall,
+        "throughput_jobs_per_minute": len(completed) / wall * 60,
+        "peak_rss_mb": max(sampler.samples, default=0) / 1024**2,
+        "final_rss_mb": (sampler.samples[-1] if sampler.samples else 0) / 1024**2,
+        "stages": {
+            stage: {
+                f"p{p}": percentile([r[stage] for r in completed], p) for p in (50, 95, 99)
+            }
+            for stage in STAGES
+        },
+        "errors": failures,
+    }
+
+    print(f"\n{report['completed']}/{args.sessions} jobs completed in {wall:.1f}s")
+    print(f"Throughput: {report['throughput_jobs_per_minute']:.2f} jobs/minute")
+    print(f"Harness and session RSS: peak {report['peak_rss_mb']:.0f} MB, final {report['final_rss_mb']:.0f} MB")
+    print(f"\n{'stage':<8}{'p50':>10}{'p95':>10}{'p99':>10}  (seconds)")
+    for stage, values in report["stages"].items():
+        print(f"{stage:<8}" + "".join(f"{values[p]:>10.3f}" for p in ("p50", "p95", "p99")))
+    for error in failures:
+        print(f"error: {error}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
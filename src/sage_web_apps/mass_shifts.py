@@ -0,0 +1,203 @@
+"""
+Mass shifts of open searches: a finely binned histogram of precursor delta
+masses (experimental - calculated) of the target PSMs at FDR_THRESHOLD,
+built in one streaming pass, and its peaks annotated with known
+modifications.
+"""
+
+import csv
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow.dataset as ds
+from numpy.lib.stride_tricks import sliding_window_view
+
+from sage_web_apps.exports import BATCH_SIZE
+from sage_web_apps.incremental import CohortTable, open_psms
+from sage_web_apps.jobs import Job
+from sage_web_apps.plots import FDR_THRESHOLD, cached_bins
+from sage_web_apps.quant import find_table
+
+# Da per histogram bin
+BIN_WIDTH = 0.001
+
+# a peak is the highest bin within +- PEAK_WINDOW / 2 Da, its PSMs are the sum
+PEAK_WINDOW = 0.02
+
+# peaks need this many PSMs, or this share of all PSMs if that is more
+MIN_PEAK_PSMS = 5
+MIN_PEAK_FRACTION = 0.0005
+MAX_PEAKS = 50
+
+# Da between a peak and a modification to annotate it
+ANNOTATION_TOLERANCE = float(os.getenv("SAGE_MASS_SHIFT_TOLERANCE", "0.01"))
+
+C13 = 1.003355
+
+# monoisotopic delta masses (Unimod) of common modifications and artifacts,
+# extended or overridden by a name,mass CSV in SAGE_MASS_SHIFT_TABLE
+MODIFICATIONS = {
+    "Unmodified": 0.0,
+    "Deamidation": 0.984016,
+    "Amidation": -0.984016,
+    "Methyl": 14.01565,
+    "Carbonyl": 13.979265,
+    "Oxidation": 15.994915,
+    "Ammonia loss / pyro-Glu (Q)": -17.026549,
+    "Ammonium": 17.026549,
+    "Water loss / pyro-Glu (E)": -18.010565,
+    "Cation:Na": 21.981943,
+    "Formyl": 27.994915,
+    "Dimethyl": 28.0313,
+    "Dioxidation": 31.989829,
+    "Dehydroalanine (C)": -33.987721,
+    "Cation:K": 37.955882,
+    "Acetyl": 42.010565,
+    "Trimethyl": 42.04695,
+    "Carbamyl": 43.005814,
+    "Nitro": 44.985078,
+    "Trioxidation": 47.984744,
+    "Carbamidomethyl / Gly": 57.021464,
+    "Missing carbamidomethyl": -57.021464,
+    "Crotonyl": 68.026215,
+    "Propionamide / Ala": 71.037114,
+    "Sulfo": 79.956815,
+    "Phospho": 79.966331,
+    "Malonyl": 86.000394,
+    "Met loss + Acetyl": -89.02992,
+    "Succinyl": 100.016044,
+    "GlyGly": 114.042927,
+    "Cysteinyl": 119.004099,
+    "Met loss": -131.040485,
+    "iTRAQ4plex": 144.102063,
+    "Hex": 162.052824,
+    "HexNAc": 203.079373,
+    "TMT6plex": 229.162932,
+    "TMTpro": 304.207146,
+    "LRGG": 383.228103,
+}
+
+
+def modification_table() -> Dict[str, float]:
+    table = dict(MODIFICATIONS)
+    path = os.getenv("SAGE_MASS_SHIFT_TABLE")
+    if path:
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                table[row["name"]] = float(row["mass"])
+    return table
+
+
+def compute_mass_shifts(
+    dataset: Union[ds.Dataset, CohortTable]
+) -> Dict[str, np.ndarray]:
+    """
+    Counts of target PSMs at FDR_THRESHOLD per BIN_WIDTH of delta mass. The
+    bins cover the delta masses seen and grow while the table is streamed,
+    so one pass is enough; `start` is the first bin's index.
+    """
+    names = dataset.schema.names
+    passing = (ds.field("label") == 1) & (ds.field("spectrum_q") <= FDR_THRESHOLD)
+    if "rank" in names:
+        passing = passing & (ds.field("rank") == 1)
+
+    start = 0
+    counts = np.zeros(0, dtype=np.int64)
+    for batch in dataset.to_batches(
+        columns=["expmass", "calcmass"], filter=passing, batch_size=BATCH_SIZE
+    ):
+        delta = batch.column(0).to_numpy(zero_copy_only=False).astype(float)
+        delta -= batch.column(1).to_numpy(zero_copy_only=False)
+        bins = np.floor(delta[np.isfinite(delta)] / BIN_WIDTH).astype(np.int64)
+        if not len(bins):
+            continue
+        low, high = bins.min(), bins.max()
+        if not len(counts):
+            start = low
+        if low < start:
+            counts = np.concatenate([np.zeros(start - low, dtype=np.int64), counts])
+            start = low
+        if high >= start + len(counts):
+            grow = high - start - len(counts) + 1
+            counts = np.concatenate([counts, np.zeros(grow, dtype=np.int64)])
+        counts += np.bincount(bins - start, minlength=len(counts))
+
+    return {
+        "start": np.array([start], dtype=np.int64),
+        "width": np.array([BIN_WIDTH]),
+        "counts": counts,
+    }
+
+
+def mass_shifts(job: Job) -> Optional[Dict[str, np.ndarray]]:
+    """The delta mass histogram of a finished job, cached in its workspace."""
+    source = find_table(job.output_path, "results.sage")
+    if source is None:
+        return None
+    cache_path = os.path.join(
+        job.workspace, "plots", f"mass_shifts_q{FDR_THRESHOLD:g}_{BIN_WIDTH:g}Da.npz"
+    )
+    return cached_bins(cache_path, source, lambda: compute_mass_shifts(open_psms(job)))
+
+
+def bin_masses(shifts: Dict[str, np.ndarray]) -> np.ndarray:
+    """Delta mass at the center of each bin."""
+    width = shifts["width"][0]
+    return (shifts["start"][0] + np.arange(len(shifts["counts"])) + 0.5) * width
+
+
+def annotate(mass: float, table: Dict[str, float]) -> Tuple[Optional[str], float]:
+    """The closest modification (or one with a 13C isotope error) and its error."""
+    best, error = None, np.inf
+    for name, delta in table.items():
+        isotope = "13C isotope error" if delta == 0 else f"{name} + 13C"
+        for label, shifted in ((name, delta), (isotope, delta + C13)):
+            if abs(mass - shifted) < abs(error):
+                best, error = label, mass - shifted
+    if abs(error) > ANNOTATION_TOLERANCE:
+        return None, error
+    return best, error
+
+
+def pick_peaks(shifts: Dict[str, np.ndarray]) -> List[dict]:
+    """
+    Local maxima of the histogram, largest first: bins that are the highest
+    within PEAK_WINDOW, with the PSMs and centroid over that window.
+    """
+    counts = shifts["counts"]
+    if not counts.sum():
+        return []
+    half = max(1, int(round(PEAK_WINDOW / 2 / shifts["width"][0])))
+    masses = bin_masses(shifts)
+    windows = sliding_window_view(np.pad(counts, half), 2 * half + 1)
+    sums = windows.sum(axis=1)
+    centroids = (
+        sliding_window_view(np.pad(masses * counts, half), 2 * half + 1).sum(axis=1)
+        / np.maximum(sums, 1)
+    )
+    min_psms = max(MIN_PEAK_PSMS, MIN_PEAK_FRACTION * counts.sum())
+    candidates = np.flatnonzero(
+        (counts > 0) & (counts == windows.max(axis=1)) & (sums >= min_psms)
+    )
+
+    table = modification_table()
+    peaks, taken = [], np.zeros(len(counts), dtype=bool)
+    for i in candidates[np.argsort(-sums[candidates], kind="stable")]:
+        # flat tops have several maxima, the first taken wins
+        if taken[i]:
+            continue
+        taken[max(0, i - half) : i + half + 1] = True
+        name, error = annotate(centroids[i], table)
+        peaks.append(
+            {
+                "delta_mass": centroids[i],
+                "psms": int(sums[i]),
+                "share": sums[i] / counts.sum(),
+                "annotation": name,
+                "error": error if name else None,
+            }
+        )
+        if len(peaks) == MAX_PEAKS:
+            break
+    return peaks
@@ -0,0 +1,154 @@
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+import pandas as pd
+
+# what one browser session may keep in server memory
+SESSION_BUDGET_BYTES = int(float(os.getenv("SAGE_SESSION_MEMORY_MB", "512")) * 1024**2)
+
+# evicted frames are written here, one folder per session
+SPILL_DIR = os.getenv(
+    "SAGE_SPILL_DIR", os.path.join(tempfile.gettempdir(), "sage_web_app_spill")
+)
+
+KINDS = ["uploads", "results", "logs"]
+
+
+def object_bytes(obj) -> int:
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, (bytes, str)):
+        return len(obj)
+    return sys.getsizeof(obj)
+
+
+class SessionMemory:
+    """
+    Accounts for the bytes a session holds (uploads, result frames, logs) and
+    keeps them under a budget. Over budget, the least recently used objects
+    not used in the current rerun are evicted: frames are spilled to parquet
+    and read back on their next use, everything else is dropped and loaded
+    again. Objects used in the same rerun never evict each other; one that
+    does not fit next to them is replaced by its preview, if it has one.
+
+    Keys are tuples ending with a version (e.g. the file's mtime), entries of
+    other versions are dropped when a key is used.
+    """
+
+    def __init__(self, budget: int = SESSION_BUDGET_BYTES):
+        self.budget = budget
+        # key -> (kind, object, bytes), least recently used first
+        self.objects: "OrderedDict[Hashable, Tuple[str, object, int]]" = OrderedDict()
+        # key -> (kind, parquet path)
+        self.spilled: Dict[Hashable, Tuple[str, str]] = {}
+        # keys used in the current rerun, and keys holding a preview
+        self.shown: Set[Hashable] = set()
+        self.previews: Set[Hashable] = set()
+        self.upload_bytes = 0
+        self.spill_dir = os.path.join(SPILL_DIR, uuid.uuid4().hex)
+        # sessions end without a callback, clean up when the state is dropped
+        weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+    def begin_rerun(self) -> None:
+        self.shown = set()
+
+    def _drop_stale(self, key: tuple) -> None:
+        stale = [
+            other
+            for other in [*self.objects, *self.spilled]
+            if other[:-1] == key[:-1] and other != key
+        ]
+        for other in stale:
+            self.objects.pop(other, None)
+            self.previews.discard(other)
+            _, path = self.spilled.pop(other, (None, None))
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def _shown_bytes(self) -> int:
+        return self.upload_bytes + sum(
+            size for key, (_, _, size) in self.objects.items() if key in self.shown
+        )
+
+    def get(
+        self,
+        key: tuple,
+        kind: str,
+        load: Callable[[], object],
+        preview: Optional[Callable[[], object]] = None,
+        estimate: int = 0,
+    ):
+        """
+        The object stored under key, loading it (or its spill) if needed. With
+        `preview`, an object that does not fit next to the ones shown in this
+        rerun (by `estimate`, or once loaded) is replaced by preview().
+        """
+        self.shown.add(key)
+        if key in self.objects:
+            self.objects.move_to_end(key)
+            return self.objects[key][1]
+        self._drop_stale(key)
+        room = self.budget - self._shown_bytes()
+        if key in self.spilled:
+            _, path = self.spilled.pop(key)
+            obj = pd.read_parquet(path)
+            os.remove(path)
+        elif preview and estimate > room:
+            obj = preview()
+            self.previews.add(key)
+        else:
+            obj = load()
+        size = object_bytes(obj)
+        if preview and key not in self.previews and size > room:
+            del obj
+            obj = preview()
+            size = object_bytes(obj)
+            self.previews.add(key)
+        self.objects[key] = (kind, obj, size)
+        self.enforce()
+        return obj
+
+    def is_preview(self, key: tuple) -> bool:
+        return key in self.previews
+
+    def track_uploads(self, files: List) -> None:
+        # held by Streamlit until the uploader is cleared, so never evicted here
+        self.upload_bytes = sum(f.size for f in files if f is not None)
+        self.enforce()
+
+    def held_bytes(self) -> int:
+        return self.upload_bytes + sum(size for _, _, size in self.objects.values())
+
+    def enforce(self) -> None:
+        total = self.held_bytes()
+        for key in list(self.objects):
+            if total <= self.budget:
+                break
+            if key in self.shown:
+                continue
+            kind, obj, size = self.objects.pop(key)
+            if isinstance(obj, pd.DataFrame):
+                os.makedirs(self.spill_dir, exist_ok=True)
+                path = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}.parquet")
+                obj.to_parquet(path)
+                self.spilled[key] = (kind, path)
+            total -= size
+
+    def usage(self) -> Dict[str, int]:
+        """Bytes in memory per kind, and bytes spilled to disk."""
+        usage = dict.fromkeys(KINDS, 0)
+        usage["uploads"] = self.upload_bytes
+        for kind, _, size in self.objects.values():
+            usage[kind] = usage.get(kind, 0) + size
+        usage["spilled"] = sum(
+            os.path.getsize(path)
+            for _, path in self.spilled.values()
+            if os.path.exists(path)
+        )
+        return usage
@@ -0,0 +1,150 @@
+import os
+import uuid
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import pyarrow.dataset as ds
+
+from sage_web_apps.coalesce import SCORE_COLUMNS
+from sage_web_apps.exports import BATCH_SIZE
+from sage_web_apps.incremental import CohortTable, open_psms
+from sage_web_apps.jobs import Job
+from sage_web_apps.quant import find_table
+
+# bins per axis, the browser only ever gets this many values per plot
+BINS = 100
+
+# PSMs in the ppm, RT and per-file plots
+FDR_THRESHOLD = 0.01
+
+
+def _batches(
+    dataset: Union[ds.Dataset, CohortTable], columns: List[str]
+) -> Iterator[Dict[str, np.ndarray]]:
+    for batch in dataset.to_batches(columns=columns, batch_size=BATCH_SIZE):
+        yield {
+            name: batch.column(i).to_numpy(zero_copy_only=False)
+            for i, name in enumerate(columns)
+        }
+
+
+def _update_range(ranges: Dict[str, List[float]], name: str, values: np.ndarray):
+    values = values[np.isfinite(values)]
+    if len(values):
+        low, high = ranges.setdefault(name, [np.inf, -np.inf])
+        ranges[name] = [min(low, values.min()), max(high, values.max())]
+
+
+def _edges(ranges: Dict[str, List[float]], name: str) -> np.ndarray:
+    low, high = ranges.get(name, [0.0, 1.0])
+    if low == high:
+        high = low + 1
+    return np.linspace(low, high, BINS + 1)
+
+
+def compute_bins(dataset: Union[ds.Dataset, CohortTable]) -> Dict[str, np.ndarray]:
+    """
+    Histograms of a Sage PSM table: score (targets and decoys), precursor ppm
+    error, RT vs predicted RT and IDs per file, the last three for target
+    PSMs at FDR_THRESHOLD. Two streaming passes over the needed columns, one
+    for the value ranges and one for the (vectorized) histograms, so memory
+    does not grow with the table.
+    """
+    names = dataset.schema.names
+    score = next(c for c in SCORE_COLUMNS if c in names)
+    # Sage's predicted RT is on the scale of the aligned RT
+    rt = "aligned_rt" if "aligned_rt" in names else "rt"
+    has_rt = "predicted_rt" in names and rt in names
+    columns = [score, "label", "spectrum_q", "precursor_ppm", "filename"]
+    if has_rt:
+        columns += [rt, "predicted_rt"]
+
+    ranges: Dict[str, List[float]] = {}
+    file_ids: Dict[str, int] = {}
+    for batch in _batches(dataset, columns):
+        passing = (batch["label"] == 1) & (batch["spectrum_q"] <= FDR_THRESHOLD)
+        _update_range(ranges, "score", batch[score].astype(float))
+        _update_range(ranges, "ppm", batch["precursor_ppm"][passing].astype(float))
+        if has_rt:
+            _update_range(ranges, "rt", batch[rt][passing].astype(float))
+            predicted = batch["predicted_rt"][passing].astype(float)
+            _update_range(ranges, "predicted_rt", predicted)
+        files, counts = np.unique(
+            batch["filename"][passing].astype(str), return_counts=True
+        )
+        for file, count in zip(files, counts):
+            file_ids[file] = file_ids.get(file, 0) + int(count)
+
+    bins = {
+        "score_edges": _edges(ranges, "score"),
+        "ppm_edges": _edges(ranges, "ppm"),
+        "rt_edges": _edges(ranges, "rt"),
+        "predicted_rt_edges": _edges(ranges, "predicted_rt"),
+    }
+    score_targets = np.zeros(BINS, dtype=np.int64)
+    score_decoys = np.zeros(BINS, dtype=np.int64)
+    ppm = np.zeros(BINS, dtype=np.int64)
+    rt_grid = np.zeros((BINS, BINS), dtype=np.int64)
+    for batch in _batches(dataset, columns):
+        decoy = batch["label"] == -1
+        passing = ~decoy & (batch["spectrum_q"] <= FDR_THRESHOLD)
+        scores = batch[score].astype(float)
+        score_targets += np.histogram(scores[~decoy], bins["score_edges"])[0]
+        score_decoys += np.histogram(scores[decoy], bins["score_edges"])[0]
+        ppm += np.histogram(batch["precursor_ppm"][passing], bins["ppm_edges"])[0]
+        if has_rt:
+            rt_grid += np.histogram2d(
+                batch[rt][passing].astype(float),
+                batch["predicted_rt"][passing].astype(float),
+                [bins["rt_edges"], bins["predicted_rt_edges"]],
+            )[0].astype(np.int64)
+
+    files = sorted(file_ids)
+    # Sage writes predicted_rt = 0 without predict_rt
+    has_rt = has_rt and ranges.get("predicted_rt", [0, 0])[1] > 0
+    bins.update(
+        score_targets=score_targets,
+        score_decoys=score_decoys,
+        ppm_counts=ppm,
+        rt_counts=rt_grid if has_rt else np.zeros((0, 0), dtype=np.int64),
+        rt_column=np.array([rt]),
+        score_column=np.array([score]),
+        files=np.array(files, dtype=str),
+        file_ids=np.array([file_ids[f] for f in files], dtype=np.int64),
+    )
+    return bins
+
+
+def cached_bins(
+    cache_path: str, source: str, compute: Callable[[], Dict[str, np.ndarray]]
+) -> Dict[str, np.ndarray]:
+    """compute(), cached as .npz until source changes."""
+    if os.path.exists(cache_path) and (
+        os.path.getmtime(cache_path) >= os.path.getmtime(source)
+    ):
+        with np.load(cache_path) as cached:
+            return dict(cached)
+
+    bins = compute()
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # written then renamed, concurrent sessions never read a partial file
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **bins)
+    os.replace(tmp_path, cache_path)
+    return bins
+
+
+def plot_bins(job: Job) -> Optional[Dict[str, np.ndarray]]:
+    """
+    The binned plots of a finished job, None without a PSM table. Cached as
+    .npz in the job's workspace, so every table is only scanned once.
+    """
+    source = find_table(job.output_path, "results.sage")
+    if source is None:
+        return None
+    cache_path = os.path.join(
+        job.workspace, "plots", f"results_q{FDR_THRESHOLD:g}.npz"
+    )
+    # the tables of extended jobs do not change, only the job's own is checked
+    return cached_bins(cache_path, source, lambda: compute_bins(open_psms(job)))
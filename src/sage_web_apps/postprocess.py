@@ -0,0 +1,82 @@
+import os
+import uuid
+from typing import Dict
+
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from sage_web_apps.exports import converted_path, export_table, table_paths
+from sage_web_apps.incremental import open_psms
+from sage_web_apps.jobs import Job, zip_output
+from sage_web_apps.mass_shifts import mass_shifts
+from sage_web_apps.plots import FDR_THRESHOLD, plot_bins
+
+# threads per worker that process finished searches while the next ones run
+POSTPROCESS_WORKERS = int(os.getenv("SAGE_POSTPROCESS_WORKERS", "2"))
+
+
+def convert_tables(job: Job) -> None:
+    """
+    Parquet copies of the TSV outputs. Exports, plots, quant and SQL queries
+    then read only the columns they need instead of parsing the whole TSV.
+    """
+    for path in table_paths(job.output_path):
+        if not path.endswith(".tsv"):
+            continue
+        dest = converted_path(path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = f"{dest[: -len('.parquet')]}.{uuid.uuid4().hex}.tmp.parquet"
+        export_table(path, tmp_path)
+        os.replace(tmp_path, dest)
+
+
+def summarize(job: Job) -> Dict[str, int]:
+    """Target PSMs, peptides and proteins at FDR_THRESHOLD, over all files."""
+    dataset = open_psms(job)
+    if dataset is None:
+        return {}
+    names = dataset.schema.names
+    targets = ds.field("label") == 1
+
+    summary = {}
+    for key, column, q_column in (
+        ("psms", "psm_id", "spectrum_q"),
+        ("peptides", "peptide", "peptide_q"),
+        ("proteins", "proteins", "protein_q"),
+    ):
+        if column not in names or q_column not in names:
+            continue
+        table = dataset.to_table(
+            columns=[column], filter=targets & (ds.field(q_column) <= FDR_THRESHOLD)
+        )
+        summary[key] = pc.count_distinct(table.column(0)).as_py()
+    return summary
+
+
+def _summarize(job: Job) -> None:
+    job.summary = summarize(job)
+
+
+# the download first, it is what most users wait for; the last two warm the
+# plot caches (plots.py, mass_shifts.py)
+STEPS = [
+    ("archive", zip_output),
+    ("parquet copies", convert_tables),
+    ("summary", _summarize),
+    ("plots", plot_bins),
+    ("mass shifts", mass_shifts),
+]
+
+
+def postprocess(job: Job) -> None:
+    """
+    Everything a completed job's results page needs, built once, off the
+    search slot. Sage's outputs are valid whatever fails here, so a failed
+    step is recorded in job.postprocess_errors and the others still run.
+    """
+    job.postprocess_errors = {}
+    for name, step in STEPS:
+        try:
+            step(job)
+        except Exception as e:
+            job.postprocess_errors[name] = f"{type(e).__name__}: {e}"
@@ -0,0 +1,81 @@
+"""
+Preview searches: Sage with the search's own config on a sample spread over
+each chosen mzML file, to check tolerances, modifications and enzyme in a
+minute or two before committing hours of CPU to the full search. Previews
+are queued and run by a worker like searches (tasks.py).
+"""
+
+import json
+import os
+import subprocess
+from typing import Dict, List
+
+import numpy as np
+
+from sage_web_apps.plots import BINS, FDR_THRESHOLD
+from sage_web_apps.quant import find_table, read_table
+
+# MS2 spectra searched by a preview, over all files
+PREVIEW_SPECTRA = int(os.getenv("SAGE_PREVIEW_SPECTRA", "5000"))
+
+# wall-clock limit of a preview search, in seconds
+PREVIEW_TIMEOUT = float(os.getenv("SAGE_PREVIEW_TIMEOUT", "300"))
+
+
+def run_preview(
+    sage_path: str, config: dict, fasta_path: str, mzml_paths: List[str], workdir: str
+) -> str:
+    """Search the sampled mzML files, returns Sage's output directory."""
+    config_path = os.path.join(workdir, "preview.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+    output_path = os.path.join(workdir, "output")
+    proc = subprocess.run(
+        [
+            sage_path,
+            config_path,
+            *mzml_paths,
+            "--fasta",
+            fasta_path,
+            "--output_directory",
+            output_path,
+        ],
+        capture_output=True,
+        text=True,
+        timeout=PREVIEW_TIMEOUT,
+    )
+    if proc.returncode:
+        raise RuntimeError(f"Preview search failed: {proc.stderr[-1000:]}")
+    return output_path
+
+
+def preview_summary(output_path: str, sampled: int) -> Dict[str, object]:
+    """
+    ID rate at FDR_THRESHOLD, precursor ppm errors of the passing PSMs and
+    delta masses (experimental - calculated) of all target PSMs, which show
+    unexpected modifications and mass offsets. Plain lists and numbers, the
+    summary is stored as JSON.
+    """
+    path = find_table(output_path, "results.sage")
+    if path is None:
+        raise RuntimeError("The preview search wrote no PSMs")
+    psms = read_table(
+        path, ["rank", "label", "spectrum_q", "precursor_ppm", "expmass", "calcmass"]
+    )
+    # one PSM per spectrum, configs may report more
+    targets = psms[(psms["label"] == 1) & (psms["rank"] == 1)]
+    passing = targets[targets["spectrum_q"] <= FDR_THRESHOLD]
+    ppm_counts, ppm_edges = np.histogram(passing["precursor_ppm"], BINS)
+    delta_counts, delta_edges = np.histogram(
+        targets["expmass"] - targets["calcmass"], BINS
+    )
+    return {
+        "sampled": sampled,
+        "psms": len(passing),
+        "id_rate": len(passing) / sampled if sampled else 0.0,
+        "median_ppm": float(passing["precursor_ppm"].median()) if len(passing) else None,
+        "ppm_edges": ppm_edges.tolist(),
+        "ppm_counts": ppm_counts.tolist(),
+        "delta_edges": delta_edges.tolist(),
+        "delta_counts": delta_counts.tolist(),
+    }
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import streamlit as st
+
+from sage_web_apps.profiling import profile_rerun
+
+# `streamlit run profiled_app.py -- <app script>` runs one app as the only page,
+# so each of its reruns is profiled as a whole (run.py --profile)
+app_path = sys.argv[1]
+
+with profile_rerun(os.path.splitext(os.path.basename(app_path))[0]):
+    st.navigation([st.Page(app_path)], position="hidden").run()
@@ -0,0 +1,234 @@
+"""
+Opt-in profiling of Streamlit reruns (`--profile DIR` in run.py, or
+SAGE_PROFILE_DIR).
+
+Every rerun (and fragment rerun) is timed as a whole and per named section,
+while a background thread samples the rerun's call stack. Each rerun is
+written to DIR as <time>-<app>.json (timings) and .folded (sampled stacks,
+for flamegraph tools), and summary.json keeps the slowest sections and the
+hottest app lines over the last reruns.
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict, deque
+from contextlib import ContextDecorator
+from typing import Deque, Dict, List, Tuple
+
+PROFILE_DIR = os.getenv("SAGE_PROFILE_DIR")
+
+# how often the running reruns' stacks are sampled
+SAMPLE_INTERVAL = float(os.getenv("SAGE_PROFILE_INTERVAL_MS", "5")) / 1000
+
+# per-rerun profiles kept on disk, oldest are deleted
+KEEP_PROFILES = int(os.getenv("SAGE_PROFILE_KEEP", "500"))
+
+# reruns per section the summary statistics are computed over
+SUMMARY_WINDOW = 200
+
+SUMMARY_FILE = "summary.json"
+
+# source files of the apps, for the summary's hottest lines
+APP_FILES = {f for f in os.listdir(os.path.dirname(__file__)) if f.endswith(".py")}
+
+_local = threading.local()
+_lock = threading.Lock()
+# thread id -> profile of the rerun running in it
+_active: Dict[int, "RerunProfile"] = {}
+_durations: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=SUMMARY_WINDOW))
+_hot_lines: Counter = Counter()
+_sampler = None
+
+
+class RerunProfile:
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        # open sections, (name, start)
+        self.stack: List[Tuple[str, float]] = []
+        self.sections: List[dict] = []
+        # ';'-joined stack, outermost first -> samples
+        self.samples: Counter = Counter()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _sample_forever() -> None:
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        frames = sys._current_frames()
+        with _lock:
+            for thread_id, profile in _active.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if stack:
+                    profile.samples[";".join(reversed(stack))] += 1
+
+
+def _start_sampler() -> None:
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample_forever, daemon=True)
+            _sampler.start()
+
+
+def _open_section(profile: RerunProfile, name: str) -> None:
+    profile.stack.append((name, time.perf_counter()))
+
+
+def _close_section(profile: RerunProfile) -> None:
+    name, start = profile.stack.pop()
+    profile.sections.append(
+        {
+            "name": "/".join([open_name for open_name, _ in profile.stack] + [name]),
+            "offset": round(start - profile.start, 6),
+            "seconds": round(time.perf_counter() - start, 6),
+        }
+    )
+
+
+class profile_section(ContextDecorator):
+    """Time a named part of a rerun, as `with` block or decorator."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        profile = getattr(_local, "profile", None)
+        if profile is not None:
+            _open_section(profile, self.name)
+        return self
+
+    def __exit__(self, *exc):
+        profile = getattr(_local, "profile", None)
+        if profile is not None and profile.stack:
+            _close_section(profile)
+        return False
+
+
+class profile_rerun(ContextDecorator):
+    """Profile a whole rerun. Nested in another rerun it is timed as a section."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        if not PROFILE_DIR:
+            return self
+        profile = getattr(_local, "profile", None)
+        if profile is not None:
+            _open_section(profile, self.name)
+            return self
+        _start_sampler()
+        _local.profile = RerunProfile(self.name)
+        with _lock:
+            _active[threading.get_ident()] = _local.profile
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        profile = getattr(_local, "profile", None)
+        if profile is None:
+            return False
+        if profile.stack:
+            _close_section(profile)
+            return False
+        with _lock:
+            _active.pop(threading.get_ident(), None)
+        _local.profile = None
+        # st.stop() and st.rerun() end reruns with an exception too
+        _finish(profile, exc_type.__name__ if exc_type else "ok")
+        return False
+
+
+def _finish(profile: RerunProfile, outcome: str) -> None:
+    seconds = time.perf_counter() - profile.start
+    with _lock:
+        _durations[profile.name].append(seconds)
+        for section in profile.sections:
+            _durations[f"{profile.name}/{section['name']}"].append(section["seconds"])
+        for stack, count in profile.samples.items():
+            # innermost frame in the apps' own code
+            for label in reversed(stack.split(";")):
+                if label.rsplit("(", 1)[-1].split(":")[0] in APP_FILES:
+                    _hot_lines[label] += count
+                    break
+        summary = _summary()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"\W+", "_", profile.name)
+    now = time.time()
+    # sortable by time, for pruning
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    stamp += f".{int(now * 1000) % 1000:03d}"
+    stem = f"{stamp}-{name}-{uuid.uuid4().hex[:6]}"
+    record = {
+        "app": profile.name,
+        "started_at": profile.started_at,
+        "seconds": round(seconds, 6),
+        "outcome": outcome,
+        "samples": sum(profile.samples.values()),
+        "sections": profile.sections,
+    }
+    with open(os.path.join(PROFILE_DIR, stem + ".json"), "w") as f:
+        json.dump(record, f, indent=2)
+    with open(os.path.join(PROFILE_DIR, stem + ".folded"), "w") as f:
+        for stack, count in profile.samples.most_common():
+            f.write(f"{stack} {count}\n")
+    _write_summary(summary)
+    _prune()
+
+
+def _summary() -> dict:
+    slowest = []
+    for name, values in _durations.items():
+        values = sorted(values)
+        slowest.append(
+            {
+                "name": name,
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                "p95": values[int(0.95 * (len(values) - 1))],
+                "max": values[-1],
+            }
+        )
+    slowest.sort(key=lambda entry: entry["p95"], reverse=True)
+    return {
+        "updated_at": time.time(),
+        "window": SUMMARY_WINDOW,
+        "slowest": slowest,
+        "hot_lines": _hot_lines.most_common(30),
+    }
+
+
+def _write_summary(summary: dict) -> None:
+    path = os.path.join(PROFILE_DIR, SUMMARY_FILE)
+    # several sessions finish reruns at once, each writes a complete file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _prune() -> None:
+    profiles = sorted(
+        f for f in os.listdir(PROFILE_DIR) if f.endswith(".json") and f != SUMMARY_FILE
+    )
+    for file in profiles[: max(0, len(profiles) - KEEP_PROFILES)]:
+        for path in (file, file[: -len(".json")] + ".folded"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, path))
+            except OSError:
+                pass
@@ -0,0 +1,127 @@
+import os
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+from sage_web_apps.exports import table_source
+from sage_web_apps.jobs import Job
+
+# non-intensity columns of Sage's lfq.tsv
+LFQ_ID_COLUMNS = ["peptide", "charge", "proteins", "q_value", "score", "spectral_angle"]
+
+# reporter intensity columns of Sage's tmt.tsv (tmt_126, ...), the others are
+# ids and scan metadata such as ion_injection_time
+TMT_CHANNEL_PREFIX = "tmt_"
+
+LEVELS = ["peptide", "protein"]
+
+
+def find_table(output_path: str, name: str) -> Optional[str]:
+    for ext in (".tsv", ".parquet"):
+        path = os.path.join(output_path, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_table(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    path = table_source(path)
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, sep="\t", usecols=columns)
+
+
+def quant_type(job: Job) -> Optional[str]:
+    if find_table(job.output_path, "lfq"):
+        return "lfq"
+    if find_table(job.output_path, "tmt"):
+        return "tmt"
+    return None
+
+
+def lfq_matrix(output_path: str, level: str, max_q: float) -> pd.DataFrame:
+    """Peptide or protein x file intensities from Sage's precursor level lfq table."""
+    lfq = read_table(find_table(output_path, "lfq"))
+    samples = [c for c in lfq.columns if c not in LFQ_ID_COLUMNS]
+    lfq = lfq[lfq["q_value"] <= max_q]
+    # summed over charge states (and peptides for proteins)
+    key = "peptide" if level == "peptide" else "proteins"
+    return lfq.groupby(key, sort=True)[samples].sum(min_count=1)
+
+
+def tmt_matrix(output_path: str, level: str, max_q: float) -> pd.DataFrame:
+    """
+    Peptide or protein x (file, channel) reporter intensities. tmt.tsv is per
+    spectrum, so it is joined to the target PSMs passing max_q.
+    """
+    tmt = read_table(find_table(output_path, "tmt"))
+    channels = [c for c in tmt.columns if c.startswith(TMT_CHANNEL_PREFIX)]
+
+    psms = read_table(
+        find_table(output_path, "results.sage"),
+        ["filename", "scannr", "peptide", "proteins", "label", "rank", "spectrum_q"],
+    )
+    psms = psms[(psms["label"] == 1) & (psms["rank"] == 1) & (psms["spectrum_q"] <= max_q)]
+
+    key = "peptide" if level == "peptide" else "proteins"
+    merged = tmt.merge(psms[["filename", "scannr", key]], on=["filename", "scannr"])
+    matrix = merged.groupby([key, "filename"], sort=True)[channels].sum(min_count=1)
+    # one column per file and channel
+    matrix = matrix.unstack("filename")
+    matrix.columns = [f"{file}:{channel}" for channel, file in matrix.columns]
+    return matrix[sorted(matrix.columns)]
+
+
+def median_normalize(matrix: pd.DataFrame) -> pd.DataFrame:
+    """Scale every sample to the same median intensity (missing values ignored)."""
+    medians = matrix.median()
+    return matrix / medians * medians.median()
+
+
+def missing_values(matrix: pd.DataFrame) -> pd.DataFrame:
+    """Quantified and missing (0 or empty) values per sample."""
+    missing = matrix.isna().sum()
+    return pd.DataFrame(
+        {
+            "quantified": len(matrix) - missing,
+            "missing": missing,
+            "missing %": 100 * missing / max(1, len(matrix)),
+        }
+    )
+
+
+def quant_matrix(
+    job: Job, level: str, max_q: float, normalize: bool
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    The quant matrix of a finished job, and its missing value summary.
+
+    Both are cached as parquet in the job's workspace, so they are only
+    assembled once per job and setting.
+    """
+    kind = quant_type(job)
+    # v2: TMT matrices before it also summed non-reporter columns
+    cache_dir = os.path.join(job.workspace, "quant_v2")
+    name = f"{kind}_{level}_q{max_q:g}{'_norm' if normalize else ''}"
+    matrix_path = os.path.join(cache_dir, f"{name}.parquet")
+    missing_path = os.path.join(cache_dir, f"{name}_missing.parquet")
+
+    source = find_table(job.output_path, kind)
+    if os.path.exists(missing_path) and os.path.getmtime(missing_path) >= os.path.getmtime(source):
+        return pd.read_parquet(matrix_path), pd.read_parquet(missing_path)
+
+    if kind == "lfq":
+        matrix = lfq_matrix(job.output_path, level, max_q)
+    else:
+        matrix = tmt_matrix(job.output_path, level, max_q)
+    # Sage reports unquantified values as 0
+    matrix = matrix.mask(matrix <= 0)
+    if normalize:
+        matrix = median_normalize(matrix)
+    missing = missing_values(matrix)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    matrix.to_parquet(matrix_path)
+    # written last, marks the cache entry as complete
+    missing.to_parquet(missing_path)
+    return matrix, missing
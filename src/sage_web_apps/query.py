@@ -0,0 +1,125 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from sage_web_apps.exports import table_paths, table_source
+from sage_web_apps.incremental import earlier_tables
+from sage_web_apps.jobs import Job
+
+try:
+    import duckdb
+except ImportError:  # optional, pip install sage-web-app[query]
+    duckdb = None
+
+# bounds of a query session, larger intermediates spill to temp_directory
+MEMORY_LIMIT = os.getenv("SAGE_QUERY_MEMORY_LIMIT", "2GB")
+THREADS = int(os.getenv("SAGE_QUERY_THREADS", "4"))
+
+
+def _identifier(text: str) -> str:
+    return re.sub(r"\W+", "_", text).strip("_").lower()
+
+
+def _literal(text: str) -> str:
+    return "'" + text.replace("'", "''") + "'"
+
+
+# output table, the tables of the jobs it extends and their q-values (or None)
+TableSources = Tuple[str, Tuple[str, ...], Optional[str]]
+
+
+def job_tables(jobs: List[Job]) -> Dict[str, TableSources]:
+    """
+    View name -> the table's sources, e.g. 'my_search_3fa2c1_results'. The
+    PSM and fragment views of incremental searches cover the extended jobs.
+    """
+    tables = {}
+    for job in jobs:
+        for path in table_paths(job.output_path):
+            stem = os.path.basename(path).split(".")[0]
+            name = f"{_identifier(job.name)}_{job.job_id[:6]}_{_identifier(stem)}"
+            earlier, q_path = earlier_tables(job, path)
+            tables[name] = (
+                table_source(path),
+                tuple(table_source(p) for p in earlier),
+                q_path,
+            )
+    return tables
+
+
+def _scan(path: str) -> str:
+    if path.endswith(".parquet"):
+        return f"read_parquet({_literal(path)})"
+    return f"read_csv({_literal(path)}, delim = '\t', header = true)"
+
+
+def _view(path: str, earlier: Tuple[str, ...], q_path: Optional[str]) -> str:
+    view = f"SELECT * FROM {_scan(path)}"
+    if q_path:
+        # the earlier PSMs with this job's q-values (incremental.py)
+        replace = ", ".join(
+            f'q."{c}" AS "{c}"' for c in pq.read_schema(q_path).names if c != "psm_id"
+        )
+        for other in earlier:
+            view += (
+                f" UNION ALL BY NAME SELECT t.* REPLACE ({replace}) FROM {_scan(other)}"
+                f" AS t JOIN {_scan(q_path)} AS q ON t.psm_id = q.psm_id"
+            )
+    else:
+        for other in earlier:
+            view += f" UNION ALL BY NAME SELECT * FROM {_scan(other)}"
+    return view
+
+
+def connect(tables: Dict[str, TableSources], temp_directory: str):
+    """
+    In-memory DuckDB with one lazily scanned view per table. Afterwards only
+    the tables themselves can be opened and the configuration is locked, so
+    queries cannot read other files or lift the memory limit.
+    """
+    os.makedirs(temp_directory, exist_ok=True)
+    con = duckdb.connect()
+    con.execute(f"SET memory_limit = '{MEMORY_LIMIT}'")
+    con.execute(f"SET threads = {THREADS}")
+    con.execute(f"SET temp_directory = {_literal(temp_directory)}")
+
+    for name, sources in tables.items():
+        con.execute(f'CREATE VIEW "{name}" AS {_view(*sources)}')
+
+    # the files, not their folders: no new file can be created next to them
+    paths = set()
+    for path, earlier, q_path in tables.values():
+        paths.update(p for p in (path, *earlier, q_path) if p)
+    con.execute(f"SET allowed_paths = [{', '.join(map(_literal, sorted(paths)))}]")
+    con.execute("SET enable_external_access = false")
+    con.execute("SET lock_configuration = true")
+    return con
+
+
+def run_query(
+    tables: Dict[str, TableSources],
+    sql: str,
+    page: int,
+    page_size: int,
+    temp_directory: str,
+) -> Tuple[pd.DataFrame, int]:
+    """
+    One page of a query's result, and the total row count. Only a single
+    SELECT (or WITH) statement is run, anything else raises ValueError.
+    """
+    statements = duckdb.extract_statements(sql)
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        raise ValueError("Only a single SELECT query can be run")
+    sql = statements[0].query.strip().rstrip(";")
+    con = connect(tables, temp_directory)
+    try:
+        total = con.execute(f"SELECT count(*) FROM ({sql})").fetchone()[0]
+        df = con.execute(
+            f"SELECT * FROM ({sql}) LIMIT {int(page_size)} OFFSET {int(page) * int(page_size)}"
+        ).df()
+    finally:
+        con.close()
+    return df, total
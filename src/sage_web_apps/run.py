@@ -14,6 +14,17 @@ def run_streamlit_app(module_path):
     
     # Run streamlit command
     cmd = [sys.executable, "-m", "streamlit", "run", module_path]
+    if os.getenv("SAGE_PROFILE_DIR") and not module_path.endswith("sage_web_app.py"):
+        # wrapped so whole reruns are profiled (sage_web_app.py does it itself)
+        cmd = [
+            sys.executable,
+            "-m",
+            "streamlit",
+            "run",
+            os.path.join(current_dir, "profiled_app.py"),
+            "--",
+            module_path,
+        ]
     subprocess.run(cmd)
 
 def run_input_app():
@@ -26,6 +37,11 @@ def run_input_app():
         action="store_true",
         help="Run the app in server mode (default: False)",
     )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Profile every rerun and write the profiles to DIR",
+    )
 
     args = parser.parse_args()
     if args.server:
@@ -34,6 +50,9 @@ def run_input_app():
         # set env local to true if not set (running cli command)
         os.environ["LOCAL"] = "True"
 
+    if args.profile:
+        os.environ["SAGE_PROFILE_DIR"] = os.path.abspath(args.profile)
+
     """Run the sage_input_app.py streamlit application."""
     app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sage_input_app.py")
     run_streamlit_app(app_path)
@@ -46,6 +65,17 @@ def run_sage_app():
         action="store_true",
         help="Run the app in server mode (default: False)",
     )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Profile every rerun and write the profiles to DIR",
+    )
+    parser.add_argument(
+        "--data-root",
+        action="append",
+        default=[],
+        help="Server-side folder users may browse for input files (can be repeated)",
+    )
 
     args = parser.parse_args()
     if args.server:
@@ -54,11 +84,60 @@ def run_sage_app():
         # set env local to true if not set (running cli command)
         os.environ["LOCAL"] = "True"
 
+    if args.profile:
+        os.environ["SAGE_PROFILE_DIR"] = os.path.abspath(args.profile)
+
+    if args.data_root:
+        os.environ["SAGE_DATA_ROOTS"] = os.pathsep.join(
+            os.path.abspath(root) for root in args.data_root
+        )
+
     """Run the sage_app.py streamlit application."""
     app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sage_app.py")
     run_streamlit_app(app_path)
 
+def run_web_app():
+
+    parser = argparse.ArgumentParser(
+        description="Run the config generator and the Sage app as pages of one server."
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="Run the app in server mode (default: False)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Profile every rerun and write the profiles to DIR",
+    )
+    parser.add_argument(
+        "--data-root",
+        action="append",
+        default=[],
+        help="Server-side folder users may browse for input files (can be repeated)",
+    )
+
+    args = parser.parse_args()
+    if args.server:
+        os.environ["LOCAL"] = "False"
+    else:
+        # set env local to true if not set (running cli command)
+        os.environ["LOCAL"] = "True"
+
+    if args.profile:
+        os.environ["SAGE_PROFILE_DIR"] = os.path.abspath(args.profile)
+
+    if args.data_root:
+        os.environ["SAGE_DATA_ROOTS"] = os.pathsep.join(
+            os.path.abspath(root) for root in args.data_root
+        )
+
+    """Run both apps in one streamlit process (sage_web_app.py)."""
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sage_web_app.py")
+    run_streamlit_app(app_path)
+
 if __name__ == "__main__":
     # If script is run directly, show help
     print("This module provides functions to run Sage Streamlit apps.")
-    print("Use 'sage-app' or 'sage-input-app' CLI commands to run the apps.")
+    print("Use 'sage-app', 'sage-config' or 'sage-web' CLI commands to run the apps.")
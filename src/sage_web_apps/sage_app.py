@@ -1,14 +1,69 @@
 import streamlit as st
 import platform
+import io
+import json
 import requests
 import tarfile
 import os
 import subprocess
 import tempfile
 import shutil
-import zipfile
+import time
+import uuid
+import numpy as np
 import pandas as pd
 
+from sage_web_apps.data_browser import (
+    FASTA_EXTENSIONS,
+    MZML_EXTENSIONS,
+    get_data_roots,
+    list_data_dir,
+    resolve_data_path,
+)
+from sage_web_apps.coalesce import command_flags
+from sage_web_apps.exports import (
+    Q_VALUE_COLUMNS,
+    distinct_values,
+    export_table,
+    open_table,
+    table_paths,
+    table_source,
+)
+from sage_web_apps.incremental import can_extend, open_output, searched_files
+from sage_web_apps.jobs import (
+    CANCELLED,
+    COMPLETED,
+    PENDING,
+    PREVIEW,
+    SEARCH,
+    TIMED_OUT,
+    TUNING,
+    Job,
+    QuotaError,
+    Quotas,
+    Scheduler,
+    download_name,
+    log_tail,
+)
+from sage_web_apps.mass_shifts import bin_masses, mass_shifts, pick_peaks
+from sage_web_apps.memory import SessionMemory
+from sage_web_apps.plots import FDR_THRESHOLD, plot_bins
+from sage_web_apps.preview import PREVIEW_SPECTRA
+from sage_web_apps.profiling import profile_rerun, profile_section
+from sage_web_apps.quant import LEVELS, quant_matrix, quant_type
+from sage_web_apps.query import duckdb, job_tables, run_query
+from sage_web_apps.tasks import read_result, sample_uploads, task_command, write_task
+from sage_web_apps.tuning import TRIAL_SPECTRA, cached_recommendation, fingerprint
+from sage_web_apps.users import get_user_id
+from sage_web_apps.validation import ValidationError, copy_validated, validate_path
+from sage_web_apps.worker import Worker
+
+# if not set (running from community cloud = server mode)
+is_local = os.getenv("LOCAL", "False") == "True"
+
+# job workspaces (uploads and results) live here
+jobs_root = os.path.abspath(os.getenv("SAGE_WORKSPACE_DIR", "sage_jobs"))
+
 
 # Fill out params, save as json
 # upload mzml.gz.tar(s) and fasta
@@ -85,6 +140,10 @@ def download_sage(arch):
 
 @st.cache_resource
 def load_sage(arch):
+    # use an existing Sage install (or a stand-in for load tests) if given
+    if os.getenv("SAGE_EXECUTABLE"):
+        return os.getenv("SAGE_EXECUTABLE")
+
     # Check if sage directory exists
     if not os.path.exists("sage"):
         download_sage(arch)
@@ -97,7 +156,109 @@ def load_sage(arch):
 
 sage_path = load_sage(arch)
 
-with st.sidebar:
+
+def _open_data_folder(folder_key, subdir_key):
+    if st.session_state[subdir_key]:
+        st.session_state[folder_key] = st.session_state[subdir_key]
+    st.session_state[subdir_key] = None
+
+
+def _parent_data_folder(folder_key):
+    st.session_state[folder_key] = os.path.dirname(st.session_state[folder_key]) or "."
+
+
+def data_browser(label, key, extensions, multiple):
+    """
+    Browse the allow-listed server data roots and pick files by path.
+
+    Returns absolute paths, nothing is copied or uploaded.
+    """
+    root = st.selectbox(f"{label} data root", data_roots, key=f"{key}_root")
+    folder_key = f"{key}_folder_{root}"
+    subdir_key = f"{key}_subdir"
+    if folder_key not in st.session_state:
+        st.session_state[folder_key] = "."
+
+    try:
+        dirs, files = list_data_dir(root, st.session_state[folder_key], extensions)
+    except (ValueError, OSError) as e:
+        st.error(f"Cannot open folder: {str(e)}")
+        st.session_state[folder_key] = "."
+        return []
+
+    st.caption(os.path.normpath(os.path.join(root, st.session_state[folder_key])))
+    c1, c2 = st.columns([3, 1], vertical_alignment="bottom")
+    with c1:
+        st.selectbox(
+            "Open folder",
+            dirs,
+            index=None,
+            format_func=os.path.basename,
+            key=subdir_key,
+            on_change=_open_data_folder,
+            args=(folder_key, subdir_key),
+        )
+    with c2:
+        st.button(
+            "Up",
+            key=f"{key}_up",
+            disabled=st.session_state[folder_key] == ".",
+            on_click=_parent_data_folder,
+            args=(folder_key,),
+            use_container_width=True,
+        )
+
+    if multiple:
+        selected = st.multiselect(
+            f"{label} files", files, format_func=os.path.basename, key=f"{key}_files"
+        )
+    else:
+        selected = st.selectbox(
+            f"{label} file",
+            files,
+            index=None,
+            format_func=os.path.basename,
+            key=f"{key}_files",
+        )
+        selected = [selected] if selected else []
+
+    return [resolve_data_path(root, f) for f in selected]
+
+
+@st.cache_resource
+def get_scheduler():
+    # one scheduler and in-process worker per server process, shared by every session
+    scheduler = Scheduler(Quotas.from_env(), jobs_root)
+    slots = int(os.getenv("SAGE_MAX_RUNNING_JOBS", "1"))
+    if slots > 0:
+        Worker(scheduler, slots).start()
+    return scheduler
+
+
+def get_session_memory():
+    # bytes held for this session, kept under SAGE_SESSION_MEMORY_MB
+    if "memory" not in st.session_state:
+        st.session_state["memory"] = SessionMemory()
+    st.session_state["memory"].begin_rerun()
+    return st.session_state["memory"]
+
+
+@st.cache_data(max_entries=4096)
+def is_extendable(_job, job_id, finished_at):
+    # finished jobs do not change, so each one's config is read once
+    return can_extend(_job, sage_path)
+
+
+data_roots = get_data_roots()
+scheduler = get_scheduler()
+user_id = get_user_id(is_local)
+memory = get_session_memory()
+
+# listed once per rerun, the panels below all use this snapshot
+all_jobs = scheduler.jobs
+user_jobs = scheduler.user_jobs(user_id, all_jobs.values())
+
+with st.sidebar, profile_section("sidebar"):
 
     # Replace the text outputs with more informative content
     st.title("Sage Proteomics Search Engine")
@@ -111,11 +272,93 @@ with st.sidebar:
     except Exception as e:
         st.error(f"Failed to get Sage version: {str(e)}")
 
-    fasta_file = st.file_uploader("Upload FASTA file", type=["fasta"])
-    mzml_files = st.file_uploader(
-        "Upload mzML files", type=["mzml", "mzml.gz"], accept_multiple_files=True
+    usage = scheduler.usage(user_id, user_jobs)
+    st.caption(
+        f"User: {user_id} | {usage['running']} running, {usage['pending']} queued | "
+        f"{usage['cpu_hours']:.2f} CPU-hours | "
+        f"{usage['workspace_bytes'] / 1024**3:.2f} GB workspace"
+    )
+    # filled in at the end of the run, once results are loaded
+    memory_status = st.empty()
+
+    # incremental search (incremental.py): new mzML files for a finished search,
+    # with its FASTA, config and options
+    extendable = [
+        job
+        for job in user_jobs
+        if job.status == COMPLETED and is_extendable(job, job.job_id, job.finished_at)
+    ]
+    parent_job = None
+    if extendable:
+        parent_job = st.selectbox(
+            "Add files to an earlier search",
+            extendable,
+            index=None,
+            format_func=lambda job: f"{job.name} ({job.job_id[:6]})",
+            placeholder="New search",
+            help="Search only the new mzML files with the earlier search's FASTA, "
+            "config and options, then recompute the FDR over all files",
+        )
+
+    input_source = "Upload"
+    if data_roots:
+        input_source = st.radio(
+            "Input source",
+            ["Upload", "Server data"],
+            horizontal=True,
+            help="Server data references files on the server by path, without uploading them",
+        )
+
+    fasta_file, mzml_files, json_file = None, [], None
+    fasta_server_paths, mzml_server_paths, json_server_paths = [], [], []
+    # new uploader keys after a submit, so Streamlit releases the uploaded bytes
+    upload_generation = st.session_state.setdefault("upload_generation", 0)
+    if input_source == "Upload":
+        if parent_job is None:
+            fasta_file = st.file_uploader(
+                "Upload FASTA file",
+                type=["fasta"],
+                key=f"fasta_upload_{upload_generation}",
+            )
+        mzml_files = st.file_uploader(
+            "Upload mzML files",
+            type=["mzml", "mzml.gz"],
+            accept_multiple_files=True,
+            key=f"mzml_upload_{upload_generation}",
+        )
+    else:
+        if parent_job is None:
+            fasta_server_paths = data_browser("FASTA", "fasta", FASTA_EXTENSIONS, False)
+        mzml_server_paths = data_browser("mzML", "mzml", MZML_EXTENSIONS, True)
+        if parent_job is None:
+            json_server_paths = data_browser("Config", "config", (".json",), False)
+
+    # handed over by the config builder page of the multipage app (sage_web_app.py)
+    generated_config = None
+    if not json_server_paths and parent_job is None:
+        if st.session_state.get("generated_config") and st.toggle(
+            "Use config from the config builder", value=True
+        ):
+            generated_config = st.session_state["generated_config"]
+        else:
+            json_file = st.file_uploader(
+                "Upload JSON file", type=["json"], key=f"json_upload_{upload_generation}"
+            )
+
+    memory.track_uploads([fasta_file, json_file, *mzml_files])
+
+    compress_mzml = input_source == "Upload" and st.checkbox(
+        "Compress mzML uploads",
+        value=os.getenv("SAGE_COMPRESS_MZML", "True") == "True",
+        help="Store uncompressed mzML uploads as .mzML.gz, Sage reads them directly",
+    )
+
+    preview_first = st.checkbox(
+        "Preview before the full search",
+        value=os.getenv("SAGE_PREVIEW_FIRST", "False") == "True",
+        help="Run searches a sample of every mzML file first and shows the ID rate "
+        "and mass errors, the full search starts after confirming",
     )
-    json_file = st.file_uploader("Upload JSON file", type=["json"])
 
     include_fragment_annotations = st.checkbox(
         "Include fragment annotations", value=True
@@ -123,105 +366,1036 @@ with st.sidebar:
     output_type = st.selectbox("Output type", ["csv", "parquet"])
     search_name = st.text_input("Search name", value="sage_search")
 
+    # in server mode the configured timeout is also the longest allowed
+    default_timeout = float(os.getenv("SAGE_JOB_TIMEOUT_HOURS", "0"))
+    timeout_hours = st.number_input(
+        "Timeout (hours)",
+        min_value=0.0,
+        max_value=default_timeout if default_timeout and not is_local else None,
+        value=default_timeout,
+        help="Stop the search if it runs longer than this (0 = no limit)",
+    )
+
+
+def selected_config():
+    # the config the search would run with, None until one is chosen
+    try:
+        if json_server_paths:
+            with open(json_server_paths[0]) as f:
+                return json.load(f)
+        if generated_config:
+            return json.loads(generated_config)
+        if json_file is not None:
+            return json.loads(json_file.getvalue())
+    except (OSError, ValueError) as e:
+        st.error(f"Cannot read the config: {e}")
+    return None
+
+
+def sampleable_inputs(config):
+    # Bruker .d folders cannot be sampled
+    mzml_paths = [path for path in mzml_server_paths if not os.path.isdir(path)]
+    return config is not None and (mzml_paths or mzml_files) and (
+        fasta_file or fasta_server_paths
+    )
+
+
+def sample_fasta(workdir):
+    """The chosen FASTA for a trial or preview search, and its SHA-256."""
+    if fasta_server_paths:
+        return fasta_server_paths[0], validate_path(fasta_server_paths[0])
+    fasta_path = os.path.join(workdir, fasta_file.name)
+    return fasta_path, copy_validated(fasta_file, fasta_path, fasta_file.name)
+
+
+def histogram_chart(edges, counts, x_title):
+    """A 1D histogram from precomputed bins ({series: counts})."""
+    data = pd.concat(
+        [
+            pd.DataFrame(
+                {"start": edges[:-1], "end": edges[1:], "count": values, "series": name}
+            )
+            for name, values in counts.items()
+        ]
+    )
+    st.vega_lite_chart(
+        data[data["count"] > 0],
+        {
+            "mark": {"type": "bar", "opacity": 0.7},
+            "encoding": {
+                "x": {"field": "start", "type": "quantitative", "title": x_title},
+                "x2": {"field": "end"},
+                "y": {"field": "count", "type": "quantitative", "stack": None},
+                "color": {"field": "series", "type": "nominal", "title": None},
+            },
+        },
+        use_container_width=True,
+    )
+
+
+def submit_task(
+    kind, workspace, fasta_path, config, spectra, spread=False, indexed=False, **fields
+):
+    """
+    Queue a tuning or preview job (tasks.py) on samples of the chosen mzML
+    files, the uploads are sampled here and server data by the worker.
+    """
+    server_paths = [path for path in mzml_server_paths if not os.path.isdir(path)]
+    task = sample_uploads(
+        [(f, f.name) for f in mzml_files],
+        len(server_paths),
+        workspace,
+        spectra,
+        spread,
+        indexed,
+    )
+    config_path = os.path.join(workspace, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+    job = Job(
+        job_id=os.path.basename(workspace),
+        owner=user_id,
+        name=f"{search_name} ({kind})",
+        workspace=workspace,
+        command=task_command(workspace),
+        output_path=os.path.join(workspace, "output"),
+        fasta_path=fasta_path,
+        mzml_paths=server_paths,
+        config_path=config_path,
+        kind=kind,
+    )
+    write_task(job, dict(task, sage_path=sage_path, **fields))
+    scheduler.submit(job)
+
+
+@st.fragment(run_every="2s")
+@profile_rerun("task_status")
+def task_status(job_id):
+    job = scheduler.get(job_id)
+    if job is None or job.finished:
+        # rerun the whole page to show the result
+        st.rerun()
+
+    if job.status == PENDING:
+        st.info(f"Queued, position {scheduler.queue_position(job_id)} in the queue")
+    else:
+        st.info(f"Running in a search slot... ({time.time() - job.started_at:.0f}s)")
+        st.code(log_tail(job, "stdout.txt"), language="text", height=150)
+    if st.button("Cancel", key=f"cancel_{job_id}", disabled=job.cancel_requested):
+        scheduler.cancel(job_id)
+        st.rerun(scope="fragment")
+
+
+def task_result(state_key, label):
+    """
+    The result of the job in st.session_state[state_key] once it finished,
+    its progress until then.
+    """
+    task = st.session_state.get(state_key)
+    if task is None:
+        return None
+    job = scheduler.get(task["job_id"])
+    if job is not None and not job.finished:
+        task_status(job.job_id)
+        return None
+
+    del st.session_state[state_key]
+    result = read_result(job) if job is not None and job.status == COMPLETED else None
+    if result is None and (job is None or job.status != CANCELLED):
+        error = job and (log_tail(job, "stderr.txt").strip() or job.error)
+        st.error(f"{label} failed: {error}")
+    return result
+
+
+@profile_section("tuning_panel")
+def tuning_panel():
+    """Trial searches on a sample of the chosen spectra, for bucket_size and threads."""
+    config = selected_config()
+    st.caption(
+        f"Searches about {TRIAL_SPECTRA} MS2 spectra of the chosen files with each "
+        "bucket size and a few thread counts, and recommends the setting that "
+        "finishes the full search first. Tuning is queued and runs in a search slot "
+        "like a search."
+    )
+    if not st.button(
+        "Tune",
+        disabled=not sampleable_inputs(config) or "tuning_job" in st.session_state,
+        key="tune",
+    ):
+        return
+
+    job_id = uuid.uuid4().hex
+    workspace = os.path.join(jobs_root, job_id)
+    os.makedirs(workspace)
+    try:
+        fasta_path, fasta_sha256 = sample_fasta(workspace)
+        key = fingerprint(sage_path, fasta_sha256, config)
+        result = cached_recommendation(jobs_root, key)
+        if result is None:
+            submit_task(
+                TUNING, workspace, fasta_path, config, TRIAL_SPECTRA, fingerprint=key
+            )
+            st.session_state["tuning_job"] = {"job_id": job_id}
+            return
+    except (ValidationError, QuotaError, OSError) as e:
+        st.error(f"Tuning failed: {e}")
+        result = None
+    shutil.rmtree(workspace, ignore_errors=True)
+    if result:
+        st.session_state["tuning"] = result
+
+
+def preview_key():
+    # a preview belongs to the inputs and config it searched
+    return json.dumps(
+        [
+            fasta_server_paths,
+            getattr(fasta_file, "file_id", None),
+            mzml_server_paths,
+            [f.file_id for f in mzml_files],
+            selected_config(),
+        ],
+        sort_keys=True,
+    )
+
+
+@profile_section("run_preview")
+def run_preview_search():
+    """Queue Sage on every Nth MS2 spectrum of each chosen file, with its config."""
+    config = selected_config()
+    if not sampleable_inputs(config):
+        st.error("Preview needs a FASTA file, mzML files (not .d folders) and a config")
+        return
+
+    job_id = uuid.uuid4().hex
+    workspace = os.path.join(jobs_root, job_id)
+    os.makedirs(workspace)
+    try:
+        fasta_path, _ = sample_fasta(workspace)
+        # spread over each file, so the whole gradient is represented
+        submit_task(
+            PREVIEW,
+            workspace,
+            fasta_path,
+            config,
+            PREVIEW_SPECTRA,
+            spread=True,
+            indexed=True,
+        )
+    except (ValidationError, QuotaError, OSError) as e:
+        shutil.rmtree(workspace, ignore_errors=True)
+        st.error(f"Preview failed: {e}")
+        return
+    st.session_state["preview_job"] = {"job_id": job_id, "key": preview_key()}
+    # follow it from the top of the run flow
+    st.rerun()
 
-if st.button("Run"):
-    if fasta_file is None:
+
+@profile_section("preview_results")
+def preview_results(summary):
+    st.subheader("Preview")
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Spectra searched", f"{summary['sampled']:,}")
+    c2.metric(f"PSMs at {FDR_THRESHOLD:.0%} FDR", f"{summary['psms']:,}")
+    c3.metric("ID rate", f"{summary['id_rate']:.1%}")
+    if summary["psms"]:
+        st.caption(
+            f"Median precursor error {summary['median_ppm']:.2f} ppm. A median far from "
+            "0 or errors piling up at the tolerance edges suggest the precursor "
+            "tolerance is off."
+        )
+        histogram_chart(
+            summary["ppm_edges"], {"PSMs": summary["ppm_counts"]}, "Precursor error (ppm)"
+        )
+    histogram_chart(
+        summary["delta_edges"],
+        {"Target PSMs": summary["delta_counts"]},
+        "Delta mass (Da)",
+    )
+    st.caption(
+        "Peaks away from 0 Da are modifications or isotope errors the search does not "
+        "account for."
+    )
+    st.button(
+        "Start the full search",
+        type="primary",
+        on_click=lambda: st.session_state.update(confirm_search=True),
+    )
+
+
+with st.expander("Auto-tune bucket size and threads", expanded=False):
+    tuning_panel()
+    tuning = task_result("tuning_job", "Tuning")
+    if tuning:
+        st.session_state["tuning"] = tuning
+    tuning = st.session_state.get("tuning")
+    use_tuned_bucket_size = False
+    if tuning:
+        st.dataframe(
+            pd.DataFrame(tuning["trials"])[
+                ["bucket_size", "threads", "spectra_per_second", "estimated_seconds"]
+            ].rename(
+                columns={
+                    "bucket_size": "Bucket size",
+                    "threads": "Threads",
+                    "spectra_per_second": "Spectra/s",
+                    "estimated_seconds": "Estimated full search (s)",
+                }
+            ),
+            hide_index=True,
+            use_container_width=True,
+        )
+        st.success(
+            f"Fastest: bucket_size {tuning['bucket_size']} with {tuning['threads']} "
+            f"of {tuning['cpus']} cores (estimated {tuning['estimated_spectra']} MS2 "
+            "spectra)"
+        )
+        if tuning["threads"] < tuning["cpus"]:
+            st.caption(
+                "Sage does not get faster with more threads here, so more searches "
+                "can run at once (SAGE_MAX_RUNNING_JOBS) at the same speed each."
+            )
+        # only applied if the FASTA and config are still the tuned ones (checked on Run)
+        use_tuned_bucket_size = st.checkbox(
+            f"Use bucket_size {tuning['bucket_size']} for this search", value=True
+        )
+
+
+# with preview_first, Run queues a search of a sample and the full search
+# waits for "Start the full search"
+confirmed = st.session_state.pop("confirm_search", False)
+preview_job = st.session_state.get("preview_job")
+summary = task_result("preview_job", "Preview")
+if summary:
+    st.session_state["preview"] = {"key": preview_job["key"], "summary": summary}
+run_clicked = st.button("Run", key="run", disabled="preview_job" in st.session_state)
+if run_clicked and preview_first:
+    run_preview_search()
+    run_clicked = False
+preview = st.session_state.get("preview")
+if preview_first and preview and preview["key"] == preview_key():
+    preview_results(preview["summary"])
+
+if run_clicked or confirmed:
+    if parent_job is None and fasta_file is None and not fasta_server_paths:
         st.error("Please upload a FASTA file")
         st.stop()
-    if not mzml_files:
+    if not mzml_files and not mzml_server_paths:
         st.error("Please upload at least one mzML file")
         st.stop()
-    if not json_file:
+    if (
+        parent_job is None
+        and not json_file
+        and not json_server_paths
+        and not generated_config
+    ):
         st.error("Please upload a JSON file or provide parameters")
         st.stop()
+    if parent_job:
+        # Sage names PSMs by file name, uploads may be stored gzipped
+        def run_name(path):
+            name = os.path.basename(path.rstrip("/"))
+            return name[: -len(".gz")] if name.lower().endswith(".gz") else name
 
-    # open tmp directory
-    with tempfile.TemporaryDirectory(delete=False, dir=".") as tmp_dir:
-        # Save the uploaded files to the temporary directory
-        fasta_path = os.path.join(tmp_dir, fasta_file.name)
-        with open(fasta_path, "wb") as f:
-            f.write(fasta_file.getbuffer())
+        searched = {run_name(path) for path in searched_files(parent_job)}
+        new_names = [run_name(p) for p in mzml_server_paths]
+        new_names += [run_name(f.name) for f in mzml_files]
+        repeated = sorted(
+            {name for name in new_names if name in searched or new_names.count(name) > 1}
+        )
+        if repeated:
+            st.error(
+                "These files are already in the search or chosen twice: "
+                + ", ".join(repeated)
+            )
+            st.stop()
 
-        mzml_paths = []
+    uploads = [f for f in [fasta_file, json_file, *mzml_files] if f is not None]
+    try:
+        scheduler.check_quota(user_id, extra_bytes=sum(f.size for f in uploads))
+    except QuotaError as e:
+        st.error(str(e))
+        st.stop()
+
+    # every job gets its own workspace directory
+    # the job id doubles as the secret in the job's shareable URL
+    job_id = uuid.uuid4().hex
+    tmp_dir = os.path.join(jobs_root, job_id)
+    os.makedirs(tmp_dir)
+
+    # Save the uploaded files to the workspace, validating them in the same
+    # pass; server data is referenced in place, so it is only read
+    try:
+        if parent_job:
+            # the earlier search's FASTA and config, so the scores stay comparable
+            fasta_path, fasta_sha256 = parent_job.fasta_path, parent_job.fasta_sha256
+            json_path = os.path.join(tmp_dir, os.path.basename(parent_job.config_path))
+            shutil.copyfile(parent_job.config_path, json_path)
+        else:
+            if fasta_server_paths:
+                fasta_path = fasta_server_paths[0]
+                fasta_sha256 = validate_path(fasta_path)
+            else:
+                fasta_path = os.path.join(tmp_dir, fasta_file.name)
+                fasta_sha256 = copy_validated(fasta_file, fasta_path, fasta_file.name)
+
+            # Save the JSON file to the workspace
+            if json_server_paths:
+                json_name = os.path.basename(json_server_paths[0])
+                json_path = os.path.join(tmp_dir, json_name)
+                with open(json_server_paths[0], "rb") as f:
+                    copy_validated(f, json_path, json_name)
+            elif generated_config:
+                json_path = os.path.join(tmp_dir, "sage_config.json")
+                copy_validated(
+                    io.BytesIO(generated_config.encode()), json_path, "sage_config.json"
+                )
+            else:
+                json_path = os.path.join(tmp_dir, json_file.name)
+                copy_validated(json_file, json_path, json_file.name)
+
+        # the tuned bucket size, if tuning ran on this FASTA and config
+        if use_tuned_bucket_size and parent_job is None:
+            with open(json_path) as f:
+                config = json.load(f)
+            key = fingerprint(sage_path, fasta_sha256, config)
+            if key == tuning["fingerprint"]:
+                config.setdefault("database", {})["bucket_size"] = tuning["bucket_size"]
+                with open(json_path, "w") as f:
+                    json.dump(config, f, indent=2)
+
+        mzml_paths = list(mzml_server_paths)
+        # server mzML files can be large, the worker validates and hashes them
+        mzml_sha256 = [None] * len(mzml_server_paths)
         for mzml_file in mzml_files:
             mzml_path = os.path.join(tmp_dir, mzml_file.name)
-            with open(mzml_path, "wb") as f:
-                f.write(mzml_file.getbuffer())
+            # gzipped on multiple cores while it is written
+            compress = compress_mzml and mzml_file.name.lower().endswith(".mzml")
+            if compress:
+                mzml_path += ".gz"
+            mzml_sha256.append(
+                copy_validated(mzml_file, mzml_path, mzml_file.name, compress)
+            )
             mzml_paths.append(mzml_path)
+    except ValidationError as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        st.error(f"Invalid input, the search was not started: {e}")
+        st.stop()
 
-        # Save the JSON file to the temporary directory
-        json_path = os.path.join(tmp_dir, json_file.name)
-        with open(json_path, "wb") as f:
-            f.write(json_file.getbuffer())
-
-        output_path = os.path.join(tmp_dir, "output")
-
-        # Run the command
+    output_path = os.path.join(tmp_dir, "output")
 
-        command = [
-            sage_path,
-            json_path,
-            "".join(mzml_paths),
-            "--output_directory",
-            output_path,
-            "--fasta",
-            fasta_path,
-        ]
+    command = [
+        sage_path,
+        json_path,
+        *mzml_paths,
+        "--output_directory",
+        output_path,
+        "--fasta",
+        fasta_path,
+    ]
+    if parent_job:
+        command += command_flags(parent_job)
+    else:
         if include_fragment_annotations:
             command.append("--annotate-matches")
-
         if output_type == "parquet":
             command.append("--parquet")
 
-        with st.spinner("Running Sage..."):
-
-            try:
-                result = subprocess.run(command, capture_output=True, text=True)
-                st.success("Sage completed successfully")
-            except Exception as e:
-                st.error(f"Failed to run Sage: {str(e)}")
-                st.stop()
-
-            with st.expander("Sage output", expanded=False):
-                stdout_tab, stderr_tab = st.tabs(["stdout", "stderr"])
-                with stdout_tab:
-                    st.code(result.stdout, language="text", height=300)
-                with stderr_tab:
-                    st.code(result.stderr, language="text", height=300)
-
-            # download results (zip file)
-            zip_path = os.path.join(tmp_dir, f"{search_name}.zip")
-            with zipfile.ZipFile(zip_path, "w") as zipf:
-                for root, dirs, files in os.walk(output_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        zipf.write(file_path, os.path.relpath(file_path, output_path))
-
-                # save the output as log.txt
-                stdout_log_path = os.path.join(output_path, "stdout.txt")
-                with open(stdout_log_path, "w") as logf:
-                    logf.write(result.stdout)
-
-                stderr_log_path = os.path.join(output_path, "stderr.txt")
-                with open(stderr_log_path, "w") as logf:
-                    logf.write(result.stderr)
-
-            with open(zip_path, "rb") as f:
-                st.download_button(
-                    label="Download results",
-                    data=f,
-                    file_name=f"{search_name}.zip",
-                    mime="application/zip",
-                    on_click="ignore",
+    job = Job(
+        job_id=job_id,
+        owner=user_id,
+        name=search_name,
+        workspace=tmp_dir,
+        command=command,
+        output_path=output_path,
+        fasta_path=fasta_path,
+        fasta_sha256=fasta_sha256,
+        mzml_paths=mzml_paths,
+        mzml_sha256=mzml_sha256,
+        config_path=json_path,
+        timeout=timeout_hours * 3600 if timeout_hours else None,
+        parent_id=parent_job.job_id if parent_job else None,
+    )
+    try:
+        scheduler.submit(job)
+    except QuotaError as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        st.error(str(e))
+        st.stop()
+
+    all_jobs[job_id] = job
+    user_jobs.insert(0, job)
+    # the job can be reopened from any session with this URL
+    st.query_params["job"] = job_id
+    # the uploads are in the job's workspace now
+    st.session_state["upload_generation"] += 1
+    st.session_state.pop("preview", None)
+
+
+# rows shown of result tables that do not fit in the session's memory budget
+PREVIEW_ROWS = 1000
+
+
+def load_result(path):
+    """The table and whether it is only its first PREVIEW_ROWS rows."""
+    # the parquet copy made by post-processing, if there is one
+    source = table_source(path)
+
+    # held per session by `memory`, which spills it to disk when over budget
+    def read():
+        if source.endswith(".parquet"):
+            return pd.read_parquet(source)
+        return pd.read_csv(source, sep="\t")
+
+    def read_preview():
+        return open_table(path).head(PREVIEW_ROWS).to_pandas()
+
+    key = ("result", path, os.path.getmtime(path))
+    df = memory.get(
+        key, "results", read, read_preview, estimate=os.path.getsize(source)
+    )
+    return df, memory.is_preview(key)
+
+
+def read_log(path):
+    def read():
+        with open(path) as f:
+            return f.read()
+
+    return memory.get(("log", path, os.path.getmtime(path)), "logs", read)
+
+
+@st.fragment(run_every="2s")
+@profile_rerun("job_status")
+def job_status(job_id):
+    job = scheduler.get(job_id)
+    if job.finished:
+        # rerun the whole page to show the results
+        st.rerun()
+
+    if job.status == PENDING:
+        st.info(f"Queued, position {scheduler.queue_position(job_id)} in the queue")
+    elif job.cancel_requested:
+        st.warning("Stopping Sage...")
+    elif job.returncode is not None:
+        st.info("Sage finished, processing the results...")
+    else:
+        st.info(f"Running Sage... ({time.time() - job.started_at:.0f}s)")
+        if job.batch_id:
+            st.caption(
+                "Searched in one Sage run with other queued jobs that use the same "
+                "FASTA and config. Results are split per job and the FDR is "
+                "computed for this job's files only."
+            )
+        else:
+            # Sage logs its progress to stderr
+            st.code(log_tail(job, "stderr.txt"), language="text", height=200)
+
+    if job.owner == user_id and st.button(
+        "Cancel", key=f"cancel_{job_id}", disabled=job.cancel_requested
+    ):
+        scheduler.cancel(job_id)
+        st.rerun(scope="fragment")
+
+
+@st.cache_data(max_entries=32)
+def load_distinct_values(_dataset, path, mtime, column):
+    return distinct_values(_dataset, column)
+
+
+def download_on_demand(path, file_name, key, mime=None):
+    """
+    A download button for path, shown once asked for: Streamlit reads the
+    file of a download button into memory on every rerun that shows it.
+    """
+    prepared_key = f"prepared_{key}"
+    if st.session_state.get(prepared_key) != path:
+        if not st.button(
+            f"Prepare {file_name} ({os.path.getsize(path) / 1024**2:.1f} MB)",
+            key=f"prepare_{key}",
+        ):
+            return
+        st.session_state[prepared_key] = path
+    with open(path, "rb") as f:
+        st.download_button(
+            label=f"Download {file_name}",
+            data=f,
+            file_name=file_name,
+            mime=mime,
+            key=f"download_{key}",
+            on_click="ignore",
+        )
+
+
+@profile_section("export_panel")
+def export_panel(job):
+    """Per-artifact downloads and a filtered export streamed from disk."""
+    st.caption("Artifacts")
+    files = [
+        file
+        for file in sorted(os.listdir(job.output_path))
+        if os.path.isfile(os.path.join(job.output_path, file))
+    ]
+    artifact = st.selectbox("File", files, key=f"artifact_{job.job_id}")
+    if artifact:
+        download_on_demand(
+            os.path.join(job.output_path, artifact), artifact, f"artifact_{job.job_id}"
+        )
+
+    tables = table_paths(job.output_path)
+    if not tables:
+        return
+
+    st.caption("Filtered export")
+    table = st.selectbox(
+        "Table", tables, format_func=os.path.basename, key=f"export_table_{job.job_id}"
+    )
+    # with the tables of the jobs an incremental search extends
+    dataset = open_output(job, table)
+    schema = dataset.schema
+
+    q_columns = [c for c in Q_VALUE_COLUMNS if c in schema.names]
+    c1, c2 = st.columns(2)
+    with c1:
+        q_column = st.selectbox(
+            "q-value column",
+            q_columns,
+            disabled=not q_columns,
+            key=f"export_q_column_{job.job_id}",
+        )
+    with c2:
+        max_q = st.number_input(
+            "Maximum q-value",
+            min_value=0.0,
+            max_value=1.0,
+            value=0.01,
+            step=0.01,
+            format="%.3f",
+            disabled=not q_columns,
+            key=f"export_max_q_{job.job_id}",
+        )
+
+    columns = st.multiselect(
+        "Columns", schema.names, placeholder="All columns", key=f"export_columns_{job.job_id}"
+    )
+    filenames = []
+    if "filename" in schema.names:
+        filenames = st.multiselect(
+            "Files",
+            load_distinct_values(dataset, table, os.path.getmtime(table), "filename"),
+            placeholder="All files",
+            key=f"export_files_{job.job_id}",
+        )
+    targets_only = "label" in schema.names and st.checkbox(
+        "Targets only", value=True, key=f"export_targets_{job.job_id}"
+    )
+    export_format = st.radio(
+        "Format", ["parquet", "tsv.gz"], horizontal=True, key=f"export_format_{job.job_id}"
+    )
+
+    export_key = f"export_path_{job.job_id}"
+    if st.button("Prepare export", key=f"export_{job.job_id}"):
+        export_dir = os.path.join(job.workspace, "exports")
+        os.makedirs(export_dir, exist_ok=True)
+        table_name = os.path.basename(table).split(".")[0]
+        dest = os.path.join(export_dir, f"{table_name}_filtered.{export_format}")
+        with st.spinner("Exporting..."):
+            rows = export_table(
+                dataset,
+                dest,
+                columns=columns,
+                max_q=max_q if q_column else None,
+                q_column=q_column,
+                filenames=filenames,
+                targets_only=targets_only,
+            )
+        st.session_state[export_key] = dest
+        st.info(f"{rows} rows exported")
+
+    dest = st.session_state.get(export_key)
+    if dest and os.path.exists(dest):
+        with open(dest, "rb") as f:
+            st.download_button(
+                label=f"Download {os.path.basename(dest)}",
+                data=f,
+                file_name=os.path.basename(dest),
+                key=f"download_export_{job.job_id}",
+                on_click="ignore",
+            )
+
+
+@st.cache_data(max_entries=16)
+def load_query_page(tables, sql, page, page_size):
+    return run_query(
+        dict(tables), sql, page, page_size, os.path.join(jobs_root, ".query_tmp")
+    )
+
+
+@profile_section("query_panel")
+def query_panel(jobs):
+    """SQL over the output tables of one or more finished jobs, one page at a time."""
+    if duckdb is None:
+        st.info("Install the query extra (pip install sage-web-app[query]) to query results with SQL.")
+        return
+
+    completed = [job for job in jobs if job.status == COMPLETED]
+    selected = st.multiselect(
+        "Jobs",
+        completed,
+        default=completed[:1],
+        format_func=lambda job: f"{job.name} ({job.job_id[:6]})",
+        key="query_jobs",
+    )
+    tables = job_tables(selected)
+    if not tables:
+        return
+
+    st.caption("Tables: " + ", ".join(f"`{name}`" for name in tables))
+    results_table = next((name for name in tables if name.endswith("_results")), None)
+    if results_table:
+        example = (
+            f'SELECT proteins, count(DISTINCT peptide) AS peptides\nFROM "{results_table}"\n'
+            "WHERE label = 1 AND peptide_q <= 0.01\nGROUP BY proteins\nORDER BY peptides DESC"
+        )
+    else:
+        example = f'SELECT * FROM "{next(iter(tables))}"'
+    sql = st.text_area("SQL", value=example, height=150, key="query_sql")
+
+    # queries can scan large tables, they only run when asked to
+    if st.button("Run query", key="query_run"):
+        st.session_state.query_last = (sql, tuple(sorted(tables.items())))
+        st.session_state.query_page = 0
+    if "query_last" not in st.session_state:
+        return
+    query_sql, query_tables = st.session_state.query_last
+    if query_sql != sql:
+        st.caption("Results of the last query run:")
+
+    page_size = 100
+    try:
+        df, total = load_query_page(
+            query_tables, query_sql, st.session_state.query_page, page_size
+        )
+    except (duckdb.Error, ValueError) as e:
+        st.error(str(e))
+        return
+
+    st.dataframe(df, use_container_width=True, hide_index=True)
+    pages = max(1, -(-total // page_size))
+    c1, c2, c3 = st.columns([1, 2, 1], vertical_alignment="center")
+    if c1.button("Previous", disabled=st.session_state.query_page == 0, use_container_width=True):
+        st.session_state.query_page -= 1
+        st.rerun()
+    c2.caption(f"Page {st.session_state.query_page + 1} of {pages} ({total} rows)")
+    if c3.button("Next", disabled=st.session_state.query_page >= pages - 1, use_container_width=True):
+        st.session_state.query_page += 1
+        st.rerun()
+
+
+@profile_section("quant_overview")
+def quant_overview(job):
+    c1, c2, c3 = st.columns(3, vertical_alignment="bottom")
+    with c1:
+        level = st.radio("Level", LEVELS, horizontal=True, key=f"quant_level_{job.job_id}")
+    with c2:
+        max_q = st.number_input(
+            "Maximum q-value",
+            min_value=0.0,
+            max_value=1.0,
+            value=0.01,
+            step=0.01,
+            format="%.3f",
+            key=f"quant_max_q_{job.job_id}",
+        )
+    with c3:
+        normalize = st.checkbox("Median normalize", key=f"quant_normalize_{job.job_id}")
+
+    try:
+        with st.spinner("Building quant matrix..."):
+            matrix, missing = quant_matrix(job, level, max_q, normalize)
+    except (KeyError, ValueError) as e:
+        st.error(f"Could not build the quant matrix: {str(e)}")
+        return
+
+    st.caption(f"{len(matrix)} {level}s x {len(matrix.columns)} samples")
+    st.dataframe(matrix, use_container_width=True)
+    st.caption("Missing values per sample")
+    st.dataframe(missing, use_container_width=True)
+
+
+@st.cache_data(max_entries=16)
+def load_plot_bins(job_id, mtime):
+    return plot_bins(scheduler.get(job_id))
+
+
+@st.cache_data(max_entries=8)
+def load_mass_shifts(job_id, mtime):
+    return mass_shifts(scheduler.get(job_id))
+
+
+@profile_section("mass_shift_panel")
+def mass_shift_panel(job):
+    """Delta mass histogram and annotated peaks, from the job's cached bins."""
+    shifts = load_mass_shifts(job.job_id, job.finished_at)
+    if shifts is None or not shifts["counts"].sum():
+        st.info(f"No target PSMs at {FDR_THRESHOLD:.0%} FDR.")
+        return
+
+    peaks = pick_peaks(shifts)
+    st.dataframe(
+        pd.DataFrame(
+            peaks, columns=["delta_mass", "psms", "share", "annotation", "error"]
+        ),
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "delta_mass": st.column_config.NumberColumn(
+                "Delta mass (Da)", format="%.4f"
+            ),
+            "psms": "PSMs",
+            "share": st.column_config.NumberColumn("Share", format="percent"),
+            "annotation": "Modification",
+            "error": st.column_config.NumberColumn("Error (Da)", format="%.4f"),
+        },
+    )
+
+    # the fine bins summed to at most 1000 bars for the overview
+    counts, width = shifts["counts"], shifts["width"][0]
+    factor = -(-len(counts) // 1000)
+    padded = np.pad(counts, (0, -len(counts) % factor))
+    edges = (shifts["start"][0] + np.arange(0, len(padded) + 1, factor)) * width
+    histogram_chart(
+        edges, {"PSMs": padded.reshape(-1, factor).sum(axis=1)}, "Delta mass (Da)"
+    )
+
+    if peaks:
+        peak = st.selectbox(
+            "Zoom in on peak",
+            peaks,
+            format_func=lambda p: (
+                f"{p['delta_mass']:.4f} Da ({p['annotation'] or 'unknown'})"
+            ),
+            key=f"mass_shift_peak_{job.job_id}",
+        )
+        # +- 0.05 Da at full resolution
+        masses = bin_masses(shifts)
+        near = np.abs(masses - peak["delta_mass"]) <= 0.05
+        edges = np.append(masses[near] - width / 2, masses[near][-1] + width / 2)
+        histogram_chart(edges, {"PSMs": counts[near]}, "Delta mass (Da)")
+
+
+@profile_section("result_plots")
+def result_plots(job):
+    """PSM plots drawn from per-job cached histograms, never from the PSMs."""
+    bins = load_plot_bins(job.job_id, job.finished_at)
+    if bins is None:
+        return
+
+    c1, c2 = st.columns(2)
+    with c1:
+        st.caption(f"Score ({bins['score_column'][0]})")
+        histogram_chart(
+            bins["score_edges"],
+            {"targets": bins["score_targets"], "decoys": bins["score_decoys"]},
+            "score",
+        )
+    with c2:
+        st.caption(f"Precursor error, target PSMs at {FDR_THRESHOLD:.0%} FDR")
+        histogram_chart(bins["ppm_edges"], {"PSMs": bins["ppm_counts"]}, "ppm")
+
+    c1, c2 = st.columns(2)
+    with c1:
+        st.caption(f"Target PSMs at {FDR_THRESHOLD:.0%} FDR per file")
+        st.bar_chart(
+            pd.DataFrame({"file": bins["files"], "PSMs": bins["file_ids"]}),
+            x="file",
+            y="PSMs",
+            horizontal=True,
+        )
+    with c2:
+        if bins["rt_counts"].size:
+            st.caption("Retention time vs predicted RT")
+            rt_edges, predicted_edges = bins["rt_edges"], bins["predicted_rt_edges"]
+            x, y = np.nonzero(bins["rt_counts"])
+            grid = pd.DataFrame(
+                {
+                    "rt": rt_edges[x],
+                    "rt_end": rt_edges[x + 1],
+                    "predicted": predicted_edges[y],
+                    "predicted_end": predicted_edges[y + 1],
+                    "count": bins["rt_counts"][x, y],
+                }
+            )
+            st.vega_lite_chart(
+                grid,
+                {
+                    "mark": "rect",
+                    "encoding": {
+                        "x": {
+                            "field": "rt",
+                            "type": "quantitative",
+                            "title": bins["rt_column"][0],
+                        },
+                        "x2": {"field": "rt_end"},
+                        "y": {
+                            "field": "predicted",
+                            "type": "quantitative",
+                            "title": "predicted_rt",
+                        },
+                        "y2": {"field": "predicted_end"},
+                        "color": {
+                            "field": "count",
+                            "type": "quantitative",
+                            "scale": {"type": "log", "scheme": "viridis"},
+                        },
+                    },
+                },
+                use_container_width=True,
+            )
+        else:
+            st.caption("No RT predictions (enable predict_rt in the config)")
+
+
+@profile_section("show_job_results")
+def show_job_results(job):
+    if job.status == COMPLETED:
+        st.success("Sage completed successfully")
+        if job.parent_id:
+            st.caption(
+                f"Searched {len(job.mzml_paths)} new files and added them to search "
+                f"{job.parent_id}. The FDR, counts, plots, filtered exports and SQL "
+                f"views cover all {len(searched_files(job))} files; the archive and "
+                "the tables below hold the new files' PSMs."
+            )
+        if job.postprocess_errors:
+            errors = job.postprocess_errors.items()
+            st.warning(
+                "Some results could not be prepared: "
+                + "; ".join(f"{step} ({error})" for step, error in errors)
+            )
+        if job.summary:
+            columns = st.columns(len(job.summary))
+            for column, (key, value) in zip(columns, job.summary.items()):
+                column.metric(f"{key.capitalize()} at {FDR_THRESHOLD:.0%} FDR", f"{value:,}")
+    elif job.status == CANCELLED:
+        st.warning("Search was cancelled")
+    elif job.status == TIMED_OUT:
+        st.error(f"Search timed out: {job.error}")
+    else:
+        st.error(f"Sage failed: {job.error}")
+
+    with st.expander("Sage output", expanded=job.status != COMPLETED):
+        stdout_tab, stderr_tab = st.tabs(["stdout", "stderr"])
+        for tab, log in [(stdout_tab, "stdout.txt"), (stderr_tab, "stderr.txt")]:
+            log_path = os.path.join(job.output_path, log)
+            if os.path.exists(log_path):
+                with tab:
+                    st.code(read_log(log_path), language="text", height=300)
+
+    if os.path.exists(job.zip_path):
+        download_on_demand(
+            job.zip_path,
+            f"{download_name(job.name)}.zip",
+            f"zip_{job.job_id}",
+            "application/zip",
+        )
+
+    if job.status != COMPLETED:
+        return
+
+    with st.expander("Downloads", expanded=False):
+        export_panel(job)
+
+    if quant_type(job):
+        st.subheader(f"Quant overview ({quant_type(job).upper()})")
+        quant_overview(job)
+
+    st.subheader("Plots")
+    try:
+        result_plots(job)
+    except (KeyError, ValueError, StopIteration) as e:
+        st.error(f"Could not plot the results: {str(e)}")
+
+    with st.expander("Mass shifts (open search)", expanded=False):
+        try:
+            mass_shift_panel(job)
+        except (KeyError, ValueError) as e:
+            st.error(f"Could not compute the mass shifts: {str(e)}")
+
+    # show the results (either tsv or parquet files)
+    st.subheader("Results")
+    for file in sorted(os.listdir(job.output_path)):
+        if file.endswith(".tsv") or file.endswith(".parquet"):
+            path = os.path.join(job.output_path, file)
+            df, is_preview = load_result(path)
+            st.caption(file)
+            if is_preview:
+                st.caption(
+                    f"First {len(df):,} rows, the table does not fit in the session's "
+                    "memory. Use the downloads or the query panel for all rows."
                 )
+            st.dataframe(df)
+
+
+# tuning and preview jobs count against the quotas, but only show where they
+# were started
+search_jobs = [job for job in user_jobs if job.kind == SEARCH]
+job_ids = [job.job_id for job in search_jobs]
+
+# jobs shared by URL can be opened by anyone who has the link
+linked_job_id = st.query_params.get("job")
+linked_job = all_jobs.get(linked_job_id)
+if linked_job and linked_job.kind == SEARCH and linked_job_id not in job_ids:
+    job_ids.insert(0, linked_job_id)
+
+if job_ids:
+    st.subheader("Jobs")
+    if search_jobs:
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    {
+                        "Job": job.job_id,
+                        "Name": job.name,
+                        "Status": job.status,
+                        "Submitted": time.strftime(
+                            "%Y-%m-%d %H:%M:%S", time.localtime(job.submitted_at)
+                        ),
+                        "CPU hours": job.cpu_seconds / 3600,
+                    }
+                    for job in search_jobs
+                ]
+            ),
+            hide_index=True,
+            use_container_width=True,
+        )
 
-            # show the results (either tsv or parquet files)
-            st.subheader("Results")
-            results = os.listdir(output_path)
-            for file in results:
-                if file.endswith(".tsv"):
-                    df = pd.read_csv(os.path.join(output_path, file), sep="\t")
-                    st.dataframe(df)
-                if file.endswith(".parquet"):
-                    df = pd.read_parquet(os.path.join(output_path, file))
-                    st.dataframe(df)
+    selected_job = all_jobs.get(
+        st.selectbox(
+            "Job",
+            job_ids,
+            index=job_ids.index(linked_job_id) if linked_job_id in job_ids else 0,
+            format_func=lambda job_id: f"{all_jobs.get(job_id).name} ({job_id})",
+        )
+    )
+    st.query_params["job"] = selected_job.job_id
+    st.caption("Copy the page URL to reopen or share this job from any session.")
+
+    if selected_job.finished:
+        show_job_results(selected_job)
+    else:
+        job_status(selected_job.job_id)
+
+    with st.expander("Query results", expanded=False):
+        query_panel([all_jobs[job_id] for job_id in job_ids])
+
+memory_usage = memory.usage()
+memory_status.caption(
+    f"Session memory: {memory.held_bytes() / 1024**2:.0f} of "
+    f"{memory.budget / 1024**2:.0f} MB | "
+    + " | ".join(
+        f"{kind} {memory_usage[kind] / 1024**2:.1f} MB"
+        for kind in ["uploads", "results", "logs"]
+    )
+    + f" | {memory_usage['spilled'] / 1024**2:.1f} MB spilled to disk"
+)
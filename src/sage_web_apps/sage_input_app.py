@@ -5,9 +5,14 @@ import json
 from typing import Dict, List
 import streamlit_permalink as stp
 
+from sage_web_apps.data_browser import find_mzml_files
+from sage_web_apps.profiling import profile_section
+from sage_web_apps.state_codec import STATE_PARAM, decode_state, encode_state
+
 # if not set (running from community cloud = server mode)
 is_local = os.getenv("LOCAL", "False") == "True"
 
+@profile_section("update_query_dataframe")
 def update_query_dataframe(
     key: str, df: pd.DataFrame, append: bool, is_static: bool
 ) -> None:
@@ -32,11 +37,57 @@ def update_query_dataframe(
     else:
         st.query_params.update({key: stp.to_url_value(df)})
 
+    rerun()
+
+
+@profile_section("expand_query_state")
+def expand_query_state() -> None:
+    """
+    Unpack the compact state param into the per widget query params that
+    streamlit_permalink reads. Params set since the last run (button presets,
+    widget callbacks) are newer and win over the packed state.
+    """
+    token = st.query_params.get(STATE_PARAM)
+    if token is None:
+        return
+
+    try:
+        state = decode_state(token)
+    except ValueError:
+        st.warning("Could not read the configuration from the URL, using defaults.")
+        state = {}
+
+    for key in st.query_params:
+        if key != STATE_PARAM:
+            state[key] = st.query_params.get_all(key)
+    # one URL update for all params
+    st.query_params.from_dict(
+        {
+            key: values[0] if len(values) == 1 else values
+            for key, values in state.items()
+        }
+    )
+
+
+@profile_section("compact_query_state")
+def compact_query_state() -> None:
+    """Pack all query params into a single compressed, versioned param."""
+    state = {key: st.query_params.get_all(key) for key in st.query_params}
+    if not state:
+        return
+    st.query_params.from_dict({STATE_PARAM: encode_state(state)})
+
+
+def rerun() -> None:
+    """st.rerun, with the URL packed first like at the end of a full run."""
+    compact_query_state()
     st.rerun()
 
 
 def main():
 
+    expand_query_state()
+
     # reset query params btn
     c1, c2, c3 = st.columns(3)
 
@@ -54,7 +105,7 @@ def main():
         st.query_params.update({"precursor_tol_type": "da"})
         st.query_params.update({"precursor_tol_minus": -100})
         st.query_params.update({"precursor_tol_plus": 500})
-        st.rerun()
+        rerun()
 
     # WWA/PRM/DIA: set wide window = true, chimeric=false, report_psms=5
     if c2.button(
@@ -67,7 +118,7 @@ def main():
         st.query_params.update({"wide_window": True})
         st.query_params.update({"chimera": False})
         st.query_params.update({"report_psms": 5})
-        st.rerun()
+        rerun()
 
 
     if c3.button(
@@ -78,7 +129,7 @@ def main():
         help="Reset all query params to default values",
     ):
         st.query_params.clear()
-        st.rerun()
+        rerun()
 
     st.title("Sage Configuration Generator")
 
@@ -107,7 +158,7 @@ def main():
 
     error_container = st.empty()
 
-    with file_tab:
+    with file_tab, profile_section("file tab"):
 
         output_directory = st.text_input(
             label="Output Directory",
@@ -138,11 +189,7 @@ def main():
                 if st.button("Load Files", use_container_width=True):
                     # Load mzML files from the folder
                     if folder_path:
-                        mzml_files = [
-                            os.path.join(folder_path, f)
-                            for f in os.listdir(folder_path)
-                            if f.endswith(".mzML") or f.endswith(".mzml") or f.endswith(".mzML.gz") or f.endswith(".d")
-                        ]
+                        mzml_files = find_mzml_files(folder_path)
                         if len(mzml_files) == 0:
                             error_container.error(
                                 "No mzML files found in the specified folder."
@@ -171,7 +218,7 @@ def main():
 
         mzml_paths = mzml_df["mzML Path"].tolist()
 
-    with enzyme_tab:
+    with enzyme_tab, profile_section("enzyme tab"):
 
         c1, c2 = st.columns([1, 2])
         with c1:
@@ -181,7 +228,7 @@ def main():
                 st.query_params.update({"restrict": "P"})
                 st.query_params.update({"enzyme_terminus": "C"})
                 st.query_params.update({"missed_cleavages": 2})
-                st.rerun()
+                rerun()
 
             # chymotrypsin
             if st.button("Chymotrypsin (FWYL!P)", use_container_width=True):
@@ -190,7 +237,7 @@ def main():
                 st.query_params.update({"restrict": "P"})
                 st.query_params.update({"enzyme_terminus": "C"})
                 st.query_params.update({"missed_cleavages": 5})
-                st.rerun()
+                rerun()
 
             if st.button("Lys-C (K!P)", use_container_width=True):
                 # update query params cleave_at="K"
@@ -198,7 +245,7 @@ def main():
                 st.query_params.update({"restrict": "P"})
                 st.query_params.update({"enzyme_terminus": "C"})
                 st.query_params.update({"missed_cleavages": 1})
-                st.rerun()
+                rerun()
 
             if st.button("Asp-N (DE)", use_container_width=True):
                 # update query params cleave_at="DE"
@@ -206,7 +253,7 @@ def main():
                 st.query_params.update({"restrict": ""})
                 st.query_params.update({"enzyme_terminus": "N"})
                 st.query_params.update({"missed_cleavages": 2})
-                st.rerun()
+                rerun()
 
             # protinase K
             if st.button("Protinase K (AEFILTVWY)", use_container_width=True):
@@ -215,7 +262,7 @@ def main():
                 st.query_params.update({"restrict": ""})
                 st.query_params.update({"enzyme_terminus": "C"})
                 st.query_params.update({"missed_cleavages": 7})
-                st.rerun()
+                rerun()
 
             if st.button("Arg-C (R!P)", use_container_width=True):
                 # update query params cleave_at="R"
@@ -223,7 +270,7 @@ def main():
                 st.query_params.update({"restrict": "P"})
                 st.query_params.update({"enzyme_terminus": "C"})
                 st.query_params.update({"missed_cleavages": 1})
-                st.rerun()
+                rerun()
 
             if st.button("Non-enzymatic ()", use_container_width=True):
                 # update query params cleave_at="K"
@@ -231,7 +278,7 @@ def main():
                 st.query_params.update({"restrict": ""})
                 st.query_params.update({"enzyme_terminus": "C"})
                 st.query_params.update({"missed_cleavages": 0})
-                st.rerun()
+                rerun()
 
             if st.button("No Digestion ($)", use_container_width=True):
                 # update query params cleave_at="DE"
@@ -239,7 +286,7 @@ def main():
                 st.query_params.update({"restrict": ""})
                 st.query_params.update({"enzyme_terminus": "C"})
                 st.query_params.update({"missed_cleavages": 0})
-                st.rerun()
+                rerun()
 
         with c2:
 
@@ -311,7 +358,7 @@ def main():
                     help="Select if the search should be semi-enzymatic.",
                 )
 
-    with fragment_tab:
+    with fragment_tab, profile_section("fragment tab"):
 
         c1, c2 = st.columns([1, 2])
 
@@ -322,28 +369,28 @@ def main():
             if st.button("High Res MS/MS", use_container_width=True):
                 # update query params bucket_size=8192
                 st.query_params.update({"bucket_size": 8192})
-                st.rerun()
+                rerun()
 
             if st.button("Low Res MS/MS", use_container_width=True):
                 # update query params bucket_size=32768
                 st.query_params.update({"bucket_size": 65536})
-                st.rerun()
+                rerun()
 
             st.caption("Fragmentation")
 
             if st.button("CID/HCD", use_container_width=True):
                 # update query params bucket_size=8192
                 st.query_params.update({"fragment_ions": list("by")})
-                st.rerun()
+                rerun()
             if st.button("ETD/ECD", use_container_width=True):
                 st.query_params.update({"fragment_ions": list("cz")})
-                st.rerun()
+                rerun()
             if st.button("UVPD", use_container_width=True):
                 st.query_params.update({"fragment_ions": list("abcxyz")})
-                st.rerun()
+                rerun()
             if st.button("IRMPD", use_container_width=True):
                 st.query_params.update({"fragment_ions": list("by")})
-                st.rerun()
+                rerun()
 
         with c2:
             sc1, sc2 = st.columns(2)
@@ -353,7 +400,7 @@ def main():
                     options=[8192, 16384, 32768, 65536],
                     index=2,
                     accept_new_options=True,
-                    help="Use lower values (8192) for high-res MS/MS, higher values for low-res MS/MS (only affects search speed)",
+                    help="Use lower values (8192) for high-res MS/MS, higher values for low-res MS/MS (only affects search speed). The search page can auto-tune it on a sample of your spectra.",
                     key="bucket_size",
                 )
             with sc2:
@@ -407,7 +454,7 @@ def main():
             if peptide_min_mass >= peptide_max_mass:
                 error_container.error("Minimum mass must be less than maximum mass.")
 
-    with static_mods_tab:
+    with static_mods_tab, profile_section("static mods tab"):
 
         c1, c2 = st.columns([1, 2])
 
@@ -482,7 +529,7 @@ def main():
             mass = row["Mass"]
             static_dict[residue] = mass
 
-    with variable_mods_tab:
+    with variable_mods_tab, profile_section("variable mods tab"):
         var_df = pd.DataFrame({"Residue": ["M"], "Mass": [15.9949]})
 
         c1, c2 = st.columns([1, 2])
@@ -570,7 +617,7 @@ def main():
             else:
                 variable_dict[residue] = [mass]
 
-    with search_tolerance_tab:
+    with search_tolerance_tab, profile_section("search tolerance tab"):
 
         wide_window = stp.checkbox(
             label="Wide Window",
@@ -651,7 +698,7 @@ def main():
                 help="If true, ignore decoys in the FASTA database matching decoy_tag, and generate internally reversed peptides",
             )
 
-    with spectra_processing_tab:
+    with spectra_processing_tab, profile_section("spectra processing tab"):
 
         c1, c2, c3 = st.columns(3)
         with c1:
@@ -767,7 +814,7 @@ def main():
                 help="The number of PSMs to report for each spectrum. Higher values might disrupt re-scoring, it is best to search with multiple values",
             )
 
-    with quantification_tab:
+    with quantification_tab, profile_section("quantification tab"):
         quant_type = stp.radio(
             label="Quantification Type",
             options=["None", "TMT", "LFQ"],
@@ -949,6 +996,16 @@ def main():
         use_container_width=True,
     )
 
+    # in the multipage app (sage_web_app.py) the config goes straight to the search
+    if st.session_state.get("multipage") and st.button(
+        "Use in Search", type="primary", use_container_width=True
+    ):
+        st.session_state["generated_config"] = config_json
+        st.switch_page("sage_app.py")
+
+    # keep shared links short: one compressed param instead of one per widget
+    compact_query_state()
+
 
 if __name__ == "__main__":
     main()
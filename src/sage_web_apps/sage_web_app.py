@@ -0,0 +1,37 @@
+import os
+
+import streamlit as st
+
+from sage_web_apps.profiling import profile_rerun
+
+# The apps as pages of one server: one interpreter, and cached resources
+# (Sage install, job scheduler and worker) shared by the pages.
+app_dir = os.path.dirname(os.path.abspath(__file__))
+
+# lets the config builder hand its config to the search page
+st.session_state["multipage"] = True
+
+page = st.navigation(
+    [
+        st.Page(
+            os.path.join(app_dir, "sage_input_app.py"),
+            title="Config builder",
+            icon=":material/tune:",
+            url_path="config",
+        ),
+        st.Page(
+            os.path.join(app_dir, "sage_app.py"),
+            title="Search",
+            icon=":material/search:",
+            url_path="search",
+        ),
+        st.Page(
+            os.path.join(app_dir, "catalog_app.py"),
+            title="Job catalog",
+            icon=":material/manage_search:",
+            url_path="catalog",
+        ),
+    ]
+)
+with profile_rerun(page.url_path):
+    page.run()
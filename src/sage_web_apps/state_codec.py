@@ -0,0 +1,46 @@
+import base64
+import functools
+import json
+import zlib
+from typing import Dict, List, Tuple
+
+# bump when the payload layout changes, old links then decode to nothing
+STATE_VERSION = 1
+
+# query param holding the whole encoded app state
+STATE_PARAM = "s"
+
+
+def encode_state(state: Dict[str, List[str]]) -> str:
+    """
+    Encode query params as '<version>.<base64url(zlib(json))>'.
+
+    Keys are sorted so the same state always gives the same token.
+    """
+    payload = json.dumps(state, separators=(",", ":"), sort_keys=True)
+    compressed = zlib.compress(payload.encode(), 9)
+    token = base64.urlsafe_b64encode(compressed).decode().rstrip("=")
+    return f"{STATE_VERSION}.{token}"
+
+
+@functools.lru_cache(maxsize=64)
+def _decode_state(token: str) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+    version, _, data = token.partition(".")
+    if version != str(STATE_VERSION):
+        raise ValueError(f"Unsupported state version: {version}")
+
+    compressed = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    try:
+        state = json.loads(zlib.decompress(compressed))
+    except zlib.error as e:
+        raise ValueError(f"Corrupt state: {e}")
+    if not isinstance(state, dict) or not all(
+        isinstance(values, list) for values in state.values()
+    ):
+        raise ValueError("Corrupt state: not a mapping of params to values")
+    return tuple((key, tuple(values)) for key, values in state.items())
+
+
+def decode_state(token: str) -> Dict[str, List[str]]:
+    """Decode a token from `encode_state`. Decoding is cached per token."""
+    return {key: list(values) for key, values in _decode_state(token)}
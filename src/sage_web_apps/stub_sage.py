@@ -0,0 +1,141 @@
+"""
+Stand-in for the Sage executable, used by the load-test harness.
+
+Accepts the same command line as Sage, waits STUB_SAGE_RUNTIME seconds
+(burning CPU if STUB_SAGE_BUSY=1) and writes about STUB_SAGE_OUTPUT_MB of
+results.sage.tsv with Sage's columns and plausible values.
+
+Run with `python -m sage_web_apps.stub_sage`.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+VERSION = "sage 0.0.0-stub"
+
+PSM_COLUMNS = [
+    "psm_id",
+    "peptide",
+    "proteins",
+    "num_proteins",
+    "filename",
+    "scannr",
+    "rank",
+    "label",
+    "expmass",
+    "calcmass",
+    "charge",
+    "peptide_len",
+    "missed_cleavages",
+    "isotope_error",
+    "precursor_ppm",
+    "fragment_ppm",
+    "hyperscore",
+    "delta_next",
+    "rt",
+    "predicted_rt",
+    "matched_peaks",
+    "sage_discriminant_score",
+    "posterior_error",
+    "spectrum_q",
+    "peptide_q",
+    "protein_q",
+]
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def psm_row(psm_id, filename):
+    peptide = "".join(random.choices(AMINO_ACIDS, k=random.randint(7, 25))) + "K"
+    is_decoy = random.random() < 0.3
+    calcmass = len(peptide) * 110.0 + random.random()
+    score = random.gauss(10 if is_decoy else 20, 4)
+    rt = random.uniform(0, 120)
+    q = random.uniform(0, 1) if is_decoy else random.expovariate(50)
+    return [
+        psm_id,
+        peptide,
+        f"{'rev_' if is_decoy else ''}sp|P{psm_id % 10000:05d}|PROT",
+        1,
+        filename,
+        psm_id,
+        1,
+        -1 if is_decoy else 1,
+        f"{calcmass + random.gauss(0, 0.005):.5f}",
+        f"{calcmass:.5f}",
+        random.randint(2, 4),
+        len(peptide),
+        0,
+        0,
+        f"{random.gauss(0, 3):.3f}",
+        f"{random.gauss(0, 5):.3f}",
+        f"{score * 2:.3f}",
+        f"{random.expovariate(0.5):.3f}",
+        f"{rt:.3f}",
+        f"{rt / 120 + random.gauss(0, 0.02):.4f}",
+        random.randint(4, 30),
+        f"{score / 20:.4f}",
+        f"{random.uniform(-10, 0):.4f}",
+        f"{min(q, 1):.5f}",
+        f"{min(q, 1):.5f}",
+        f"{min(q, 1):.5f}",
+    ]
+
+
+def write_results(output_directory, mzml_paths, output_mb):
+    path = os.path.join(output_directory, "results.sage.tsv")
+    filenames = [os.path.basename(p) for p in mzml_paths] or ["stub.mzML"]
+    target_bytes = output_mb * 1024 * 1024
+
+    with open(path, "w") as f:
+        f.write("\t".join(PSM_COLUMNS) + "\n")
+        psm_id = 0
+        while f.tell() < target_bytes or psm_id == 0:
+            row = psm_row(psm_id, filenames[psm_id % len(filenames)])
+            f.write("\t".join(str(v) for v in row) + "\n")
+            psm_id += 1
+    return psm_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for Sage.")
+    parser.add_argument("--version", action="store_true")
+    parser.add_argument("parameters", nargs="?")
+    parser.add_argument("mzml_paths", nargs="*")
+    parser.add_argument("--output_directory", "-o", default=".")
+    parser.add_argument("--fasta", "-f")
+    parser.add_argument("--annotate-matches", action="store_true")
+    parser.add_argument("--parquet", action="store_true")
+    args, _ = parser.parse_known_args()
+
+    if args.version:
+        print(VERSION)
+        return
+
+    runtime = float(os.getenv("STUB_SAGE_RUNTIME", "2"))
+    output_mb = float(os.getenv("STUB_SAGE_OUTPUT_MB", "1"))
+    busy = os.getenv("STUB_SAGE_BUSY", "0") == "1"
+    exit_code = int(os.getenv("STUB_SAGE_EXIT_CODE", "0"))
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    start = time.time()
+    print(f"[stub] searching {len(args.mzml_paths)} files", file=sys.stderr)
+    while time.time() - start < runtime:
+        if busy:
+            sum(i * i for i in range(100000))
+        else:
+            time.sleep(min(0.1, runtime))
+
+    n_psms = write_results(args.output_directory, args.mzml_paths, output_mb)
+    with open(os.path.join(args.output_directory, "results.json"), "w") as f:
+        json.dump({"version": VERSION, "mzml_paths": args.mzml_paths}, f)
+    print(f"[stub] wrote {n_psms} PSMs", file=sys.stderr)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
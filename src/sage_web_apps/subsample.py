@@ -0,0 +1,214 @@
+"""
+Reduced copies of mzML files for quick trial and preview searches: only MS2
+spectra are kept, optionally every Nth and at most a given number. The input
+is streamed (gzipped or not) and reading stops once enough spectra were
+taken, so sampling the head of a large file costs a small part of reading it.
+"""
+
+import gzip
+import hashlib
+import os
+import re
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from sage_web_apps.validation import CHUNK_SIZE, ValidationError
+
+SPECTRUM_LIST = re.compile(rb"<spectrumList\b[^>]*>")
+SPECTRUM_START = re.compile(rb"<spectrum[\s>]")
+SPECTRUM_END = b"</spectrum>"
+SPECTRUM_LIST_END = b"</spectrumList>"
+MS2 = re.compile(rb'<cvParam[^>]*accession="MS:1000511"[^>]*value="2"')
+COUNT = re.compile(rb'count="(\d+)"')
+INDEX = re.compile(rb'index="\d+"')
+SPECTRUM_ID = re.compile(rb'\bid="([^"]*)"')
+MZML_START = re.compile(rb"<mzML\b")
+# the index of an indexedmzML no longer fits a reduced file, it is rewritten
+INDEXED_MZML = re.compile(rb"<indexedmzML\b[^>]*>\s*")
+INDEXED_MZML_START = (
+    b'<indexedmzML xmlns="http://psi.hupo.org/ms/mzml" '
+    b'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    b'xsi:schemaLocation="http://psi.hupo.org/ms/mzml '
+    b'http://psidev.info/files/ms/mzML/xsd/mzML1.1.2_idx.xsd">\n'
+)
+
+# room for the final spectrum count, written when it is known
+COUNT_PLACEHOLDER = b'count="0"' + b" " * 12
+
+# bytes kept between chunks, so a tag split across chunks is found
+OVERLAP = 64
+
+
+def open_mzml(src: BinaryIO, name: str) -> BinaryIO:
+    if src.seekable():
+        src.seek(0)  # uploads may have been read before
+    if name.lower().endswith(".gz"):
+        return gzip.GzipFile(fileobj=src, mode="rb")
+    return src
+
+
+def count_ms2(src: BinaryIO, name: str) -> int:
+    """MS2 spectra in the file, counted in one regex pass over it."""
+    stream = open_mzml(src, name)
+    count, tail = 0, b""
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        data = tail + chunk
+        # a tag never contains '<', so none is cut at the last one
+        cut = max(0, data.rfind(b"<"))
+        count += len(MS2.findall(data, 0, cut))
+        tail = data[cut:]
+    return count + len(MS2.findall(tail))
+
+
+def subsample_mzml(
+    src: BinaryIO,
+    name: str,
+    dest: str,
+    every: int = 1,
+    limit: Optional[int] = None,
+    indexed: bool = False,
+) -> Dict[str, int]:
+    """
+    Write every `every`th MS2 spectrum of src, at most `limit`, to dest as
+    mzML, with `indexed` as indexedmzML with a new spectrum index and
+    checksum. Returns the spectra kept, the spectra and MS2 spectra read,
+    and the spectrum count the file declares.
+    """
+    stream = open_mzml(src, name)
+    stats = {"kept": 0, "spectra": 0, "ms2": 0, "declared": 0}
+    buffer = b""
+    in_list = done = False
+    # (spectrum id, byte offset) for the index
+    offsets: List[Tuple[bytes, int]] = []
+    with open(dest, "wb+") as out:
+        count_offset = None
+        while not done:
+            chunk = stream.read(CHUNK_SIZE)
+            buffer += chunk
+            if not in_list:
+                match = SPECTRUM_LIST.search(buffer)
+                if match is None:
+                    if not chunk:
+                        raise ValidationError(f"{name}: no spectrumList")
+                    continue
+                header = INDEXED_MZML.sub(b"", buffer[: match.start()], count=1)
+                if indexed:
+                    mzml = MZML_START.search(header)
+                    if mzml is None:
+                        raise ValidationError(f"{name}: no mzML element")
+                    start = mzml.start()
+                    header = header[:start] + INDEXED_MZML_START + header[start:]
+                out.write(header)
+                tag = match.group()
+                declared = COUNT.search(tag)
+                stats["declared"] = int(declared.group(1)) if declared else 0
+                if declared:
+                    count_offset = out.tell() + declared.start()
+                    tag = (
+                        tag[: declared.start()] + COUNT_PLACEHOLDER + tag[declared.end() :]
+                    )
+                out.write(tag)
+                buffer = buffer[match.end() :]
+                in_list = True
+
+            # the buffer is walked by position and trimmed once per chunk
+            list_end = buffer.find(SPECTRUM_LIST_END)
+            pos = 0
+            while True:
+                start = SPECTRUM_START.search(buffer, pos)
+                if list_end != -1 and (start is None or list_end < start.start()):
+                    done = True
+                    break
+                if start is None:
+                    pos = max(pos, len(buffer) - OVERLAP)
+                    break
+                end = buffer.find(SPECTRUM_END, start.start())
+                if end == -1:
+                    pos = start.start()
+                    break
+                end += len(SPECTRUM_END)
+                spectrum = buffer[start.start() : end]
+                pos = end
+
+                stats["spectra"] += 1
+                if not MS2.search(spectrum):
+                    continue
+                stats["ms2"] += 1
+                if (stats["ms2"] - 1) % every:
+                    continue
+                # renumbered, readers expect index to count from 0
+                tag_end = spectrum.find(b">")
+                tag = INDEX.sub(b'index="%d"' % stats["kept"], spectrum[:tag_end], count=1)
+                out.write(b"\n")
+                spectrum_id = SPECTRUM_ID.search(tag)
+                if spectrum_id:
+                    offsets.append((spectrum_id.group(1), out.tell()))
+                out.write(tag + spectrum[tag_end:])
+                stats["kept"] += 1
+                if limit and stats["kept"] >= limit:
+                    done = True
+                    break
+            buffer = buffer[pos:]
+            if not chunk:
+                break
+
+        out.write(b"\n</spectrumList>\n</run>\n</mzML>\n")
+        if count_offset is not None:
+            end = out.tell()
+            out.seek(count_offset)
+            out.write(b'count="%d"' % stats["kept"])
+            out.seek(end)
+        if indexed:
+            _write_index(out, offsets)
+    return stats
+
+
+def _write_index(out: BinaryIO, offsets: List[Tuple[bytes, int]]) -> None:
+    index_offset = out.tell()
+    out.write(b'<indexList count="1">\n<index name="spectrum">\n')
+    for spectrum_id, offset in offsets:
+        out.write(b'<offset idRef="%s">%d</offset>\n' % (spectrum_id, offset))
+    out.write(b"</index>\n</indexList>\n")
+    out.write(b"<indexListOffset>%d</indexListOffset>\n<fileChecksum>" % index_offset)
+    # SHA-1 of the file up to and including the opening fileChecksum tag
+    checksum = hashlib.sha1()
+    out.seek(0)
+    while True:
+        chunk = out.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        checksum.update(chunk)
+    out.seek(0, os.SEEK_END)
+    out.write(checksum.hexdigest().encode() + b"</fileChecksum>\n</indexedmzML>\n")
+
+
+def sample_inputs(
+    sources: List[Tuple[BinaryIO, str]],
+    workdir: str,
+    spectra: int,
+    spread: bool = False,
+    indexed: bool = False,
+    prefix: str = "sample",
+) -> Tuple[List[str], int, int]:
+    """
+    About `spectra` MS2 spectra of the (file, name) sources as mzML files in
+    workdir, the first of each file or, with `spread`, every Nth over the
+    whole file. Returns their paths, the spectra sampled and the estimated
+    MS2 spectra of the full inputs.
+    """
+    paths, sampled, total = [], 0, 0
+    per_file = max(1, spectra // len(sources))
+    for i, (src, name) in enumerate(sources):
+        every = max(1, count_ms2(src, name) // per_file) if spread else 1
+        path = os.path.join(workdir, f"{prefix}_{i}.mzML")
+        stats = subsample_mzml(src, name, path, every, per_file, indexed)
+        if not stats["kept"]:
+            continue
+        paths.append(path)
+        sampled += stats["kept"]
+        # the declared count includes MS1 spectra, scaled by the MS2 share seen
+        declared = max(stats["declared"], stats["spectra"])
+        total += round(declared * stats["ms2"] / stats["spectra"])
+    return paths, sampled, total
@@ -0,0 +1,164 @@
+"""
+Jobs that are not searches (jobs.TUNING, jobs.PREVIEW): the trial searches
+of tuning.py and the sample search of preview.py. They are queued, counted
+against the user's quotas and run by a worker in one of its slots, pinned to
+the slot's cores like searches, instead of in the app's session on the web
+host.
+
+The app samples the uploaded mzML files into the job's workspace and writes
+TASK_FILE there. The worker runs this module in the workspace
+(`python -m sage_web_apps.tasks <workspace>`), which samples the server
+data, runs the searches and writes the result to TASK_RESULT_FILE in the
+job's output directory.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+from typing import BinaryIO, List, Optional, Tuple
+
+from sage_web_apps.jobs import (
+    JOB_FILE,
+    PREVIEW,
+    TASK_RESULT_FILE,
+    TUNING,
+    Job,
+    load_job,
+)
+from sage_web_apps.preview import preview_summary, run_preview
+from sage_web_apps.subsample import sample_inputs
+from sage_web_apps.tuning import store_recommendation, tune
+from sage_web_apps.validation import ValidationError
+
+# what to run, written by the app next to job.json
+TASK_FILE = "task.json"
+
+
+def task_command(workspace: str) -> List[str]:
+    return [sys.executable, "-m", "sage_web_apps.tasks", workspace]
+
+
+def sample_uploads(
+    uploads: List[Tuple[BinaryIO, str]],
+    server_files: int,
+    workspace: str,
+    spectra: int,
+    spread: bool = False,
+    indexed: bool = False,
+) -> dict:
+    """
+    Sample the uploads (file, name) into the workspace, as many spectra per
+    file as the worker takes from each of the `server_files`. Returns the
+    TASK_FILE fields the worker continues from.
+    """
+    per_file = max(1, spectra // (len(uploads) + server_files))
+    paths, sampled, total = [], 0, 0
+    if uploads:
+        # named apart from the worker's samples, Sage tells runs by file name
+        paths, sampled, total = sample_inputs(
+            uploads, workspace, per_file * len(uploads), spread, indexed, "upload"
+        )
+    return {
+        "spectra_per_file": per_file,
+        "spread": spread,
+        "indexed": indexed,
+        "sampled_paths": paths,
+        "sampled": sampled,
+        "total": total,
+    }
+
+
+def write_task(job: Job, task: dict) -> None:
+    with open(os.path.join(job.workspace, TASK_FILE), "w") as f:
+        json.dump(task, f, indent=2)
+
+
+def read_result(job: Job) -> Optional[dict]:
+    try:
+        with open(os.path.join(job.output_path, TASK_RESULT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def sample(job: Job, task: dict, workdir: str) -> Tuple[List[str], int, int]:
+    """The app's samples of the uploads plus samples of the server data."""
+    paths, sampled, total = task["sampled_paths"], task["sampled"], task["total"]
+    if job.mzml_paths:
+        opened = [open(path, "rb") for path in job.mzml_paths]
+        try:
+            more_paths, more_sampled, more_total = sample_inputs(
+                [(f, os.path.basename(f.name)) for f in opened],
+                workdir,
+                task["spectra_per_file"] * len(opened),
+                task["spread"],
+                task["indexed"],
+            )
+        finally:
+            for f in opened:
+                f.close()
+        paths = paths + more_paths
+        sampled += more_sampled
+        total += more_total
+    if not paths:
+        raise ValidationError("the mzML files have no MS2 spectra")
+    return paths, sampled, total
+
+
+def run_task(job: Job, task: dict, sage_path: str, workdir: str) -> dict:
+    with open(job.config_path) as f:
+        config = json.load(f)
+    paths, sampled, total = sample(job, task, workdir)
+    print(f"Sampled {sampled} of about {total} MS2 spectra", flush=True)
+    if job.kind == TUNING:
+        result = tune(
+            sage_path,
+            config,
+            job.fasta_path,
+            paths,
+            sampled,
+            total,
+            workdir,
+            progress=lambda t: print(
+                f"bucket_size {t['bucket_size']}, {t['threads']} threads: "
+                f"{t['seconds']:.1f} s",
+                flush=True,
+            ),
+        )
+        result["fingerprint"] = task["fingerprint"]
+        # the workspace is in the jobs root, where recommendations are cached
+        store_recommendation(os.path.dirname(job.workspace), result)
+        return result
+    if job.kind == PREVIEW:
+        output_path = run_preview(sage_path, config, job.fasta_path, paths, workdir)
+        return preview_summary(output_path, sampled)
+    raise ValueError(f"unknown job kind {job.kind}")
+
+
+def main() -> None:
+    workspace = sys.argv[1]
+    job = load_job(os.path.join(workspace, JOB_FILE))
+    with open(os.path.join(workspace, TASK_FILE)) as f:
+        task = json.load(f)
+    # a worker started with --sage passes its own Sage
+    sage_path = os.getenv("SAGE_EXECUTABLE") or task["sage_path"]
+
+    workdir = os.path.join(workspace, "samples")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        result = run_task(job, task, sage_path, workdir)
+    except (ValidationError, RuntimeError, OSError, subprocess.TimeoutExpired) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(job.output_path, exist_ok=True)
+    with open(os.path.join(job.output_path, TASK_RESULT_FILE), "w") as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Auto-tuning of Sage's bucket_size and thread count.
+
+A few thousand MS2 spectra of the user's files are searched with each
+bucket size on all cores, then with fewer threads at the fastest bucket
+size. Each trial's time is split into the fragment index build, which does
+not grow with the data, and the search, which is scaled to the full number
+of spectra, so the recommendation is the setting that finishes the whole
+search first. Recommendations are cached per FASTA/config fingerprint.
+
+Tuning runs as a job in a worker slot (tasks.py), so the thread counts tried
+are those of the slot's cores, and the timings are not skewed by searches
+running next to it.
+"""
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from sage_web_apps.affinity import available_cpus
+
+BUCKET_SIZES = [8192, 16384, 32768, 65536]
+
+# MS2 spectra searched per trial, over all files
+TRIAL_SPECTRA = int(os.getenv("SAGE_TUNE_SPECTRA", "2000"))
+
+# wall-clock limit per trial search, in seconds
+TRIAL_TIMEOUT = float(os.getenv("SAGE_TUNE_TIMEOUT", "600"))
+
+TUNING_DIR = "tuning"
+
+# Sage logs how long building the fragment index took
+INDEX_TIME = re.compile(r"generated .* in (\d+)\s*ms")
+
+
+def thread_counts(cpus: int) -> List[int]:
+    return sorted({max(1, cpus // 4), max(1, cpus // 2), cpus})
+
+
+def fingerprint(sage_path: str, fasta_sha256: str, config: dict) -> str:
+    """Searches with equal fingerprints get the same recommendation."""
+    config = json.loads(json.dumps(config))
+    # the tuned value and per-run paths
+    for key in ("mzml_paths", "output_directory"):
+        config.pop(key, None)
+    if isinstance(config.get("database"), dict):
+        config["database"].pop("fasta", None)
+        config["database"].pop("bucket_size", None)
+    key = [sage_path, fasta_sha256, config]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _cache_path(jobs_root: str, key: str) -> str:
+    return os.path.join(jobs_root, TUNING_DIR, f"{key}.json")
+
+
+def cached_recommendation(jobs_root: str, key: str) -> Optional[dict]:
+    try:
+        with open(_cache_path(jobs_root, key)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store_recommendation(jobs_root: str, result: dict) -> None:
+    path = _cache_path(jobs_root, result["fingerprint"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(result, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def trial(
+    sage_path: str,
+    config: dict,
+    fasta_path: str,
+    mzml_paths: List[str],
+    workdir: str,
+    bucket_size: int,
+    threads: int,
+) -> Dict[str, float]:
+    """One timed Sage search of the sampled spectra."""
+    name = f"trial_{bucket_size}_{threads}"
+    config = dict(config, database=dict(config.get("database") or {}, bucket_size=bucket_size))
+    config_path = os.path.join(workdir, f"{name}.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [
+            sage_path,
+            config_path,
+            *mzml_paths,
+            "--fasta",
+            fasta_path,
+            "--output_directory",
+            os.path.join(workdir, name),
+        ],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, RAYON_NUM_THREADS=str(threads)),
+        timeout=TRIAL_TIMEOUT,
+    )
+    seconds = time.perf_counter() - start
+    if proc.returncode:
+        raise RuntimeError(
+            f"Trial search failed (bucket_size {bucket_size}, {threads} threads): "
+            f"{proc.stderr[-1000:]}"
+        )
+    index = INDEX_TIME.search(proc.stderr)
+    index_seconds = min(seconds, int(index.group(1)) / 1000) if index else 0.0
+    return {
+        "bucket_size": bucket_size,
+        "threads": threads,
+        "seconds": seconds,
+        "index_seconds": index_seconds,
+    }
+
+
+def tune(
+    sage_path: str,
+    config: dict,
+    fasta_path: str,
+    mzml_paths: List[str],
+    sampled: int,
+    total: int,
+    workdir: str,
+    progress: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    """
+    Trial searches and the recommended bucket_size and thread count, on the
+    cores this process may use (a worker slot's).
+    """
+    cpus = len(available_cpus())
+    trials = []
+
+    def run(bucket_size, threads):
+        result = trial(
+            sage_path, config, fasta_path, mzml_paths, workdir, bucket_size, threads
+        )
+        search_seconds = max(result["seconds"] - result["index_seconds"], 1e-3)
+        result["spectra_per_second"] = sampled / search_seconds
+        result["estimated_seconds"] = (
+            result["index_seconds"] + search_seconds * max(total, sampled) / sampled
+        )
+        trials.append(result)
+        if progress:
+            progress(result)
+
+    for bucket_size in BUCKET_SIZES:
+        run(bucket_size, cpus)
+    best = min(trials, key=lambda t: t["estimated_seconds"])
+    for threads in thread_counts(cpus):
+        if threads != cpus:
+            run(best["bucket_size"], threads)
+    best = min(trials, key=lambda t: t["estimated_seconds"])
+
+    return {
+        "created_at": time.time(),
+        "cpus": cpus,
+        "sampled_spectra": sampled,
+        "estimated_spectra": total,
+        "bucket_size": best["bucket_size"],
+        "threads": best["threads"],
+        "trials": trials,
+    }
@@ -0,0 +1,22 @@
+import os
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+
+def get_user_id(is_local: bool) -> str:
+    """
+    Identity used for quotas, fair-share ordering and the job catalog.
+
+    In server mode this is the user name set by an authenticating reverse proxy
+    in the header named by SAGE_USER_HEADER, otherwise the browser session. No
+    header is trusted by default: without a proxy that sets (and strips) it,
+    any client could claim to be any user.
+    """
+    if is_local:
+        return "local"
+    header = os.getenv("SAGE_USER_HEADER")
+    user = st.context.headers.get(header) if header else None
+    if user:
+        return user
+    return f"session-{get_script_run_ctx().session_id[:8]}"
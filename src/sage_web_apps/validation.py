@@ -0,0 +1,194 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import zlib
+from typing import BinaryIO, Optional
+from xml.parsers import expat
+
+from sage_web_apps.compression import ParallelGzipWriter
+
+# inputs are checked while they are written to the workspace, so broken
+# files are rejected before a search takes any CPU
+CHUNK_SIZE = 1024 * 1024
+
+# residues Sage accepts in FASTA sequences (plus stop codons)
+FASTA_SEQUENCE = re.compile(rb"^[A-Za-z*]*$")
+
+
+class ValidationError(Exception):
+    """Raised when an input file is malformed."""
+
+
+class FastaValidator:
+    def __init__(self):
+        self.buffer = b""
+        self.line_number = 0
+        self.records = 0
+        self.residues = 0
+
+    def _line(self, line: bytes):
+        self.line_number += 1
+        line = line.rstrip(b"\r")
+        if not line.strip():
+            return
+        if line.startswith(b">"):
+            if not line[1:].strip():
+                raise ValidationError(
+                    f"empty FASTA header on line {self.line_number}"
+                )
+            self.records += 1
+        elif self.records == 0:
+            raise ValidationError("FASTA does not start with a '>' header line")
+        elif not FASTA_SEQUENCE.match(line.strip()):
+            raise ValidationError(
+                f"invalid sequence characters on line {self.line_number}"
+            )
+        else:
+            self.residues += len(line.strip())
+
+    def feed(self, data: bytes):
+        lines = (self.buffer + data).split(b"\n")
+        # the last piece may be a partial line
+        self.buffer = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def close(self):
+        self._line(self.buffer)
+        if self.records == 0 or self.residues == 0:
+            raise ValidationError("FASTA contains no protein sequences")
+
+
+class MzmlValidator:
+    """XML well-formedness (incl. closing tags) and, for .gz, gzip integrity."""
+
+    def __init__(self, gzipped: bool):
+        self.gzipped = gzipped
+        self.decompressor = zlib.decompressobj(31) if gzipped else None
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self._start
+        self.root = None
+        self.spectra = 0
+
+    def _start(self, name, attrs):
+        if self.root is None:
+            self.root = name
+            if name not in ("mzML", "indexedmzML"):
+                raise ValidationError(f"root element is <{name}>, not <mzML>")
+        elif name == "spectrum":
+            self.spectra += 1
+
+    def _parse(self, data: bytes, final: bool = False):
+        try:
+            self.parser.Parse(data, final)
+        except expat.ExpatError as e:
+            raise ValidationError(f"invalid mzML XML: {e}")
+
+    def feed(self, data: bytes):
+        if not self.gzipped:
+            self._parse(data)
+            return
+        try:
+            while data:
+                self._parse(self.decompressor.decompress(data))
+                # parallel gzip writes several members back to back
+                data = self.decompressor.unused_data
+                if self.decompressor.eof and data:
+                    self.decompressor = zlib.decompressobj(31)
+        except zlib.error as e:
+            raise ValidationError(f"corrupt gzip data: {e}")
+
+    def close(self):
+        if self.gzipped and not self.decompressor.eof:
+            raise ValidationError("gzip file is truncated")
+        # fails on unclosed elements, e.g. a truncated file
+        self._parse(b"", True)
+        if self.spectra == 0:
+            raise ValidationError("mzML contains no spectra")
+
+
+class ConfigValidator:
+    def __init__(self):
+        self.data = b""
+
+    def feed(self, data: bytes):
+        self.data += data
+
+    def close(self):
+        try:
+            config = json.loads(self.data)
+        except ValueError as e:
+            raise ValidationError(f"config is not valid JSON: {e}")
+        if not isinstance(config, dict):
+            raise ValidationError("config must be a JSON object")
+
+
+def validator_for(name: str):
+    """A validator for an input file by name, None if it cannot be checked."""
+    name = name.lower()
+    if name.endswith((".fasta", ".fa")):
+        return FastaValidator()
+    if name.endswith(".mzml"):
+        return MzmlValidator(gzipped=False)
+    if name.endswith(".mzml.gz"):
+        return MzmlValidator(gzipped=True)
+    if name.endswith(".json"):
+        return ConfigValidator()
+    return None
+
+
+def copy_validated(
+    src: BinaryIO, dest: Optional[str], name: str, compress: bool = False
+) -> str:
+    """
+    Stream src to dest (None to only check it) and validate it in the same
+    pass, gzipping it on the way with `compress`. Returns the SHA-256 of
+    src's content (before compression), raises ValidationError naming the
+    file.
+    """
+    validator = validator_for(name)
+    digest = hashlib.sha256()
+    if src.seekable():
+        src.seek(0)  # uploads may have been read before
+    if dest and compress:
+        out = ParallelGzipWriter(dest)
+    else:
+        out = open(dest, "wb") if dest else None
+    try:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if out:
+                out.write(chunk)
+            digest.update(chunk)
+            if validator:
+                validator.feed(chunk)
+        if validator:
+            validator.close()
+    except ValidationError as e:
+        raise ValidationError(f"{name}: {e}")
+    finally:
+        if out:
+            out.close()
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=4096)
+def _validate_file(path: str, size: int, mtime_ns: int) -> str:
+    with open(path, "rb") as f:
+        return copy_validated(f, None, os.path.basename(path))
+
+
+def validate_path(path: str) -> Optional[str]:
+    """
+    Validate a file that is used in place (server data), returns its SHA-256.
+    Results are cached by path, size and mtime, so an unchanged file is read
+    once per process.
+    """
+    if os.path.isdir(path):
+        return None  # Bruker .d folders
+    stat = os.stat(path)
+    return _validate_file(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
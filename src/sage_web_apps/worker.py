@@ -0,0 +1,466 @@
+"""
+Workers run queued Sage jobs.
+
+The app runs one worker in-process (SAGE_MAX_RUNNING_JOBS slots, 0 to only
+queue). More can run on other nodes with `sage-worker`, as long as the job
+workspaces are on storage mounted at the same path everywhere.
+
+A worker claims a job (see jobs.claim_job), together with queued jobs that
+can share its Sage run (see coalesce.py), refreshes the job's heartbeat
+while Sage runs and writes the result back to job.json. Jobs whose worker
+stopped sending heartbeats are queued again by any other worker.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from sage_web_apps.affinity import CpuAllocator, pin_current_thread
+from sage_web_apps.coalesce import (
+    MAX_BATCH_JOBS,
+    batch_command,
+    file_names,
+    input_shares,
+    search_key,
+    split_outputs,
+)
+from sage_web_apps.incremental import merge_parent
+from sage_web_apps.jobs import (
+    CANCELLED,
+    COMPLETED,
+    FAILED,
+    JOB_FILE,
+    PENDING,
+    RUNNING,
+    SEARCH,
+    TIMED_OUT,
+    Job,
+    Quotas,
+    Scheduler,
+    claim_job,
+    claimant,
+    drop_claim,
+    is_job_process,
+    load_job,
+    proc_cpu_seconds,
+    release_workspace,
+    save_job,
+    signal_process_group,
+)
+from sage_web_apps.postprocess import POSTPROCESS_WORKERS, postprocess
+from sage_web_apps.validation import ValidationError, validate_path
+
+# how often running Sage processes are polled (seconds)
+POLL_INTERVAL = 0.5
+
+# how often an idle worker looks for queued jobs (seconds)
+QUEUE_POLL_INTERVAL = 2
+
+# seconds between SIGTERM and SIGKILL when stopping a search
+KILL_GRACE_PERIOD = 10
+
+# how often running jobs report they are alive, and when they count as lost
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = float(os.getenv("SAGE_HEARTBEAT_TIMEOUT", "60"))
+
+
+class Worker:
+    def __init__(
+        self,
+        scheduler: Scheduler,
+        slots: int,
+        sage_path: Optional[str] = None,
+        postprocess_workers: int = POSTPROCESS_WORKERS,
+    ):
+        self.scheduler = scheduler
+        self.slots = slots
+        # use this node's Sage instead of the path the app put in the command
+        self.sage_path = sage_path
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.running: Dict[str, Job] = {}
+        # Sage runs by their first job; a run takes one slot, however many
+        # coalesced jobs it searches
+        self.batches: Dict[str, List[Job]] = {}
+        # job_id -> share of its run's CPU time
+        self.cpu_shares: Dict[str, float] = {}
+        self.cpus = CpuAllocator(slots)
+        # jobs another worker took over, their Sage process is killed
+        self.lost = set()
+        self.wakeup = threading.Event()
+        # serializes job.json writes of the run and heartbeat threads
+        self.lock = threading.Lock()
+        # finished searches are archived and indexed here, off the slots
+        self.postprocessing = ThreadPoolExecutor(
+            max(1, postprocess_workers), thread_name_prefix="postprocess"
+        )
+
+    def start(self) -> None:
+        threading.Thread(target=self.run_forever, daemon=True).start()
+
+    def save(self, job: Job) -> None:
+        with self.lock:
+            save_job(job)
+
+    def run_forever(self) -> None:
+        threading.Thread(target=self._heartbeats, daemon=True).start()
+        while True:
+            try:
+                self.requeue_lost_jobs()
+                while len(self.batches) < self.slots:
+                    job = self._claim_next()
+                    if job is None:
+                        break
+                    jobs = self._claim_batch(job)
+                    self.batches[job.job_id] = jobs
+                    for job in jobs:
+                        self.running[job.job_id] = job
+                    threading.Thread(
+                        target=self._run, args=(jobs,), daemon=True
+                    ).start()
+            except Exception:
+                # the node keeps taking jobs, a job claimed here and not started
+                # is queued again by requeue_lost_jobs
+                traceback.print_exc()
+            self.wakeup.wait(QUEUE_POLL_INTERVAL)
+            self.wakeup.clear()
+
+    def _claim_next(self) -> Optional[Job]:
+        for job in self.scheduler.queue():
+            if not claim_job(job, self.worker_id):
+                continue
+            # re-read, the queue snapshot may be stale
+            job = load_job(os.path.join(job.workspace, JOB_FILE))
+            if job.status != PENDING:
+                continue
+            return job
+        return None
+
+    def _claim_batch(self, leader: Job) -> List[Job]:
+        """The claimed job plus queued jobs that can share its Sage run."""
+        key = search_key(leader) if MAX_BATCH_JOBS > 1 else None
+        if key is None:
+            return [leader]
+        jobs = [leader]
+        names = file_names(leader)
+        # every job of the batch counts against its owner's running job cap
+        cap = self.scheduler.quotas.max_running_jobs
+        running = self.scheduler.running(list(self.scheduler.jobs.values()))
+        running[leader.owner] = running.get(leader.owner, 0) + 1
+        for job in self.scheduler.queue():
+            if len(jobs) >= MAX_BATCH_JOBS:
+                break
+            if job.job_id == leader.job_id or names & file_names(job):
+                continue
+            if cap and running.get(job.owner, 0) >= cap:
+                continue
+            if search_key(job) != key or not claim_job(job, self.worker_id):
+                continue
+            job = load_job(os.path.join(job.workspace, JOB_FILE))
+            if job.status != PENDING:
+                continue
+            jobs.append(job)
+            names |= file_names(job)
+            running[job.owner] = running.get(job.owner, 0) + 1
+        return jobs
+
+    def requeue_lost_jobs(self) -> None:
+        """Queue jobs again whose worker died (no heartbeat) or never started them."""
+        now = time.time()
+        for job in self.scheduler.jobs.values():
+            try:
+                self._requeue_lost_job(job, now)
+            except Exception:
+                # one job's files changing under us must not stop the others
+                traceback.print_exc()
+
+    def _requeue_lost_job(self, job: Job, now: float) -> None:
+        if job.status == RUNNING:
+            if now - (job.heartbeat_at or job.started_at or 0) < HEARTBEAT_TIMEOUT:
+                return
+        elif job.status == PENDING:
+            # claimed, but the claimant died before starting it
+            try:
+                claimed_at = os.path.getmtime(job.claim_path)
+            except OSError:
+                return  # not claimed, or the claim was just dropped or taken
+            if now - claimed_at < HEARTBEAT_TIMEOUT:
+                return
+        else:
+            return
+
+        if not drop_claim(job):
+            return  # another worker got there first
+        # a Sage process left behind by a worker on this node
+        if job.worker and job.worker.split(":")[0] == socket.gethostname():
+            if is_job_process(job):
+                signal_process_group(job.pid, signal.SIGKILL)
+
+        if job.cancel_requested:
+            job.status = CANCELLED
+            job.finished_at = now
+            release_workspace(job)
+        else:
+            job.status = PENDING
+            job.started_at = job.pid = job.worker = job.heartbeat_at = None
+        save_job(job)
+
+    def _heartbeats(self) -> None:
+        """Record that running jobs are alive, also while their results are zipped."""
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            for job in list(self.running.values()):
+                if claimant(job) != self.worker_id:
+                    # requeued elsewhere, e.g. after a network partition
+                    self.lost.add(job.job_id)
+                    continue
+                with self.lock:
+                    if job.finished:
+                        continue
+                    job.heartbeat_at = time.time()
+                    if job.returncode is None and job.pid:
+                        share = self.cpu_shares.get(job.job_id, 1.0)
+                        job.cpu_seconds = proc_cpu_seconds(job.pid) * share
+                    save_job(job)
+
+    def _validate_inputs(self, jobs: List[Job]) -> List[Job]:
+        """Validate and hash the jobs' server data, failing jobs with broken files."""
+        valid = []
+        for job in jobs:
+            if job.kind != SEARCH:
+                valid.append(job)  # tasks only sample their inputs
+                continue
+            hashes = job.mzml_sha256 or [None] * len(job.mzml_paths)
+            try:
+                job.mzml_sha256 = [
+                    sha256 or validate_path(path)
+                    for path, sha256 in zip(job.mzml_paths, hashes)
+                ]
+            except (ValidationError, OSError) as e:
+                with self.lock:
+                    job.status = FAILED
+                    job.error = f"Invalid input, the search was not started: {e}"
+                    job.finished_at = time.time()
+                    save_job(job)
+                del self.running[job.job_id]
+                self.lost.discard(job.job_id)
+                continue
+            valid.append(job)
+        return valid
+
+    def _run(self, jobs: List[Job]) -> None:
+        # the slot is held under the first claimed job
+        slot = jobs[0].job_id
+        for job in jobs:
+            if job.kind != SEARCH:
+                # tasks.py in this node's Python, it gets the Sage path below
+                job.command = [sys.executable, *job.command[1:]]
+            elif self.sage_path:
+                job.command = [self.sage_path, *job.command[1:]]
+
+        started_at = time.time()
+        cpus = self.cpus.allocate()
+        for job in jobs:
+            job.status = RUNNING
+            job.started_at = job.heartbeat_at = started_at
+            job.worker = self.worker_id
+            job.cpus = cpus
+            self.save(job)
+
+        # running (with heartbeats) while large server files are read
+        jobs = self._validate_inputs(jobs)
+        if not jobs:
+            self.cpus.release(cpus)
+            del self.batches[slot]
+            self.wakeup.set()
+            return
+
+        leader = jobs[0]
+        if len(jobs) > 1:
+            # one search for all, split into the jobs' outputs afterwards
+            run_path = os.path.join(leader.workspace, "batch")
+            command = batch_command(jobs, run_path)
+        else:
+            run_path = leader.output_path
+            command = leader.command
+        for job, share in zip(jobs, input_shares(jobs)):
+            self.cpu_shares[job.job_id] = share
+            job.batch_id = leader.job_id if len(jobs) > 1 else None
+            self.save(job)
+
+        stopped = None
+        cpus_released = False
+        try:
+            os.makedirs(run_path, exist_ok=True)
+            stdout_path = os.path.join(run_path, "stdout.txt")
+            stderr_path = os.path.join(run_path, "stderr.txt")
+            with open(stdout_path, "w") as out, open(stderr_path, "w") as err:
+                # Sage inherits the cores of this thread, its rayon pool is sized to match
+                pin_current_thread(cpus)
+                env = dict(os.environ, RAYON_NUM_THREADS=str(len(cpus)))
+                if self.sage_path:
+                    env["SAGE_EXECUTABLE"] = self.sage_path
+                # own session/process group, so everything Sage starts can be killed
+                proc = subprocess.Popen(
+                    command,
+                    stdout=out,
+                    stderr=err,
+                    start_new_session=True,
+                    env=env,
+                )
+                for job in jobs:
+                    job.pid = proc.pid
+                    self.save(job)
+
+                deadline = started_at + leader.timeout if leader.timeout else None
+                killed_at = None
+                # wait4 instead of proc.wait() to get the CPU time of this child only
+                while True:
+                    pid, wait_status, rusage = os.wait4(proc.pid, os.WNOHANG)
+                    if pid:
+                        break
+                    # a batch keeps running for the jobs that still want it
+                    if killed_at is None:
+                        if all(job.job_id in self.lost for job in jobs):
+                            stopped = "lost"
+                        elif all(job.cancel_requested for job in jobs):
+                            stopped = CANCELLED
+                        elif deadline and time.time() > deadline:
+                            stopped = TIMED_OUT
+                        if stopped:
+                            signal_process_group(proc.pid, signal.SIGTERM)
+                            killed_at = time.time()
+                    elif time.time() - killed_at > KILL_GRACE_PERIOD:
+                        signal_process_group(proc.pid, signal.SIGKILL)
+                    time.sleep(POLL_INTERVAL)
+                proc.returncode = os.waitstatus_to_exitcode(wait_status)
+                # reap anything Sage left behind in its group
+                signal_process_group(proc.pid, signal.SIGKILL)
+
+            # the cores are free for the next job while the results are processed
+            self.cpus.release(cpus)
+            cpus_released = True
+            pin_current_thread(sorted(self.cpus.available))
+
+            cpu_seconds = rusage.ru_utime + rusage.ru_stime
+            for job in jobs:
+                job.returncode = proc.returncode
+                job.cpu_seconds = cpu_seconds * self.cpu_shares[job.job_id]
+            if stopped == TIMED_OUT:
+                status = TIMED_OUT
+                error = f"Sage did not finish within {leader.timeout / 3600:g} hours"
+                for job in jobs:
+                    job.error = error
+            elif stopped == CANCELLED:
+                status = CANCELLED
+            elif stopped == "lost":
+                status = FAILED
+            else:
+                status = COMPLETED if proc.returncode == 0 else FAILED
+                if proc.returncode != 0:
+                    for job in jobs:
+                        job.error = f"Sage exited with code {proc.returncode}"
+        except Exception as e:
+            status = FAILED
+            for job in jobs:
+                job.error = str(e)
+
+        if not cpus_released:
+            self.cpus.release(cpus)
+
+        # the slot takes the next search, the outputs are processed meanwhile
+        del self.batches[slot]
+        self.wakeup.set()
+        self.postprocessing.submit(self._finish, jobs, run_path, status)
+
+    def _finish(self, jobs: List[Job], run_path: str, status: str) -> None:
+        """Post-processing stage: split, merge, archive and index the outputs, then save."""
+        # jobs of the batch whose earlier search could not be added
+        merge_failed = set()
+        try:
+            if len(jobs) > 1 and os.path.isdir(run_path):
+                # also for stopped runs, so every job keeps its logs
+                split_outputs(run_path, jobs)
+                shutil.rmtree(run_path, ignore_errors=True)
+            if status == COMPLETED:
+                for job in jobs:
+                    # tasks leave only their result (tasks.py)
+                    if job.kind != SEARCH:
+                        continue
+                    if len(jobs) == 1 or not job.cancel_requested:
+                        # incremental searches add the earlier job's results first
+                        if job.parent_id:
+                            try:
+                                merge_parent(job, self.scheduler.get(job.parent_id))
+                            except Exception as e:
+                                job.error = f"Could not add search {job.parent_id}: {e}"
+                                merge_failed.add(job.job_id)
+                                continue
+                        postprocess(job)
+        except Exception as e:
+            status = FAILED
+            for job in jobs:
+                job.error = f"Post-processing failed: {e}"
+
+        for job in jobs:
+            if job.job_id in self.lost:
+                continue
+            job_status = status
+            if len(jobs) > 1 and status == COMPLETED and job.cancel_requested:
+                # cancelled while its batch kept running for the other jobs
+                job_status = CANCELLED
+            elif job.job_id in merge_failed:
+                job_status = FAILED
+            # hand the disk space back right away
+            if job_status in (CANCELLED, TIMED_OUT) or job.kind != SEARCH:
+                release_workspace(job)
+            with self.lock:
+                job.finished_at = time.time()
+                job.status = job_status
+                save_job(job)
+
+        for job in jobs:
+            del self.running[job.job_id]
+            self.lost.discard(job.job_id)
+            self.cpu_shares.pop(job.job_id, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued Sage jobs.")
+    parser.add_argument(
+        "--jobs-root",
+        default=os.getenv("SAGE_WORKSPACE_DIR", "sage_jobs"),
+        help="Job workspace directory shared with the app (default: SAGE_WORKSPACE_DIR)",
+    )
+    parser.add_argument(
+        "--slots", type=int, default=1, help="Searches to run at once on this node"
+    )
+    parser.add_argument(
+        "--sage",
+        default=os.getenv("SAGE_EXECUTABLE", "sage"),
+        help="Sage executable on this node (default: SAGE_EXECUTABLE or sage on PATH)",
+    )
+    parser.add_argument(
+        "--postprocess-workers",
+        type=int,
+        default=POSTPROCESS_WORKERS,
+        help="Finished searches processed at once (default: SAGE_POSTPROCESS_WORKERS)",
+    )
+    args = parser.parse_args()
+
+    scheduler = Scheduler(Quotas.from_env(), os.path.abspath(args.jobs_root))
+    worker = Worker(scheduler, args.slots, args.sage, args.postprocess_workers)
+    print(f"Worker {worker.worker_id} running {args.slots} slot(s) from {args.jobs_root}")
+    worker.run_forever()
+
+
+if __name__ == "__main__":
+    main()